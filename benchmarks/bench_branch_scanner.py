@@ -0,0 +1,106 @@
+'''
+Compares the built-in indirect branch scanner with the radare2 pipeline on a
+large synthetic binary.
+
+Usage:
+    python3 benchmarks/bench_branch_scanner.py [--functions N] [--binary path]
+'''
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "commands"))
+import branch_scanner  # noqa: E402
+
+
+def generate_source(num_functions: int) -> str:
+    lines = [
+        "#include <stdio.h>",
+        "#include <stdlib.h>",
+        "typedef long (*handler_t)(long);",
+    ]
+    for i in range(num_functions):
+        lines.append(f"__attribute__((noinline)) long leaf_{i}(long x) {{ return x * {i + 3} + {i}; }}")
+    lines.append(f"handler_t handlers[{num_functions}] = {{")
+    lines.extend(f"    leaf_{i}," for i in range(num_functions))
+    lines.append("};")
+    for i in range(num_functions):
+        # an indirect call through a table and a switch which is compiled into a jump table
+        lines.append(f"""__attribute__((noinline)) long dispatch_{i}(long x) {{
+    long r = handlers[(x + {i}) % {num_functions}](x);
+    switch ((x + r) & 7) {{
+    case 0: return r + {i};
+    case 1: return r - {i};
+    case 2: return r * {i};
+    case 3: return r ^ {i};
+    case 4: return r | {i};
+    case 5: return r & {i};
+    case 6: return r << 1;
+    default: return r >> 1;
+    }}
+}}""")
+    lines.append("int main(int argc, char **argv) {")
+    lines.append("    long acc = argc;")
+    lines.append(f"    long (*dispatchers[])(long) = {{ {', '.join(f'dispatch_{i}' for i in range(num_functions))} }};")
+    lines.append(f"    for (long i = 0; i < {num_functions}; i++) acc += dispatchers[i](acc);")
+    lines.append('    printf("%ld\\n", acc);')
+    lines.append("    return 0;")
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def build_binary(num_functions: int, work_dir: str) -> str:
+    source_path = os.path.join(work_dir, "synthetic.c")
+    binary_path = os.path.join(work_dir, "synthetic")
+    with open(source_path, "w") as fout:
+        fout.write(generate_source(num_functions))
+    subprocess.check_call(["cc", "-O2", "-fno-pie", "-no-pie", "-o", binary_path, source_path])
+    return binary_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--functions", type=int, default=5000, help="Number of synthetic dispatch functions")
+    parser.add_argument("--binary", default=None, help="Use an existing binary instead of building a synthetic one")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        if args.binary:
+            binary_path = args.binary
+        else:
+            start = time.perf_counter()
+            binary_path = build_binary(args.functions, work_dir)
+            print(f"Built synthetic binary in {time.perf_counter() - start:.2f} seconds")
+
+        section = branch_scanner.load_text_section(binary_path)
+        print(f"Binary: {binary_path} ({section.arch}, text section {len(section.data)} bytes)")
+
+        start = time.perf_counter()
+        scanner_sites = [site.address for site in branch_scanner.iter_indirect_branches(section.arch, section.data, section.address)]
+        scanner_time = time.perf_counter() - start
+        print(f"scanner: {len(scanner_sites)} sites in {scanner_time:.2f} seconds")
+
+        if shutil.which("r2") is None:
+            print("r2: skipped (radare2 is not installed)")
+            return
+
+        with open(binary_path, "rb") as fin:
+            section_name = ".text" if fin.read(4) == b"\x7fELF" else "__TEXT.__text"
+        start = time.perf_counter()
+        r2_sites = branch_scanner.scan_with_r2(binary_path, section.image_base, [section_name])
+        r2_time = time.perf_counter() - start
+        print(f"r2:      {len(r2_sites)} sites in {r2_time:.2f} seconds")
+        print(f"speedup: {r2_time / scanner_time:.1f}x")
+
+        only_scanner = set(scanner_sites) - set(r2_sites)
+        only_r2 = set(r2_sites) - set(scanner_sites)
+        print(f"sites found only by scanner: {len(only_scanner)}, only by r2: {len(only_r2)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,445 @@
+'''
+Measures the cost of the tracing commands (brt_set_bps, swtt_set_bps and
+xpr_yara_dump) by driving LLDB headlessly through its Python module against
+synthetic C programs. Requires Linux x86_64, a C compiler and LLDB with its
+Python module (found with "lldb -P" if it is not importable).
+
+Each scenario runs in its own process, so that the peak memory of one scenario
+does not hide the others. The results are written as JSON, and can be compared
+with an earlier run.
+
+With --check, nothing is timed: the cached static analyses (brt_set_bps branch
+sites and the xpr_yara_dump YaraMatcher.init lookup) are run on each program
+with an empty analysis cache and again from the stored entries, and both runs
+have to find the same sites.
+
+Usage:
+    python3 benchmarks/bench_tracing.py [--scale N] [--scenario NAME ...] [--output results.json] [--compare old.json]
+    python3 benchmarks/bench_tracing.py --check [--scale N] [--scenario NAME ...]
+'''
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+COMMANDS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "commands")
+sys.path.insert(0, COMMANDS_DIR)
+import analysis_cache  # noqa: E402
+
+
+def generate_indirect_calls_source(scale: int) -> str:
+    lines = [
+        "#include <stdio.h>",
+        "typedef long (*handler_t)(long);",
+        "struct shape;",
+        "struct shape_vtable { long (*area)(const struct shape *); long (*scale)(struct shape *, long); };",
+        "struct shape { const struct shape_vtable *vtable; long a, b; };",
+    ]
+    for i in range(scale):
+        lines.append(f"__attribute__((noinline)) long leaf_{i}(long x) {{ return x * {i + 3} + {i}; }}")
+    lines.append(f"handler_t handlers[{scale}] = {{ {', '.join(f'leaf_{i}' for i in range(scale))} }};")
+    for i in range(scale):
+        lines.append(f"__attribute__((noinline)) long dispatch_{i}(long x) {{ return handlers[(unsigned long)(x + {i}) % {scale}](x); }}")
+
+    # vtable calls through a few "classes"
+    num_classes = 8
+    for i in range(num_classes):
+        lines.append(f"static long area_{i}(const struct shape *s) {{ return s->a * s->b + {i}; }}")
+        lines.append(f"static long scale_{i}(struct shape *s, long k) {{ s->a += k; return s->a + {i}; }}")
+        lines.append(f"static const struct shape_vtable vtable_{i} = {{ area_{i}, scale_{i} }};")
+    lines.append(f"static const struct shape_vtable *vtables[{num_classes}] = {{ {', '.join(f'&vtable_{i}' for i in range(num_classes))} }};")
+    lines.append("__attribute__((noinline)) long visit(struct shape *s, long k) { return s->vtable->area(s) + s->vtable->scale(s, k); }")
+
+    lines.append("int main(int argc, char **argv) {")
+    lines.append("    long acc = argc;")
+    lines.append(f"    long (*dispatchers[])(long) = {{ {', '.join(f'dispatch_{i}' for i in range(scale))} }};")
+    lines.append(f"    struct shape shapes[{num_classes * 4}];")
+    lines.append(f"    for (int i = 0; i < {num_classes * 4}; i++) {{ shapes[i].vtable = vtables[i % {num_classes}]; shapes[i].a = i; shapes[i].b = i + 1; }}")
+    lines.append(f"    for (long i = 0; i < {scale}; i++) acc += dispatchers[i](acc);")
+    lines.append(f"    for (long i = 0; i < {scale}; i++) acc += visit(&shapes[i % {num_classes * 4}], i);")
+    lines.append('    printf("%ld\\n", acc);')
+    lines.append("    return 0;")
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def generate_allocations_source(scale: int) -> str:
+    num_types = 16
+    lines = [
+        "#include <stdint.h>",
+        "#include <stdlib.h>",
+        "#include <stdio.h>",
+        "/* Swift-like value metadata (kind, description) and context descriptors (flags, parent, name) */",
+        "struct metadata { uintptr_t kind; const void *description; };",
+        "struct context_descriptor { uint32_t flags; int32_t parent; int32_t name; };",
+        "static struct context_descriptor module_descriptor = { 0, 0, 0 };",
+        'static const char module_name[] = "Bench";',
+    ]
+    for i in range(num_types):
+        lines.append(f"static struct context_descriptor type_descriptor_{i} = {{ 0x11, 0, 0 }};")
+        lines.append(f'static const char type_name_{i}[] = "Type{i}";')
+        lines.append(f"struct metadata metadata_{i} = {{ 0x200, &type_descriptor_{i} }};")
+    lines.append("static void set_relative(int32_t *field, const void *target) { *field = (int32_t)((const char *)target - (const char *)field); }")
+    lines.append("static void init_descriptors(void) {")
+    lines.append("    set_relative(&module_descriptor.name, module_name);")
+    for i in range(num_types):
+        lines.append(f"    set_relative(&type_descriptor_{i}.parent, &module_descriptor);")
+        lines.append(f"    set_relative(&type_descriptor_{i}.name, type_name_{i});")
+    lines.append("}")
+    lines.append("__attribute__((noinline)) void *swift_allocObject(const struct metadata *metadata, size_t size, size_t align) {")
+    lines.append("    const struct metadata **object = malloc(size);")
+    lines.append("    *object = metadata;")
+    lines.append("    return object;")
+    lines.append("}")
+    for i in range(scale):
+        lines.append(f"__attribute__((noinline)) long alloc_site_{i}(long x) {{ long *p = swift_allocObject(&metadata_{i % num_types}, 32, 7); p[1] = x; x += p[1] ^ {i}; free(p); return x; }}")
+    lines.append("int main(int argc, char **argv) {")
+    lines.append("    long acc = argc;")
+    lines.append("    init_descriptors();")
+    lines.append("    for (int round = 0; round < 8; round++) {")
+    for i in range(scale):
+        lines.append(f"        acc = alloc_site_{i}(acc);")
+    lines.append("    }")
+    lines.append('    printf("%ld\\n", acc);')
+    lines.append("    return 0;")
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def generate_yara_source(scale: int) -> str:
+    return f"""#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+/* stand-ins for the libyara compiler API used by XProtectRemediator */
+typedef struct {{ size_t num_bytes; int num_strings; }} YR_COMPILER;
+__attribute__((noinline)) int yr_compiler_create(YR_COMPILER **compiler) {{ *compiler = calloc(1, sizeof(YR_COMPILER)); return 0; }}
+__attribute__((noinline)) int yr_compiler_add_string(YR_COMPILER *compiler, const char *rules, const char *ns) {{ compiler->num_bytes += strlen(rules); compiler->num_strings++; return 0; }}
+__attribute__((noinline)) int yr_compiler_get_rules(YR_COMPILER *compiler, void **rules) {{ *rules = compiler; return 0; }}
+__attribute__((noinline)) void *yara_matcher_init(char **rules, int num_rules) {{
+    YR_COMPILER *compiler;
+    void *compiled;
+    yr_compiler_create(&compiler);
+    for (int i = 0; i < num_rules; i++) yr_compiler_add_string(compiler, rules[i], NULL);
+    yr_compiler_get_rules(compiler, &compiled);
+    return compiled;
+}}
+static char *make_rule(int id, int num_strings) {{
+    size_t capacity = 128 + (size_t)num_strings * 64;
+    char *rule = malloc(capacity);
+    int length = snprintf(rule, capacity, "rule r_%d {{ strings: ", id);
+    for (int i = 0; i < num_strings; i++) length += snprintf(rule + length, capacity - length, "$s%d = \\"pattern_%d_%d\\" ", i, id, i);
+    snprintf(rule + length, capacity - length, "condition: any of them }}");
+    return rule;
+}}
+int main(int argc, char **argv) {{
+    int num_matchers = 8, num_rules = {scale};
+    for (int m = 0; m < num_matchers; m++) {{
+        char **rules = malloc(sizeof(char *) * num_rules);
+        /* matchers with the same parity compile the same rules, so most rules are duplicates */
+        for (int i = 0; i < num_rules; i++) rules[i] = make_rule((m % 2) * num_rules + i, 1 + (i * 37) % 512);
+        void *compiled = yara_matcher_init(rules, num_rules);
+        printf("%zu\\n", ((YR_COMPILER *)compiled)->num_bytes);
+        for (int i = 0; i < num_rules; i++) free(rules[i]);
+        free(rules);
+    }}
+    return 0;
+}}
+"""
+
+
+@dataclass
+class Program:
+    name: str
+    generate: Callable[[int], str]
+
+
+@dataclass
+class Scenario:
+    name: str
+    program: str
+    script: str
+    command: str
+    callbacks: List[str]
+
+
+PROGRAMS = {
+    "indirect_calls": Program("indirect_calls", generate_indirect_calls_source),
+    "allocations": Program("allocations", generate_allocations_source),
+    "yara": Program("yara", generate_yara_source),
+}
+
+BRT_CALLBACKS = ["break_on_indirect_branch", "break_on_indirect_branch_fast", "break_on_function_entry"]
+SWTT_CALLBACKS = ["break_on_swift_allocObject", "break_on_swift_initStackObject", "break_on_allocation_call_site"]
+XPR_CALLBACKS = ["break_on_YaraMatcher_init", "break_on_yr_compiler_add_string"]
+
+SCENARIOS = {scenario.name: scenario for scenario in [
+    Scenario("brt_step", "indirect_calls", "branch_trace", "brt_set_bps", BRT_CALLBACKS),
+    Scenario("brt_fast_aggregate", "indirect_calls", "branch_trace", "brt_set_bps -f -a", BRT_CALLBACKS),
+    Scenario("brt_fast_lazy", "indirect_calls", "branch_trace", "brt_set_bps -f -a --arm lazy", BRT_CALLBACKS),
+    Scenario("swtt_allocator", "allocations", "sw_types_trace", "swtt_set_bps", SWTT_CALLBACKS),
+    Scenario("swtt_call_sites", "allocations", "sw_types_trace", "swtt_set_bps -c", SWTT_CALLBACKS),
+    Scenario("xpr_yara", "yara", "xpr_yara_dump", "xpr_yara_dump", XPR_CALLBACKS),
+]}
+
+
+def discover_sites(scenario: Scenario, module, target) -> int:
+    '''
+    Runs the static analysis of a scenario with an empty analysis cache, and
+    returns the number of sites found
+    '''
+    if scenario.script == "branch_trace":
+        import branch_trace
+        return sum(len(addresses) for addresses in branch_trace.get_all_branch_instructions(target, [module]).values())
+    if scenario.script == "sw_types_trace":
+        import sw_types_trace
+        return sum(len(branches) for branches in sw_types_trace.find_allocation_call_sites(target, module).values())
+    import xpr_yara_dump
+    return 0 if xpr_yara_dump.find_YaraMatcher_init_addr(target, module) is None else 1
+
+
+def run_cached_analysis(scenario: Scenario, module, target) -> Optional[List[int]]:
+    '''
+    Runs the analysis of a scenario through the analysis cache, and returns the
+    sites found. Returns None if the analysis of the scenario is not cached.
+    '''
+    if scenario.script == "branch_trace":
+        import branch_trace
+        return sorted(address for addresses in branch_trace.get_all_branch_instructions(target, [module]).values() for address in addresses)
+    if scenario.script == "xpr_yara_dump":
+        import xpr_yara_dump
+        address = xpr_yara_dump.get_YaraMatcher_init_addr(target, module)
+        return [] if address is None else [address]
+    return None
+
+
+def instrument_callbacks(module, names: List[str], latencies: List[int]):
+    '''
+    Wraps breakpoint callbacks to record their latency. The wrappers keep the
+    (frame, bp_loc, dict) signature, which LLDB inspects to pass arguments.
+    '''
+    def instrument(callback):
+        def wrapper(frame, bp_loc, internal_dict):
+            start = time.perf_counter_ns()
+            try:
+                return callback(frame, bp_loc, internal_dict)
+            finally:
+                latencies.append(time.perf_counter_ns() - start)
+        return wrapper
+
+    for name in names:
+        if hasattr(module, name):
+            setattr(module, name, instrument(getattr(module, name)))
+
+
+def import_lldb():
+    try:
+        import lldb
+    except ImportError:
+        sys.path.insert(0, subprocess.check_output(["lldb", "-P"], text=True).strip())
+        import lldb
+    return lldb
+
+
+def summarize_latencies(latencies: List[int]) -> Optional[Dict[str, float]]:
+    if not latencies:
+        return None
+    latencies = sorted(latencies)
+    return {
+        "count": len(latencies),
+        "mean_us": statistics.fmean(latencies) / 1000,
+        "p50_us": latencies[len(latencies) // 2] / 1000,
+        "p99_us": latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)] / 1000,
+        "max_us": latencies[-1] / 1000,
+    }
+
+
+def launch_to_main(lldb, scenario: Scenario, binary_path: str, work_dir: str):
+    '''
+    Imports the command script of the scenario into a new debugger, and launches
+    the program until main. Returns (debugger, target, process)
+    '''
+    debugger = lldb.SBDebugger.Create()
+    debugger.SetAsync(False)
+    debugger.HandleCommand(f"command script import {os.path.join(COMMANDS_DIR, scenario.script)}.py")
+    target = debugger.CreateTarget(binary_path)
+    main_bp = target.BreakpointCreateByName("main")
+    process = target.LaunchSimple(None, None, work_dir)
+    if process.GetState() != lldb.eStateStopped:
+        raise RuntimeError(f"Cannot stop {binary_path} at main")
+    target.BreakpointDelete(main_bp.GetID())
+    return debugger, target, process
+
+
+def check_scenario(scenario: Scenario, binary_path: str, work_dir: str) -> dict:
+    '''
+    Runs the cached analysis of the scenario with an empty analysis cache, then
+    from the stored entries, and checks that both runs find the same sites
+    '''
+    lldb = import_lldb()
+    cache_dir = os.path.join(work_dir, f"check_cache_{scenario.name}")
+    analysis_cache.configure(directory=cache_dir)
+    debugger, target, process = launch_to_main(lldb, scenario, binary_path, work_dir)
+    try:
+        module = target.GetModuleAtIndex(0)
+        uncached = run_cached_analysis(scenario, module, target)
+        if uncached is None:
+            return {"scenario": scenario.name, "checked": False}
+        if not uncached:
+            raise RuntimeError(f"No sites are found in {binary_path} without a cache entry")
+        if not os.listdir(cache_dir):
+            raise RuntimeError("The analysis result is not stored in the cache")
+        cached = run_cached_analysis(scenario, module, target)
+        if cached != uncached:
+            raise RuntimeError(f"{len(cached)} sites are loaded from the cache, but {len(uncached)} are found by the analysis")
+    finally:
+        process.Kill()
+        lldb.SBDebugger.Destroy(debugger)
+    return {"scenario": scenario.name, "checked": True, "sites": len(uncached)}
+
+
+def run_scenario(scenario: Scenario, binary_path: str, work_dir: str) -> dict:
+    lldb = import_lldb()
+    analysis_cache.configure(directory=os.path.join(work_dir, f"cache_{scenario.name}"))
+
+    debugger, target, process = launch_to_main(lldb, scenario, binary_path, work_dir)
+    interpreter = debugger.GetCommandInterpreter()
+    module = target.GetModuleAtIndex(0)
+
+    start = time.perf_counter()
+    num_sites = discover_sites(scenario, module, target)
+    discovery_seconds = time.perf_counter() - start
+
+    latencies: List[int] = []
+    instrument_callbacks(sys.modules[scenario.script], scenario.callbacks, latencies)
+    result = lldb.SBCommandReturnObject()
+    start = time.perf_counter()
+    # the analysis is cached now, so this is dominated by arming the breakpoints
+    interpreter.HandleCommand(scenario.command, result)
+    arming_seconds = time.perf_counter() - start
+    if not result.Succeeded():
+        raise RuntimeError(f"{scenario.command} failed: {result.GetError()}")
+
+    start = time.perf_counter()
+    process.Continue()
+    while process.GetState() == lldb.eStateStopped:
+        process.Continue()
+    run_seconds = time.perf_counter() - start
+    breakpoint_hits = sum(bp.GetHitCount() for bp in target.breakpoint_iter())
+    exit_status = process.GetExitStatus()
+    lldb.SBDebugger.Destroy(debugger)
+
+    return {
+        "scenario": scenario.name,
+        "command": scenario.command,
+        "sites": num_sites,
+        "discovery_seconds": discovery_seconds,
+        "arming_seconds": arming_seconds,
+        "run_seconds": run_seconds,
+        "breakpoint_hits": breakpoint_hits,
+        "stops_per_second": breakpoint_hits / run_seconds if run_seconds > 0 else None,
+        "callback_latency": summarize_latencies(latencies),
+        "peak_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "exit_status": exit_status,
+    }
+
+
+def build_program(program: Program, scale: int, work_dir: str) -> str:
+    source_path = os.path.join(work_dir, f"{program.name}.c")
+    binary_path = os.path.join(work_dir, program.name)
+    with open(source_path, "w") as fout:
+        fout.write(program.generate(scale))
+    subprocess.check_call(["cc", "-O1", "-g0", "-fno-pie", "-no-pie", "-fno-inline", "-o", binary_path, source_path])
+    return binary_path
+
+
+def compare_results(old_path: str, results: List[dict]):
+    with open(old_path, "r") as fin:
+        old_results = {result["scenario"]: result for result in json.load(fin)["results"]}
+    metrics = ["discovery_seconds", "arming_seconds", "run_seconds", "stops_per_second", "peak_rss_kib"]
+    for result in results:
+        if (old_result := old_results.get(result["scenario"])) is None:
+            continue
+        print(f"{result['scenario']}:")
+        for metric in metrics:
+            old_value, new_value = old_result.get(metric), result.get(metric)
+            if old_value and new_value:
+                print(f"    {metric}: {old_value:.4g} -> {new_value:.4g} ({new_value / old_value:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", type=int, default=2000, help="Number of functions (call sites) of each synthetic program")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="Scenarios to run (can be repeated). Default: all")
+    parser.add_argument("--output", default="bench_tracing_results.json", help="Output JSON file")
+    parser.add_argument("--compare", default=None, help="Results of an earlier run to compare with")
+    parser.add_argument("--check", action="store_true", help="Check the cached analyses instead of measuring")
+    parser.add_argument("--run-scenario", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--binary", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--work-dir", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scenario:
+        run = check_scenario if args.check else run_scenario
+        print(json.dumps(run(SCENARIOS[args.run_scenario], args.binary, args.work_dir)))
+        return
+
+    if shutil.which("cc") is None:
+        sys.exit("A C compiler (cc) is required")
+    try:
+        import_lldb()
+    except (ImportError, OSError, subprocess.CalledProcessError):
+        sys.exit("The LLDB Python module is not found (tried \"lldb -P\")")
+    scenario_names = args.scenario or list(SCENARIOS)
+    results = []
+    num_failures = 0
+    with tempfile.TemporaryDirectory() as work_dir:
+        binaries = {}
+        for name in scenario_names:
+            scenario = SCENARIOS[name]
+            if scenario.program not in binaries:
+                binaries[scenario.program] = build_program(PROGRAMS[scenario.program], args.scale, work_dir)
+            print(f"{'Checking' if args.check else 'Running'} {name} ({scenario.command}) ...", flush=True)
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), *(["--check"] if args.check else []),
+                                     "--run-scenario", name, "--binary", binaries[scenario.program], "--work-dir", work_dir],
+                                    stdout=subprocess.PIPE, text=True)
+            if output.returncode != 0:
+                print(f"{name} failed (exit status {output.returncode})", file=sys.stderr)
+                num_failures += 1
+                continue
+            result = json.loads(output.stdout.strip().splitlines()[-1])
+            results.append(result)
+            if args.check:
+                print(f"    {result['sites']} sites are found with and without the cache" if result["checked"] else "    no cached analysis")
+            else:
+                print(f"    sites={result['sites']} discovery={result['discovery_seconds']:.2f}s arming={result['arming_seconds']:.2f}s "
+                      f"hits={result['breakpoint_hits']} stops/s={result['stops_per_second'] or 0:.0f} peak_rss={result['peak_rss_kib']}KiB")
+
+    if args.check:
+        sys.exit(1 if num_failures else 0)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": platform.machine(),
+        "python": platform.python_version(),
+        "scale": args.scale,
+        "results": results,
+    }
+    with open(args.output, "w") as fout:
+        json.dump(report, fout, indent=2)
+    print(f"Saved to {args.output}")
+    if args.compare:
+        compare_results(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+'''
+Persistent cache of analysis results shared by the commands. Entries are keyed
+by the SHA-256 of the analysed file and store image-relative offsets, so they
+stay valid across ASLR slides and for every copy of the same binary. A universal
+(fat) Mach-O has one SHA-256 for all of its slices, so analyses of a slice use
+a kind which includes the architecture (see get_kind()).
+
+The cache directory and its size limit can be changed with the
+LLDB_ANALYSIS_CACHE_DIR and LLDB_ANALYSIS_CACHE_MAX_SIZE (bytes) environment
+variables, or with configure(). The least recently used entries are evicted
+when the total size of the cache exceeds the limit.
+'''
+
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+from typing import Any, Dict, Optional, Tuple
+
+
+CACHE_DIR_ENV = "LLDB_ANALYSIS_CACHE_DIR"
+MAX_SIZE_ENV = "LLDB_ANALYSIS_CACHE_MAX_SIZE"
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), "lldb_analysis_cache")
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+ENTRY_SUFFIX = ".json"
+
+cache_dir: Optional[str] = None
+max_size: Optional[int] = None
+file_hashes: Dict[Tuple[str, int, int], str] = {}
+
+
+def configure(directory: Optional[str] = None, size: Optional[int] = None):
+    global cache_dir, max_size
+    if directory is not None:
+        cache_dir = directory
+    if size is not None:
+        max_size = size
+
+
+def get_cache_dir() -> str:
+    return cache_dir or os.environ.get(CACHE_DIR_ENV) or DEFAULT_CACHE_DIR
+
+
+def get_max_size() -> int:
+    if max_size is not None:
+        return max_size
+    return int(os.environ.get(MAX_SIZE_ENV, DEFAULT_MAX_SIZE))
+
+
+def hash_file(path: str) -> Optional[str]:
+    '''
+    Returns the SHA-256 of a file, or None if it does not exist. The file is
+    mapped instead of read, and the hash is computed once per (path, size, mtime).
+    '''
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    key = (os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+    if key in file_hashes:
+        return file_hashes[key]
+
+    sha256_hash = hashlib.sha256()
+    if stat.st_size > 0:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            sha256_hash.update(data)
+    file_hashes[key] = sha256_hash.hexdigest()
+    return file_hashes[key]
+
+
+def get_kind(kind: str, target) -> str:
+    '''
+    Returns the kind for the slice of the target's architecture (e.g., "type_names_arm64")
+    '''
+    return f"{kind}_{target.GetTriple().split('-')[0]}"
+
+
+def get_entry_path(kind: str, file_hash: str) -> str:
+    return os.path.join(get_cache_dir(), f"{kind}_{file_hash}{ENTRY_SUFFIX}")
+
+
+def load(kind: str, file_hash: Optional[str]) -> Optional[Any]:
+    if file_hash is None:
+        return None
+    entry_path = get_entry_path(kind, file_hash)
+    try:
+        with open(entry_path, "r") as fin:
+            value = json.load(fin)
+    except (OSError, ValueError):
+        return None
+    try:
+        # the modification time is the last use of the entry
+        os.utime(entry_path)
+    except OSError:
+        pass
+    return value
+
+
+def store(kind: str, file_hash: Optional[str], value: Any):
+    '''
+    Writes an entry atomically, so concurrent sessions never see a partial one
+    '''
+    if file_hash is None:
+        return
+    directory = get_cache_dir()
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp_")
+    try:
+        with os.fdopen(fd, "w") as fout:
+            json.dump(value, fout, separators=(",", ":"))
+        os.replace(temp_path, get_entry_path(kind, file_hash))
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    evict()
+
+
+def evict():
+    directory = get_cache_dir()
+    entries = []
+    total_size = 0
+    with os.scandir(directory) as it:
+        for entry in it:
+            if not entry.name.endswith(ENTRY_SUFFIX) or not entry.is_file():
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+            total_size += stat.st_size
+
+    limit = get_max_size()
+    for _, size, path in sorted(entries):
+        if total_size <= limit:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total_size -= size
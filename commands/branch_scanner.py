@@ -0,0 +1,628 @@
+'''
+In-process scanner for indirect branch instructions.
+
+This module does not depend on lldb, so it can also be used from offline tools
+(e.g., benchmarks) against the section data of a file on disk.
+'''
+
+import multiprocessing
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+
+@dataclass(frozen=True)
+class BranchSite:
+    address: int
+    size: int
+    kind: str  # "call" or "jmp"
+
+
+@dataclass(frozen=True)
+class DirectBranch:
+    address: int
+    size: int
+    kind: str  # "call" or "jmp"
+    destination: int
+
+
+@dataclass(frozen=True)
+class BranchOperand:
+    '''
+    Operand of an indirect branch. register is set for "call rax"-style operands,
+    otherwise the operand is [segment:base+index*scale+displacement].
+    base is "rip" for RIP-relative operands.
+    '''
+    register: Optional[str] = None
+    base: Optional[str] = None
+    index: Optional[str] = None
+    scale: int = 1
+    displacement: int = 0
+    segment: Optional[str] = None
+    address_size: int = 64
+
+    @property
+    def is_memory(self) -> bool:
+        return self.register is None
+
+
+@dataclass
+class TextSection:
+    arch: str
+    image_base: int
+    address: int
+    data: bytes
+
+
+class Decoder:
+    '''
+    Base class of per-architecture decoders. Subclasses are registered with
+    @register_decoder and looked up by the architecture part of the target triple.
+    '''
+
+    def iter_indirect_branches(self, data: bytes, base: int) -> Iterator[BranchSite]:
+        raise NotImplementedError
+
+    def iter_direct_branches(self, data: bytes, base: int) -> Iterator[DirectBranch]:
+        '''
+        Finds PC-relative calls and jumps (which include tail calls)
+        '''
+        raise NotImplementedError
+
+
+DECODERS: Dict[str, Callable[[], Decoder]] = {}
+
+
+def register_decoder(*archs: str):
+    def wrapper(cls):
+        for arch in archs:
+            DECODERS[arch] = cls
+        return cls
+    return wrapper
+
+
+def get_decoder(arch: str) -> Optional[Decoder]:
+    decoder_class = DECODERS.get(arch)
+    if decoder_class is None:
+        return None
+    return decoder_class()
+
+
+def iter_indirect_branches(arch: str, data: bytes, base: int) -> Iterator[BranchSite]:
+    decoder = get_decoder(arch)
+    if decoder is None:
+        raise ValueError(f"Unsupported architecture: {arch}")
+    return decoder.iter_indirect_branches(data, base)
+
+
+def scan_addresses(arch: str, data: bytes, base: int) -> List[int]:
+    return [site.address for site in iter_indirect_branches(arch, data, base)]
+
+
+def get_python_executable() -> str:
+    '''
+    sys.executable can be the debugger itself when running inside LLDB, so it
+    cannot always be used to spawn worker processes
+    '''
+    if os.path.basename(sys.executable or "").startswith("python"):
+        return sys.executable
+    candidate = os.path.join(sys.exec_prefix, "bin", f"python{sys.version_info.major}.{sys.version_info.minor}")
+    if os.path.exists(candidate):
+        return candidate
+    return shutil.which("python3") or sys.executable
+
+
+def scan_in_parallel(arch: str, sections: List[Tuple[bytes, int]], max_workers: Optional[int] = None) -> List[List[int]]:
+    '''
+    Scans (data, base) pairs concurrently in a process pool, one section per task.
+    Results are returned in the order of sections.
+    '''
+    if len(sections) <= 1:
+        return [scan_addresses(arch, data, base) for data, base in sections]
+
+    context = multiprocessing.get_context("spawn")
+    context.set_executable(get_python_executable())
+    max_workers = max_workers or min(len(sections), os.cpu_count() or 1)
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as executor:
+            # submit the largest sections first to balance the load
+            order = sorted(range(len(sections)), key=lambda i: len(sections[i][0]), reverse=True)
+            futures = {i: executor.submit(scan_addresses, arch, *sections[i]) for i in order}
+            return [futures[i].result() for i in range(len(sections))]
+    except (OSError, RuntimeError) as e:
+        print(f"Parallel scan failed ({e}). Scanning sections serially", file=sys.stderr)
+        return [scan_addresses(arch, data, base) for data, base in sections]
+
+
+# x86_64 opcode attributes
+_MODRM = 0x001
+_IMM8 = 0x002
+_IMMZ = 0x004   # imm16 with an operand size prefix, imm32 otherwise
+_IMM16 = 0x008
+_IMMV = 0x010   # imm64 with REX.W (mov r64, imm64)
+_MOFFS = 0x020
+_GROUP3 = 0x040  # F6/F7: immediate only for /0 and /1
+_REL32 = 0x080
+_VEX = 0x100
+_EVEX = 0x200
+_XOP = 0x400
+
+_GPR_NAMES = ("rax", "rcx", "rdx", "rbx", "rsp", "rbp", "rsi", "rdi",
+              "r8", "r9", "r10", "r11", "r12", "r13", "r14", "r15")
+_SEGMENT_PREFIXES = {0x64: "fs", 0x65: "gs"}
+_LEGACY_PREFIXES = frozenset([0x26, 0x2e, 0x36, 0x3e, 0x64, 0x65, 0x66, 0x67, 0xf0, 0xf2, 0xf3])
+# Opcodes in the 0F map which take an imm8 (also used for VEX/EVEX map 1)
+_MAP1_IMM8_OPCODES = frozenset([0x0f, 0x70, 0x71, 0x72, 0x73, 0xa4, 0xac, 0xba, 0xc2, 0xc4, 0xc5, 0xc6])
+
+
+def _build_one_byte_table() -> List[int]:
+    table = [0] * 256
+    for base in range(0x00, 0x40, 0x08):
+        for op in range(base, base + 4):
+            table[op] = _MODRM
+        table[base + 4] = _IMM8
+        table[base + 5] = _IMMZ
+    table[0x62] = _EVEX
+    table[0x63] = _MODRM
+    table[0x68] = _IMMZ
+    table[0x69] = _MODRM | _IMMZ
+    table[0x6a] = _IMM8
+    table[0x6b] = _MODRM | _IMM8
+    for op in range(0x70, 0x80):
+        table[op] = _IMM8
+    table[0x80] = _MODRM | _IMM8
+    table[0x81] = _MODRM | _IMMZ
+    table[0x83] = _MODRM | _IMM8
+    for op in range(0x84, 0x8f):
+        table[op] = _MODRM
+    table[0x8f] = _MODRM | _XOP
+    for op in range(0xa0, 0xa4):
+        table[op] = _MOFFS
+    table[0xa8] = _IMM8
+    table[0xa9] = _IMMZ
+    for op in range(0xb0, 0xb8):
+        table[op] = _IMM8
+    for op in range(0xb8, 0xc0):
+        table[op] = _IMMV
+    table[0xc0] = _MODRM | _IMM8
+    table[0xc1] = _MODRM | _IMM8
+    table[0xc2] = _IMM16
+    table[0xc4] = _VEX
+    table[0xc5] = _VEX
+    table[0xc6] = _MODRM | _IMM8
+    table[0xc7] = _MODRM | _IMMZ
+    table[0xc8] = _IMM16 | _IMM8
+    table[0xca] = _IMM16
+    table[0xcd] = _IMM8
+    for op in range(0xd0, 0xd4):
+        table[op] = _MODRM
+    for op in range(0xd8, 0xe0):
+        table[op] = _MODRM
+    for op in range(0xe0, 0xe8):
+        table[op] = _IMM8
+    table[0xe8] = _REL32
+    table[0xe9] = _REL32
+    table[0xeb] = _IMM8
+    table[0xf6] = _MODRM | _GROUP3
+    table[0xf7] = _MODRM | _GROUP3
+    table[0xfe] = _MODRM
+    table[0xff] = _MODRM
+    return table
+
+
+def _build_two_byte_table() -> List[int]:
+    table = [_MODRM] * 256
+    for op in (0x04, 0x05, 0x06, 0x07, 0x08, 0x09, 0x0a, 0x0b, 0x0c, 0x0e, 0x77, 0xa0, 0xa1, 0xa2, 0xa8, 0xa9, 0xaa):
+        table[op] = 0
+    for op in range(0x30, 0x38):
+        table[op] = 0
+    for op in range(0xc8, 0xd0):
+        table[op] = 0
+    for op in range(0x80, 0x90):
+        table[op] = _REL32
+    for op in _MAP1_IMM8_OPCODES:
+        table[op] = _MODRM | _IMM8
+    return table
+
+
+_ONE_BYTE_TABLE = _build_one_byte_table()
+_TWO_BYTE_TABLE = _build_two_byte_table()
+
+
+def _modrm_length(data: bytes, pos: int) -> int:
+    '''
+    Returns the number of bytes of ModRM, SIB and displacement starting at pos
+    '''
+    modrm = data[pos]
+    mod = modrm >> 6
+    if mod == 3:
+        return 1
+    rm = modrm & 7
+    length = 1
+    if rm == 4:
+        length += 1
+        if mod == 0 and (data[pos + 1] & 7) == 5:
+            length += 4
+    elif mod == 0 and rm == 5:
+        length += 4
+    if mod == 1:
+        length += 1
+    elif mod == 2:
+        length += 4
+    return length
+
+
+@register_decoder("x86_64", "x86_64h")
+class X86_64Decoder(Decoder):
+    '''
+    Linear-sweep decoder. Only instruction lengths are decoded, except for the
+    FF /2../5 group which encodes indirect call/jmp.
+    '''
+
+    def iter_indirect_branches(self, data: bytes, base: int) -> Iterator[BranchSite]:
+        end = len(data)
+        pos = 0
+        while pos < end:
+            try:
+                length, is_branch, kind = self.decode(data, pos)
+            except IndexError:
+                # truncated instruction at the end of the section
+                return
+            if is_branch:
+                yield BranchSite(address=base + pos, size=length, kind=kind)
+            pos += length
+
+    def iter_direct_branches(self, data: bytes, base: int) -> Iterator[DirectBranch]:
+        end = len(data)
+        pos = 0
+        while pos < end:
+            try:
+                length, _, _ = self.decode(data, pos)
+            except IndexError:
+                return
+            # call rel32 / jmp rel32
+            if length >= 5 and data[pos + length - 5] in (0xe8, 0xe9):
+                opcode_pos = pos
+                while data[opcode_pos] in _LEGACY_PREFIXES or 0x40 <= data[opcode_pos] <= 0x4f:
+                    opcode_pos += 1
+                if opcode_pos == pos + length - 5:
+                    (displacement,) = struct.unpack_from("<i", data, opcode_pos + 1)
+                    yield DirectBranch(address=base + pos, size=length,
+                                       kind="call" if data[opcode_pos] == 0xe8 else "jmp",
+                                       destination=base + pos + length + displacement)
+            pos += length
+
+    def decode(self, data: bytes, start: int):
+        '''
+        Returns (length, is_indirect_branch, kind) of the instruction at start.
+        Invalid encodings are skipped one byte at a time.
+        '''
+        pos = start
+        operand_size_prefix = False
+        address_size_prefix = False
+        rex_w = False
+        while True:
+            b = data[pos]
+            if b in _LEGACY_PREFIXES:
+                operand_size_prefix |= b == 0x66
+                address_size_prefix |= b == 0x67
+                rex_w = False
+                pos += 1
+            elif 0x40 <= b <= 0x4f:
+                rex_w = bool(b & 0x08)
+                pos += 1
+            else:
+                break
+            if pos - start >= 14:
+                return 1, False, None
+
+        op = data[pos]
+        pos += 1
+        one_byte_map = op != 0x0f
+        if not one_byte_map:
+            op = data[pos]
+            pos += 1
+            if op == 0x38:
+                pos += 1
+                pos += _modrm_length(data, pos)
+                return pos - start, False, None
+            if op == 0x3a:
+                pos += 1
+                pos += _modrm_length(data, pos) + 1
+                return pos - start, False, None
+            attrs = _TWO_BYTE_TABLE[op]
+        else:
+            attrs = _ONE_BYTE_TABLE[op]
+            if attrs & (_VEX | _EVEX):
+                return self.decode_vex(data, start, pos, op)
+            if attrs & _XOP and (data[pos] >> 3) & 7 != 0:
+                return self.decode_xop(data, start, pos)
+
+        is_branch = False
+        kind = None
+        if attrs & _MODRM:
+            modrm = data[pos]
+            reg = (modrm >> 3) & 7
+            if one_byte_map and op == 0xff and 2 <= reg <= 5:
+                is_branch = True
+                kind = "call" if reg <= 3 else "jmp"
+            if attrs & _GROUP3 and reg <= 1:
+                attrs |= _IMM8 if op == 0xf6 else _IMMZ
+            pos += _modrm_length(data, pos)
+        if attrs & _IMM8:
+            pos += 1
+        if attrs & _IMM16:
+            pos += 2
+        if attrs & _IMMZ:
+            pos += 2 if operand_size_prefix and not rex_w else 4
+        if attrs & _REL32:
+            pos += 4
+        if attrs & _IMMV:
+            pos += 8 if rex_w else (2 if operand_size_prefix else 4)
+        if attrs & _MOFFS:
+            pos += 4 if address_size_prefix else 8
+        if pos > len(data):
+            raise IndexError(pos)
+        return pos - start, is_branch, kind
+
+    def decode_operand(self, data: bytes) -> Optional[BranchOperand]:
+        '''
+        Decodes the operand of the near indirect call/jmp at the start of data.
+        Returns None for other instructions (including far call/jmp).
+        '''
+        pos = 0
+        rex = 0
+        segment = None
+        address_size = 64
+        try:
+            while data[pos] in _LEGACY_PREFIXES or 0x40 <= data[pos] <= 0x4f:
+                b = data[pos]
+                if 0x40 <= b <= 0x4f:
+                    rex = b
+                else:
+                    rex = 0
+                    if b in _SEGMENT_PREFIXES:
+                        segment = _SEGMENT_PREFIXES[b]
+                    elif b == 0x67:
+                        address_size = 32
+                pos += 1
+            if data[pos] != 0xff:
+                return None
+            modrm = data[pos + 1]
+            pos += 2
+            if (modrm >> 3) & 7 not in (2, 4):
+                return None
+
+            mod = modrm >> 6
+            rm = modrm & 7
+            rex_b = (rex & 0x1) << 3
+            if mod == 3:
+                return BranchOperand(register=_GPR_NAMES[rm | rex_b])
+
+            base = None
+            index = None
+            scale = 1
+            if rm == 4:
+                sib = data[pos]
+                pos += 1
+                scale = 1 << (sib >> 6)
+                index_number = ((sib >> 3) & 7) | ((rex & 0x2) << 2)
+                if index_number != 4:
+                    index = _GPR_NAMES[index_number]
+                if mod == 0 and (sib & 7) == 5:
+                    mod = 2  # disp32 without base
+                else:
+                    base = _GPR_NAMES[(sib & 7) | rex_b]
+            elif mod == 0 and rm == 5:
+                base = "rip"
+                mod = 2
+            else:
+                base = _GPR_NAMES[rm | rex_b]
+
+            displacement = 0
+            if mod == 1:
+                (displacement,) = struct.unpack_from("<b", data, pos)
+            elif mod == 2:
+                (displacement,) = struct.unpack_from("<i", data, pos)
+        except (IndexError, struct.error):
+            return None
+        return BranchOperand(base=base, index=index, scale=scale, displacement=displacement,
+                             segment=segment, address_size=address_size)
+
+    def decode_vex(self, data: bytes, start: int, pos: int, escape: int):
+        if escape == 0xc5:
+            opcode_map = 1
+            pos += 1
+        elif escape == 0xc4:
+            opcode_map = data[pos] & 0x1f
+            pos += 2
+        else:
+            opcode_map = data[pos] & 0x07
+            pos += 3
+        op = data[pos]
+        pos += 1
+        if opcode_map == 1 and op == 0x77:
+            # vzeroupper/vzeroall
+            return pos - start, False, None
+        pos += _modrm_length(data, pos)
+        if opcode_map == 3 or (opcode_map == 1 and op in _MAP1_IMM8_OPCODES):
+            pos += 1
+        if pos > len(data):
+            raise IndexError(pos)
+        return pos - start, False, None
+
+    def decode_xop(self, data: bytes, start: int, pos: int):
+        opcode_map = data[pos] & 0x1f
+        pos += 3
+        pos += _modrm_length(data, pos)
+        if opcode_map == 0x08:
+            pos += 1
+        elif opcode_map == 0x0a:
+            pos += 4
+        if pos > len(data):
+            raise IndexError(pos)
+        return pos - start, False, None
+
+
+@register_decoder("arm64", "arm64e", "aarch64")
+class Arm64Decoder(Decoder):
+    '''
+    Matches br/blr and their pointer-authenticated variants (braa, blraaz, ...)
+    '''
+    PATTERNS = (
+        (0xfffffc1f, 0xd61f0000, "jmp"),   # br
+        (0xfffffc1f, 0xd63f0000, "call"),  # blr
+        (0xfffff81f, 0xd61f081f, "jmp"),   # braaz, brabz
+        (0xfffff81f, 0xd63f081f, "call"),  # blraaz, blrabz
+        (0xfffff800, 0xd71f0800, "jmp"),   # braa, brab
+        (0xfffff800, 0xd73f0800, "call"),  # blraa, blrab
+    )
+
+    def iter_indirect_branches(self, data: bytes, base: int) -> Iterator[BranchSite]:
+        aligned_size = len(data) & ~3
+        for i, (insn,) in enumerate(struct.iter_unpack("<I", data[:aligned_size])):
+            # every br/blr variant has 0b1101011 in bits 25..31
+            if (insn >> 25) != 0x6b:
+                continue
+            for mask, value, kind in self.PATTERNS:
+                if insn & mask == value:
+                    yield BranchSite(address=base + i * 4, size=4, kind=kind)
+                    break
+
+    def iter_direct_branches(self, data: bytes, base: int) -> Iterator[DirectBranch]:
+        aligned_size = len(data) & ~3
+        for i, (insn,) in enumerate(struct.iter_unpack("<I", data[:aligned_size])):
+            # bl imm26 / b imm26
+            if insn & 0x7c000000 != 0x14000000:
+                continue
+            displacement = (insn & 0x03ffffff) << 2
+            if displacement & 0x08000000:
+                displacement -= 0x10000000
+            address = base + i * 4
+            yield DirectBranch(address=address, size=4, kind="call" if insn & 0x80000000 else "jmp",
+                               destination=address + displacement)
+
+
+ELF_MACHINES = {
+    62: "x86_64",
+    183: "aarch64",
+}
+
+MACHO_CPU_TYPES = {
+    0x01000007: "x86_64",
+    0x0100000c: "arm64",
+}
+
+
+def load_text_section(path: str, arch: Optional[str] = None) -> TextSection:
+    '''
+    Reads the text section of an ELF64 or (fat) Mach-O 64 file on disk
+    '''
+    with open(path, "rb") as fin:
+        data = fin.read()
+    magic = data[:4]
+    if magic == b"\x7fELF":
+        return _load_elf_text_section(data)
+    if magic == b"\xca\xfe\xba\xbe":
+        return _load_fat_macho_text_section(data, arch)
+    if magic == b"\xcf\xfa\xed\xfe":
+        return _load_macho_text_section(data, 0)
+    raise ValueError(f"Unsupported file format: {path}")
+
+
+def _load_elf_text_section(data: bytes) -> TextSection:
+    if data[4] != 2 or data[5] != 1:
+        raise ValueError("Only little-endian ELF64 is supported")
+    (e_machine,) = struct.unpack_from("<H", data, 18)
+    e_phoff, e_shoff = struct.unpack_from("<QQ", data, 32)
+    e_phentsize, e_phnum, e_shentsize, e_shnum, e_shstrndx = struct.unpack_from("<HHHHH", data, 54)
+
+    image_base = None
+    for i in range(e_phnum):
+        p_type, _, _, p_vaddr = struct.unpack_from("<IIQQ", data, e_phoff + i * e_phentsize)
+        if p_type == 1 and (image_base is None or p_vaddr < image_base):  # PT_LOAD
+            image_base = p_vaddr
+
+    def section_header(index):
+        return struct.unpack_from("<IIQQQQ", data, e_shoff + index * e_shentsize)
+    _, _, _, _, strtab_offset, _ = section_header(e_shstrndx)
+    for i in range(e_shnum):
+        sh_name, _, _, sh_addr, sh_offset, sh_size = section_header(i)
+        name_end = data.index(b"\0", strtab_offset + sh_name)
+        if data[strtab_offset + sh_name:name_end] == b".text":
+            return TextSection(arch=ELF_MACHINES.get(e_machine, str(e_machine)),
+                               image_base=image_base or 0,
+                               address=sh_addr,
+                               data=data[sh_offset:sh_offset + sh_size])
+    raise ValueError(".text section is not found")
+
+
+def _load_fat_macho_text_section(data: bytes, arch: Optional[str]) -> TextSection:
+    (nfat_arch,) = struct.unpack_from(">I", data, 4)
+    for i in range(nfat_arch):
+        cputype, _, offset, size, _ = struct.unpack_from(">iiIII", data, 8 + i * 20)
+        if arch is None or MACHO_CPU_TYPES.get(cputype & 0xffffffff) == arch:
+            return _load_macho_text_section(data[offset:offset + size], 0)
+    raise ValueError(f"Slice for {arch} is not found")
+
+
+def _load_macho_text_section(data: bytes, offset: int) -> TextSection:
+    cputype, _, _, ncmds, _, _ = struct.unpack_from("<IiIIII", data, offset + 4)
+    pos = offset + 32
+    image_base = 0
+    for _ in range(ncmds):
+        cmd, cmdsize = struct.unpack_from("<II", data, pos)
+        if cmd == 0x19:  # LC_SEGMENT_64
+            segname = data[pos + 8:pos + 24].rstrip(b"\0")
+            (vmaddr,) = struct.unpack_from("<Q", data, pos + 24)
+            (nsects,) = struct.unpack_from("<I", data, pos + 64)
+            if segname == b"__TEXT":
+                image_base = vmaddr
+                for i in range(nsects):
+                    sect = pos + 72 + i * 80
+                    sectname = data[sect:sect + 16].rstrip(b"\0")
+                    addr, size, file_offset = struct.unpack_from("<QQI", data, sect + 32)
+                    if sectname == b"__text":
+                        return TextSection(arch=MACHO_CPU_TYPES.get(cputype, str(cputype)),
+                                           image_base=image_base,
+                                           address=addr,
+                                           data=data[offset + file_offset:offset + file_offset + size])
+        pos += cmdsize
+    raise ValueError("__TEXT.__text section is not found")
+
+
+def scan_file(path: str, arch: Optional[str] = None) -> Iterator[BranchSite]:
+    section = load_text_section(path, arch)
+    return iter_indirect_branches(section.arch, section.data, section.address)
+
+
+def disassemble_with_r2(target_path: str, image_base: int, disas_file_name: str, r2_script_path: str, target_section_names: List[str]):
+    with open(r2_script_path, "w") as fout:
+        fout.write("e asm.lines = false\n")
+        fout.write("aaaa\n")
+        fout.write(f"pD 0 > {disas_file_name}\n")
+        for target_section_name in target_section_names:
+            fout.write(f"s $(iS~{target_section_name}~[3])\n")
+            fout.write(f"pD $SS >> {disas_file_name}\n")
+    os.system(f"r2 -e bin.relocs.apply=true -i {r2_script_path} -B {hex(image_base)} -q {target_path}")
+
+
+def scan_with_r2(target_path: str, image_base: int, target_section_names: Optional[List[str]] = None) -> List[int]:
+    '''
+    Legacy radare2 + grep + awk pipeline. This takes a lot of time for large binaries.
+    '''
+    if shutil.which("r2") is None:
+        raise FileNotFoundError("r2 is not installed")
+    with tempfile.TemporaryDirectory() as work_dir:
+        disas_file_name = os.path.join(work_dir, "disas.asm")
+        disassemble_with_r2(target_path, image_base, disas_file_name, os.path.join(work_dir, "disas.r2"),
+                            target_section_names or ["__TEXT.__text"])
+        grep_process = subprocess.Popen(["grep", "-E", "(call|jmp)\\s*\\w*\\s+(\\[|r[a|b|c|d]x|r[s|d]i|r[b|s]p|r\\d|e[a|b|c|d]x|e[s|d]i|e[b|s]p)", disas_file_name], stdout=subprocess.PIPE)
+        awk_process = subprocess.Popen(["awk", "{print $1}"], stdin=grep_process.stdout, stdout=subprocess.PIPE, text=True)
+        return [int(line.strip(), 16) for line in awk_process.communicate()[0].splitlines()]
@@ -1,51 +1,200 @@
 import lldb
-import hashlib
 import os
 import shlex
 import optparse
 import json
-import subprocess
-from dataclasses import dataclass, asdict
-from typing import Dict, List
+import sys
+import threading
+import time
+from array import array
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import analysis_cache
+import branch_scanner
+import memory_cache
+import trace_format
+import trace_merge
+import trace_stats
+from module_utils import get_image_base, get_module_path, is_loaded, module_matches, parse_module_patterns, read_text_section
+from symbol_index import SymbolIndex
+from trace_format import PackedRegisters, to_json_value
+from trace_session import CONTINUE, STEP, TraceSession
+from trace_writer import TraceWriter
 
 
 FILE_NAME = os.path.basename(__file__)[:-3]
+MAX_INSTRUCTION_LENGTH = 15
 branch_data = []
+x86_64_decoder = branch_scanner.X86_64Decoder()
+
+
+@dataclass
+class DecodedBranch:
+    operand: branch_scanner.BranchOperand
+    size: int
+    kind: str
+
+
+decoded_branches: Dict[int, Optional[DecodedBranch]] = {}
+aggregator = None
+trace_writer: Optional[TraceWriter] = None
+traced_modules_generation = 0
+symbols: Optional[SymbolIndex] = None
+arming_options = None
+module_patterns: List[str] = []
+armed_modules = set()
+module_listener = None
+site_breakpoint_ids: List[int] = []
+resolver_sites: Dict[str, List[int]] = {}
+lazy_function_sites: Dict[int, Tuple[str, List[int]]] = {}
+entry_breakpoint_ids: Dict[int, int] = {}  # breakpoint ID -> function entry
+register_capture = None
+session: Optional[TraceSession] = None
+record_lock = threading.Lock()
+stats = trace_stats.TraceStats(memory_cache.counters)
+operand_register_captures: Dict[Tuple[str, ...], "RegisterCapture"] = {}
 
 
 def __lldb_init_module(debugger: lldb.SBDebugger, internal_dict: dict):
     debugger.HandleCommand(f'command script add -f {FILE_NAME}.set_bps brt_set_bps -h "Set breakpoints to record destination addresses of indirect branches"')
     debugger.HandleCommand(f'command script add -f {FILE_NAME}.save brt_save -h "Save trace data to /tmp/branches.json"')
+    debugger.HandleCommand(f'command script add -f {FILE_NAME}.disarm brt_disarm -h "Disable all branch site breakpoints"')
+    debugger.HandleCommand(f'command script add -f {FILE_NAME}.arm brt_arm -h "Re-enable all branch site breakpoints"')
+    debugger.HandleCommand(f'command script add -f {FILE_NAME}.export brt_export -h "Convert a binary or NDJSON branch trace to the JSON format"')
+    debugger.HandleCommand(f'command script add -f {FILE_NAME}.merge brt_merge -h "Merge branch traces into one edge index with hit counts"')
+    debugger.HandleCommand(f'command script add -f {FILE_NAME}.show_stats brt_stats -h "Show hit counts and callback latency of branch sites"')
+    debugger.HandleCommand(f'command script add -f {FILE_NAME}.run brt_run -h "Run the target under the asynchronous trace engine (brt_set_bps --async)"')
 
 
 def get_all_modules(debugger: lldb.SBDebugger) -> List[dict]:
-    target: lldb.SBTarget = debugger.GetSelectedTarget()
-    all_modules = []
-    for i in range(target.GetNumModules()):
-        module: lldb.SBModule = target.GetModuleAtIndex(i)
-        addr = hex(module.GetObjectFileHeaderAddress().GetLoadAddress(target))
-        name = module.GetFileSpec().GetFilename()
-        all_modules.append({"name": name, "addr": addr})
-    return all_modules
+    return get_symbol_index(debugger.GetSelectedTarget()).module_records()
+
+
+def get_symbol_index(target: lldb.SBTarget) -> SymbolIndex:
+    global symbols
+    if symbols is None or symbols.target != target:
+        if symbols is not None:
+            symbols.close()
+        symbols = SymbolIndex(target)
+    return symbols
 
 
 def save(debugger: lldb.SBDebugger, command: str, exe_ctx: lldb.SBExecutionContext, result: lldb.SBCommandReturnObject, internal_dict: dict):
     global branch_data
-    file_name = "/tmp/branches.json"
-    result = {
-        "modules": get_all_modules(debugger),
-        "branches": branch_data
-    }
-    with open(file_name, 'w') as f:
-        json.dump(result, f, indent=2)
+    command_args = shlex.split(command, posix=False)
+    parser = generate_save_option_parser()
+    try:
+        (options, args) = parser.parse_args(command_args)
+    except:
+        result.SetError(parser.usage)
+        return
+
+    if session is not None:
+        session.drain()
+    if trace_writer is not None:
+        with record_lock:
+            finalize_trace_stream(debugger)
+        return
+    with record_lock:
+        branches = branch_data if aggregator is None else aggregator.records()
+        branch_data = []
+        if aggregator is not None:
+            num_disabled_sites = aggregator.num_disabled_sites
+            aggregator.clear()
+    if options.binary:
+        file_name = options.output or "/tmp/branches.brt"
+        encoder = trace_format.BinaryTraceEncoder(file_name)
+        encoder.write_records([{"type": "modules", "modules": get_all_modules(debugger)}])
+        encoder.write_records(branches)
+        encoder.close()
+    else:
+        file_name = options.output or "/tmp/branches.json"
+        result = {
+            "modules": get_all_modules(debugger),
+            "branches": branches
+        }
+        with open(file_name, 'w') as f:
+            json.dump(result, f, indent=2, default=to_json_value)
     print(f"Branch data saved to {file_name}")
-    branch_data = []
+    if aggregator is not None:
+        print(f"{len(branches)} unique edges, {num_disabled_sites} sites disabled")
     print("Saved data is cleared")
 
 
+def export(debugger: lldb.SBDebugger, command: str, exe_ctx: lldb.SBExecutionContext, result: lldb.SBCommandReturnObject, internal_dict: dict):
+    '''
+    Converts a trace saved by "brt_save --binary" or streamed by "brt_set_bps --stream"
+    into the JSON format which can be loaded by the Binja Missing Link plugin
+    '''
+    args = shlex.split(command)
+    if len(args) not in (1, 2):
+        result.SetError("usage: brt_export <input trace> [output json (default: /tmp/branches.json)]")
+        return
+    output_path = args[1] if len(args) == 2 else "/tmp/branches.json"
+    num_branches = trace_format.export_json(args[0], output_path)
+    print(f"{num_branches} branches are exported to {output_path}")
+
+
+def merge(debugger: lldb.SBDebugger, command: str, exe_ctx: lldb.SBExecutionContext, result: lldb.SBCommandReturnObject, internal_dict: dict):
+    '''
+    Merges traces of any format into one edge index rebased to (module, offset),
+    which can be loaded by the Binja Missing Link plugin
+    '''
+    args = shlex.split(command)
+    if len(args) < 2:
+        result.SetError("usage: brt_merge <output json> <input trace> [<input trace> ...]")
+        return
+    num_records, num_edges = trace_merge.merge_traces(args[1:], args[0])
+    print(f"{num_records} records from {len(args) - 1} traces are merged into {num_edges} edges in {args[0]}")
+
+
+def write_modules_record(debugger: lldb.SBDebugger):
+    global traced_modules_generation
+    modules = get_all_modules(debugger)
+    traced_modules_generation = symbols.generation
+    trace_writer.write({"type": "modules", "modules": modules})
+
+
+def start_trace_stream(debugger: lldb.SBDebugger, path: str, binary: bool):
+    global trace_writer
+    if trace_writer is not None:
+        trace_writer.close()
+    trace_writer = TraceWriter(path, binary)
+    write_modules_record(debugger)
+    print(f"Branch data is streamed to {path}")
+
+
+def finalize_trace_stream(debugger: lldb.SBDebugger):
+    '''
+    Writes the current module table (and edge counts in the aggregation mode),
+    then waits until queued records reach the disk
+    '''
+    write_modules_record(debugger)
+    if aggregator is not None:
+        for (site, destination), edge in aggregator.edges.items():
+            trace_writer.write({"type": "edge_count", "site": hex(site), "destination": hex(destination), "count": edge.count})
+    trace_writer.flush()
+    print(f"{trace_writer.num_records} records are written to {trace_writer.path}")
+
+
+def restart_trace(debugger: lldb.SBDebugger, path: str, binary: bool):
+    '''
+    Starts the trace of a new run of the target with the breakpoints which are
+    already armed, streaming it to path. Used by brt_batch after a relaunch.
+    '''
+    global branch_data
+    with record_lock:
+        branch_data = []
+        if aggregator is not None:
+            aggregator.rearm(debugger.GetSelectedTarget())
+            aggregator.clear()
+        start_trace_stream(debugger, path, binary)
+
+
 def set_bps(debugger: lldb.SBDebugger, command: str, exe_ctx: lldb.SBExecutionContext, result: lldb.SBCommandReturnObject, internal_dict: dict):
     '''
-    NOTE: x86_64 only, only main module is supported
+    NOTE: x86_64 only
     '''
 
     target: lldb.SBTarget = debugger.GetSelectedTarget()
@@ -58,125 +207,598 @@ def set_bps(debugger: lldb.SBDebugger, command: str, exe_ctx: lldb.SBExecutionCo
     parser = generate_option_parser()
     try:
         (options, args) = parser.parse_args(command_args)
+        options.shard = parse_shard(options.shard)
     except:
         result.SetError(parser.usage)
         return
 
-    main_module: lldb.SBModule = target.GetModuleAtIndex(0)
-    image_base = main_module.GetObjectFileHeaderAddress().GetLoadAddress(target)
-    branch_instruction_addresses = get_all_branch_instructions(debugger, image_base)
+    global aggregator, arming_options, module_patterns, register_capture, session
+    if session is not None:
+        session.close()
+    session = TraceSession(options.workers) if options.use_async else None
+    register_names = parse_register_profile(options.registers)
+    register_capture = None if register_names == [] else RegisterCapture(register_names)
+    stats.clear()
+    operand_register_captures.clear()
+    get_symbol_index(target)
+    if options.aggregate:
+        aggregator = BranchAggregator(options.stale_hits, options.time_budget)
+    else:
+        aggregator = None
 
-    for address in branch_instruction_addresses:
-        bp = target.BreakpointCreateByAddress(address)
-        bp.SetScriptCallbackFunction(f"{FILE_NAME}.break_on_indirect_branch")
-    
-    print(f"Breakpoints set in main module: {main_module.GetFileSpec().GetFilename()}")
-    print(f"Please continue program execution, then save branch data using the \"brt_save\" command")
+    if options.stream is not None:
+        start_trace_stream(debugger, options.stream, options.binary)
+
+    arming_options = options
+    module_patterns = parse_module_patterns(options.modules)
+    if not module_patterns:
+        module_patterns = [target.GetModuleAtIndex(0).GetFileSpec().GetFilename()]
+
+    loaded_modules = [module for module in target.module_iter() if module_matches(module, module_patterns) and is_loaded(target, module)]
+    arm_modules(target, loaded_modules)
+    start_module_listener(target)
+    print(f"Modules which match {', '.join(module_patterns)} will be armed when they are loaded")
+    print("Please continue program execution, then save branch data using the \"brt_save\" command")
 
 
 def generate_option_parser():
-    # TODO: implement module option (not implemented yet)
     usage = "usage: %prog [options]"
     parser = optparse.OptionParser(usage=usage, prog=FILE_NAME)
     parser.add_option("-m", "--module",
+                      action="append",
+                      default=[],
+                      dest="modules",
+                      help="Module names or glob patterns (comma separated, can be repeated) to set breakpoints. Default: main module")
+    parser.add_option("--r2",
+                      action="store_true",
+                      default=False,
+                      dest="use_r2",
+                      help="Use radare2 instead of the built-in scanner to find indirect branches (slow)")
+    parser.add_option("-f", "--fast",
+                      action="store_true",
+                      default=False,
+                      dest="fast",
+                      help="Compute branch destinations at the breakpoint instead of single-stepping")
+    parser.add_option("-a", "--aggregate",
+                      action="store_true",
+                      default=False,
+                      dest="aggregate",
+                      help="Record only unique (site, destination) edges with hit counts")
+    parser.add_option("--stale-hits",
+                      action="store",
+                      type="int",
+                      default=0,
+                      dest="stale_hits",
+                      help="With --aggregate, disable a site after this many hits without a new destination (0: never)")
+    parser.add_option("--time-budget",
+                      action="store",
+                      type="float",
+                      default=0.0,
+                      dest="time_budget",
+                      help="With --aggregate, disable a site this many seconds after its first hit (0: never)")
+    parser.add_option("-s", "--stream",
+                      action="store",
+                      default=None,
+                      dest="stream",
+                      help="Stream records to this NDJSON file while tracing. brt_save then only flushes it")
+    parser.add_option("-b", "--binary",
+                      action="store_true",
+                      default=False,
+                      dest="binary",
+                      help="With --stream, write the compact binary format instead of NDJSON")
+    parser.add_option("--arm",
+                      action="store",
+                      type="choice",
+                      choices=["bulk", "lazy", "each"],
+                      default="bulk",
+                      dest="arm",
+                      help="bulk: one breakpoint with a location per site for each module (default), "
+                           "lazy: arm the sites of a function when its entry is hit, "
+                           "each: one breakpoint per site")
+    parser.add_option("--async",
+                      action="store_true",
+                      default=False,
+                      dest="use_async",
+                      help="Handle breakpoint stops on a listener thread instead of synchronous callbacks. Run the target with brt_run")
+    parser.add_option("--workers",
+                      action="store",
+                      type="int",
+                      default=1,
+                      dest="workers",
+                      help="With --async, number of worker threads which symbolicate and record branches (default: 1)")
+    parser.add_option("-r", "--registers",
+                      action="store",
+                      default="all",
+                      dest="registers",
+                      help="Registers to record: all (all 64-bit general purpose registers, default), "
+                           "operand (the registers used by the branch operand), "
+                           "or a comma separated list (e.g., rdi,rsi). rip and rsp are always recorded")
+    parser.add_option("--shard",
                       action="store",
                       default=None,
-                      dest="module",
-                      help="Module name to set breakpoints")
+                      dest="shard",
+                      help="Arm only shard I of N of the branch sites of each module (I/N, e.g., 0/4). Used by brt_shard")
+    return parser
+
+
+def parse_shard(value: Optional[str]) -> Optional[Tuple[int, int]]:
+    '''
+    Parses "I/N" into (I, N)
+    '''
+    if value is None:
+        return None
+    index, count = (int(part) for part in value.split("/"))
+    if not 0 <= index < count:
+        raise ValueError(f"Invalid shard: {value}")
+    return index, count
+
+
+def generate_save_option_parser():
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage, prog="brt_save")
+    parser.add_option("-o", "--output",
+                      action="store",
+                      default=None,
+                      dest="output",
+                      help="Output file (default: /tmp/branches.json, or /tmp/branches.brt with --binary)")
+    parser.add_option("-b", "--binary",
+                      action="store_true",
+                      default=False,
+                      dest="binary",
+                      help="Save in the compact binary format. Use brt_export to convert it to JSON")
     return parser
     
 
-def get_target_executable(debugger):
-    file_spec = debugger.GetSelectedTarget().GetExecutable()
-    directory = file_spec.GetDirectory()
-    filename = file_spec.GetFilename()
-    full_path = os.path.join(directory, filename)
-    return full_path
-
-
-def disassemble(target_path, image_base, disas_file_name):
-    r2_script_path = "/tmp/disas.r2"
-    target_section_names = [
-        "__TEXT.__text",
-    ]
-    with open(r2_script_path, "w") as fout:
-        fout.write("e asm.lines = false\n")
-        fout.write("aaaa\n")
-        fout.write(f"pD 0 > {disas_file_name}\n")
-        for target_section_name in target_section_names:
-            fout.write(f"s $(iS~{target_section_name}~[3])\n")
-            fout.write(f"pD $SS >> {disas_file_name}\n")
-    os.system(f"r2 -e bin.relocs.apply=true -i {r2_script_path} -B {hex(image_base)} -q {target_path}")
-
-
-def get_all_branch_instructions(debugger, image_base):
-    target_executable = get_target_executable(debugger)
-    def calculate_sha256(file_path):
-        sha256_hash = hashlib.sha256()
-        with open(file_path, "rb") as f:
-            for byte_block in iter(lambda: f.read(4096), b""):
-                sha256_hash.update(byte_block)
-        sha256_hash.update(image_base.to_bytes(8, byteorder="little"))
-        return sha256_hash.hexdigest()
-    sha256_value = calculate_sha256(target_executable)
-
-    branch_address_cache = f"/tmp/branches_cache_{sha256_value}.json"
-    if os.path.exists(branch_address_cache):
-        print(f"Branch address cache ({branch_address_cache}) found. Skipping r2 analysis")
-        with open(branch_address_cache, "r") as fin:
-            return json.loads(fin.read())
+def get_all_branch_instructions(target: lldb.SBTarget, modules: List[lldb.SBModule], use_r2=False) -> Dict[str, List[int]]:
+    '''
+    Returns indirect branch addresses for each module path. Modules which are not
+    cached are analysed concurrently in a process pool.
+    '''
+    arch = target.GetTriple().split('-')[0]
+    cache_kind = analysis_cache.get_kind("branch_sites", target)
+    branch_addresses = {}
+    pending = []
+    for module in modules:
+        module_path = get_module_path(module)
+        image_base = get_image_base(target, module)
+        file_hash = analysis_cache.hash_file(module_path)
+        if (offsets := analysis_cache.load(cache_kind, file_hash)) is not None:
+            print(f"Branch address cache found. Skipping analysis of {module.GetFileSpec().GetFilename()}")
+            branch_addresses[module_path] = [image_base + offset for offset in offsets]
+        elif use_r2:
+            print(f"Branch address cache not found. Start r2 analysis of {module.GetFileSpec().GetFilename()}, but it takes a lot of time.")
+            branch_addresses[module_path] = branch_scanner.scan_with_r2(module_path, image_base)
+            analysis_cache.store(cache_kind, file_hash, [address - image_base for address in branch_addresses[module_path]])
+        else:
+            pending.append((module_path, image_base, file_hash, read_text_section(target, module)))
+
+    if pending:
+        start = time.perf_counter()
+        results = branch_scanner.scan_in_parallel(arch, [section for _, _, _, section in pending])
+        print(f"Analysed {len(pending)} modules in {time.perf_counter() - start:.2f} seconds")
+        for (module_path, image_base, file_hash, _), addresses in zip(pending, results):
+            branch_addresses[module_path] = addresses
+            analysis_cache.store(cache_kind, file_hash, [address - image_base for address in addresses])
+    return branch_addresses
+
+
+def arm_modules(target: lldb.SBTarget, modules: List[lldb.SBModule]):
+    modules = {get_module_path(module): module for module in modules}
+    modules = {module_path: module for module_path, module in modules.items() if module_path not in armed_modules}
+    if not modules:
+        return
+    all_branch_addresses = get_all_branch_instructions(target, list(modules.values()), arming_options.use_r2)
+
+    start = time.perf_counter()
+    for module_path, addresses in all_branch_addresses.items():
+        armed_modules.add(module_path)
+        if arming_options.shard is not None:
+            # sites are sorted by address, so every shard gets sites from all over the module
+            index, count = arming_options.shard
+            addresses = addresses[index::count]
+        if arming_options.arm == "each":
+            for address in addresses:
+                bp = target.BreakpointCreateByAddress(address)
+                set_breakpoint_callback(bp, get_branch_callback())
+                register_site_breakpoint(bp, [address])
+        elif arming_options.arm == "lazy":
+            arm_function_entries(target, modules[module_path], addresses)
+        else:
+            create_site_breakpoint(target, module_path, module_path, addresses)
+        print(f"{len(addresses)} branch sites in {os.path.basename(module_path)} are armed ({arming_options.arm})")
+    print(f"Arming took {time.perf_counter() - start:.2f} seconds")
+
+
+def get_branch_callback() -> str:
+    return "break_on_indirect_branch_fast" if arming_options.fast else "break_on_indirect_branch"
+
+
+def set_breakpoint_callback(bp: lldb.SBBreakpoint, callback: str):
+    '''
+    Sets a script callback, or registers the corresponding handler when the
+    asynchronous trace engine is used
+    '''
+    if session is None:
+        bp.SetScriptCallbackFunction(f"{FILE_NAME}.{callback}")
     else:
-        print(f"Branch address cache ({branch_address_cache}) not found. Start r2 analysis, but it takes a lot of time.")
-        disas_file_name = "/tmp/disas.asm"
-        disassemble(target_executable, image_base, disas_file_name)
-        grep_process = subprocess.Popen(["grep", "-E", "(call|jmp)\\s*\\w*\\s+(\\[|r[a|b|c|d]x|r[s|d]i|r[b|s]p|r\\d|e[a|b|c|d]x|e[s|d]i|e[b|s]p)", disas_file_name], stdout=subprocess.PIPE)
-        awk_process = subprocess.Popen(["awk", "{print $1}"], stdin=grep_process.stdout, stdout=subprocess.PIPE, text=True)
-        branch_addresses = [int(line.strip(), 16) for line in awk_process.communicate()[0].splitlines()]
-        with open(branch_address_cache, "w") as fout:
-            fout.write(json.dumps(branch_addresses))
-        return branch_addresses
+        session.add_handler(bp.GetID(), ASYNC_HANDLERS[callback], f"{FILE_NAME}.CollectIndirectBranchInfo")
+
+
+def register_site_breakpoint(bp: lldb.SBBreakpoint, addresses: List[int]):
+    site_breakpoint_ids.append(bp.GetID())
+    if aggregator is not None:
+        for address in addresses:
+            aggregator.site_breakpoints[address] = bp.GetID()
+
+
+def create_site_breakpoint(target: lldb.SBTarget, key: str, module_path: str, addresses: List[int]) -> lldb.SBBreakpoint:
+    '''
+    Creates one logical breakpoint whose locations are all the given branch sites.
+    The locations are added by BranchSiteResolver and share one callback.
+    '''
+    resolver_sites[key] = addresses
+    extra_args = lldb.SBStructuredData()
+    extra_args.SetFromJSON(json.dumps({"key": key}))
+    module_list = lldb.SBFileSpecList()
+    module_list.Append(lldb.SBFileSpec(module_path))
+    bp = target.BreakpointCreateFromScript(f"{FILE_NAME}.BranchSiteResolver", extra_args, module_list, lldb.SBFileSpecList())
+    set_breakpoint_callback(bp, get_branch_callback())
+    register_site_breakpoint(bp, addresses)
+    return bp
+
+
+class BranchSiteResolver:
+    '''
+    Scripted breakpoint resolver which adds a location for each branch site
+    registered in resolver_sites
+    '''
+
+    def __init__(self, bkpt: lldb.SBBreakpoint, extra_args: lldb.SBStructuredData, dict):
+        self.bkpt = bkpt
+        self.key = extra_args.GetValueForKey("key").GetStringValue(4096)
+
+    def __callback__(self, sym_ctx: lldb.SBSymbolContext):
+        target = self.bkpt.GetTarget()
+        for address in resolver_sites.get(self.key, []):
+            self.bkpt.AddLocation(target.ResolveLoadAddress(address))
+
+    def __get_depth__(self):
+        return lldb.eSearchDepthModule
+
+    def get_short_help(self):
+        return f"indirect branch sites of {self.key}"
+
+
+def arm_function_entries(target: lldb.SBTarget, module: lldb.SBModule, addresses: List[int]):
+    '''
+    Sets one breakpoint at the entry of each function containing branch sites.
+    The sites of a function are armed when its entry is hit for the first time.
+    '''
+    sites_by_function: Dict[int, List[int]] = {}
+    for address in addresses:
+        symbol = target.ResolveLoadAddress(address).GetSymbol()
+        entry = symbol.GetStartAddress().GetLoadAddress(target) if symbol.IsValid() else address
+        sites_by_function.setdefault(entry, []).append(address)
+
+    module_path = get_module_path(module)
+    for entry, sites in sites_by_function.items():
+        lazy_function_sites[entry] = (module_path, sites)
+        bp = target.BreakpointCreateByAddress(entry)
+        set_breakpoint_callback(bp, "break_on_function_entry")
+        entry_breakpoint_ids[bp.GetID()] = entry
+
+
+def arm_function_sites(frame: lldb.SBFrame, bp_loc: lldb.SBBreakpointLocation) -> bool:
+    '''
+    Arms the sites of the function at its first entry. Returns True if the entry
+    itself is a branch site, whose breakpoint is only hit from the next execution.
+    '''
+    entry = frame.GetPC()
+    entry_is_site = False
+    if entry in lazy_function_sites:
+        module_path, sites = lazy_function_sites.pop(entry)
+        create_site_breakpoint(frame.GetThread().GetProcess().GetTarget(), hex(entry), module_path, sites)
+        entry_is_site = entry in sites
+    bp_loc.GetBreakpoint().SetEnabled(False)
+    return entry_is_site
+
+
+def break_on_function_entry(frame: lldb.SBFrame, bp_loc: lldb.SBBreakpointLocation, dict: dict):
+    if not arm_function_sites(frame, bp_loc):
+        return False
+    if arming_options.fast:
+        return break_on_indirect_branch_fast(frame, bp_loc, dict)
+    return break_on_indirect_branch(frame, bp_loc, dict)
+
+
+def set_site_breakpoints_enabled(debugger: lldb.SBDebugger, enabled: bool):
+    target: lldb.SBTarget = debugger.GetSelectedTarget()
+    for bp_id in site_breakpoint_ids:
+        target.FindBreakpointByID(bp_id).SetEnabled(enabled)
+    # entry breakpoints of functions whose sites are armed stay disabled
+    num_entries = 0
+    for bp_id, entry in entry_breakpoint_ids.items():
+        pending = entry in lazy_function_sites
+        target.FindBreakpointByID(bp_id).SetEnabled(enabled and pending)
+        num_entries += pending
+    print(f"{len(site_breakpoint_ids)} branch site breakpoints and {num_entries} function entry breakpoints are {'enabled' if enabled else 'disabled'}")
+
+
+def arm(debugger: lldb.SBDebugger, command: str, exe_ctx: lldb.SBExecutionContext, result: lldb.SBCommandReturnObject, internal_dict: dict):
+    set_site_breakpoints_enabled(debugger, True)
+
+
+def disarm(debugger: lldb.SBDebugger, command: str, exe_ctx: lldb.SBExecutionContext, result: lldb.SBCommandReturnObject, internal_dict: dict):
+    set_site_breakpoints_enabled(debugger, False)
+
+
+class ModuleLoadListener(threading.Thread):
+    '''
+    Arms breakpoints in the selected modules when they are loaded
+    '''
+
+    def __init__(self, target: lldb.SBTarget):
+        super().__init__(name="brt-module-listener", daemon=True)
+        self.target = target
+        self.listener = lldb.SBListener("brt-module-listener")
+        self.target.GetBroadcaster().AddListener(self.listener, lldb.SBTarget.eBroadcastBitModulesLoaded)
+        self.stopped = threading.Event()
+
+    def run(self):
+        event = lldb.SBEvent()
+        while not self.stopped.is_set():
+            if not self.listener.WaitForEvent(1, event):
+                continue
+            if not event.GetType() & lldb.SBTarget.eBroadcastBitModulesLoaded:
+                continue
+            modules = [lldb.SBTarget.GetModuleAtIndexFromEvent(i, event) for i in range(lldb.SBTarget.GetNumModulesFromEvent(event))]
+            modules = [module for module in modules if module_matches(module, module_patterns)]
+            try:
+                arm_modules(self.target, modules)
+            except Exception as e:
+                print(f"Cannot arm breakpoints: {e}", file=sys.stderr)
+
+    def stop(self):
+        self.stopped.set()
+        self.target.GetBroadcaster().RemoveListener(self.listener, lldb.SBTarget.eBroadcastBitModulesLoaded)
+
+
+def start_module_listener(target: lldb.SBTarget):
+    global module_listener
+    if module_listener is not None:
+        module_listener.stop()
+    module_listener = ModuleLoadListener(target)
+    module_listener.start()
 
 
 @dataclass
 class BranchData:
     module: str
     func: str
-    registers: Dict[str, str]
+    registers: PackedRegisters
+
+    def as_record(self) -> dict:
+        return {"module": self.module, "func": self.func, "registers": self.registers}
+
+
+class RegisterCapture:
+    '''
+    Reads the selected 64-bit general purpose registers of a frame as integers
+    into a preallocated packed record. The positions of the registers in the
+    register set are resolved on the first capture.
+    '''
+
+    def __init__(self, names: Optional[List[str]] = None):
+        self.requested = None if names is None else set(names)
+        self.names: Optional[Tuple[str, ...]] = None
+        self.index: Dict[str, int] = {}
+        self.positions: List[int] = []
+
+    def resolve(self, general_purpose_registers: lldb.SBValue):
+        names = []
+        for position in range(general_purpose_registers.GetNumChildren()):
+            register = general_purpose_registers.GetChildAtIndex(position)
+            name = register.GetName()
+            if register.GetByteSize() != 8 or (self.requested is not None and name not in self.requested):
+                continue
+            names.append(name)
+            self.positions.append(position)
+        if self.requested is not None and (missing := self.requested - set(names)):
+            print(f"Registers not found: {', '.join(sorted(missing))}", file=sys.stderr)
+        self.names = tuple(names)
+        self.index = {name: i for i, name in enumerate(names)}
+
+    def capture(self, frame: lldb.SBFrame) -> PackedRegisters:
+        general_purpose_registers = frame.GetRegisters().GetFirstValueByName("General Purpose Registers")
+        if self.names is None:
+            self.resolve(general_purpose_registers)
+        values = array("Q", bytes(8 * len(self.positions)))
+        for i, position in enumerate(self.positions):
+            values[i] = general_purpose_registers.GetChildAtIndex(position).GetValueAsUnsigned()
+        return PackedRegisters(self.names, self.index, values)
+
+
+def parse_register_profile(value: str) -> Optional[List[str]]:
+    '''
+    Returns the register names of a capture profile ("all" -> None, "operand" -> [])
+    '''
+    if value == "all":
+        return None
+    if value == "operand":
+        return []
+    # rip identifies the site and rsp is adjusted for calls
+    return ["rip", "rsp"] + [name for name in value.split(",") if name]
+
+
+def get_register_capture(process: lldb.SBProcess, pc: int) -> RegisterCapture:
+    if register_capture is not None:
+        return register_capture
+    # "operand" profile: the registers used by the branch operand at this site
+    decoded = decode_branch_instruction(process, pc)
+    names = ["rip", "rsp"]
+    if decoded is not None:
+        operand = decoded.operand
+        names.extend(name for name in (operand.register, operand.base, operand.index) if name is not None and name != "rip")
+    names = tuple(names)
+    if names not in operand_register_captures:
+        operand_register_captures[names] = RegisterCapture(list(names))
+    return operand_register_captures[names]
+
+
+def get_frame_branch_data(frame: lldb.SBFrame, capture: RegisterCapture) -> BranchData:
+    module, func = symbols.lookup(frame.GetPC())
+    return BranchData(module=module, func=func, registers=capture.capture(frame))
+
+
+def get_destination_branch_data(target: lldb.SBTarget, destination: int, kind: str, before: BranchData) -> BranchData:
+    '''
+    Builds the record of the state right after the branch without stepping.
+    Only rip (and rsp for calls) differ from the state before the branch.
+    '''
+    module, func = symbols.lookup(destination)
+    if kind == "call" and (rsp := before.registers.value("rsp")) is not None:
+        registers = before.registers.replace(rip=destination, rsp=rsp - 8)
+    else:
+        registers = before.registers.replace(rip=destination)
+    return BranchData(module=module, func=func, registers=registers)
+
+
+@dataclass
+class BranchEdge:
+    before: BranchData
+    after: BranchData
+    count: int = 1
+
+
+@dataclass
+class SiteState:
+    first_hit: float
+    hits_without_new_destination: int = 0
+
+
+class BranchAggregator:
+    '''
+    Keeps (site, destination) -> hit count and one sample record per unique edge.
+    A site is disarmed after stale_hits hits without a new destination, or
+    time_budget seconds after its first hit.
+    '''
+
+    def __init__(self, stale_hits: int, time_budget: float):
+        self.stale_hits = stale_hits
+        self.time_budget = time_budget
+        self.site_breakpoints: Dict[int, int] = {}
+        self.disabled_sites: Dict[int, int] = {}
+        self.clear()
+
+    def clear(self):
+        self.edges: Dict[Tuple[int, int], BranchEdge] = {}
+        self.sites: Dict[int, SiteState] = {}
+        self.num_disabled_sites = 0
+
+    def hit(self, target: lldb.SBTarget, site: int, destination: int) -> bool:
+        '''
+        Counts a hit of a known edge. Returns False if the edge is new and
+        its sample record has to be added with add().
+        '''
+        edge = self.edges.get((site, destination))
+        if edge is None:
+            return False
+        edge.count += 1
+        state = self.sites[site]
+        state.hits_without_new_destination += 1
+        self.disarm_if_stale(target, site, state)
+        return True
+
+    def add(self, target: lldb.SBTarget, site: int, destination: int, before: BranchData, after: BranchData) -> bool:
+        '''
+        Returns True if the edge is new
+        '''
+        if self.hit(target, site, destination):
+            return False
+        self.edges[(site, destination)] = BranchEdge(before=before, after=after)
+        state = self.sites.setdefault(site, SiteState(first_hit=time.monotonic()))
+        state.hits_without_new_destination = 0
+        self.disarm_if_stale(target, site, state)
+        return True
+
+    def disarm_if_stale(self, target: lldb.SBTarget, site: int, state: SiteState):
+        stale = 0 < self.stale_hits <= state.hits_without_new_destination
+        expired = 0 < self.time_budget <= time.monotonic() - state.first_hit
+        if not (stale or expired) or site not in self.site_breakpoints:
+            return
+        bp_id = self.disabled_sites[site] = self.site_breakpoints.pop(site)
+        self.set_site_enabled(target, site, bp_id, False)
+        self.num_disabled_sites += 1
+
+    @staticmethod
+    def set_site_enabled(target: lldb.SBTarget, site: int, bp_id: int, enabled: bool):
+        bp = target.FindBreakpointByID(bp_id)
+        bp_loc = bp.FindLocationByAddress(site)
+        if bp_loc.IsValid():
+            bp_loc.SetEnabled(enabled)
+        else:
+            bp.SetEnabled(enabled)
+
+    def rearm(self, target: lldb.SBTarget):
+        '''
+        Re-enables the sites disabled as stale, for the next run of the target
+        '''
+        for site, bp_id in self.disabled_sites.items():
+            self.set_site_enabled(target, site, bp_id, True)
+            self.site_breakpoints[site] = bp_id
+        self.disabled_sites.clear()
+
+    def set_sample(self, site: int, destination: int, before: BranchData, after: BranchData):
+        edge = self.edges[(site, destination)]
+        edge.before = before
+        edge.after = after
+
+    def records(self) -> List[dict]:
+        # edges added by the trace engine have no sample until its workers record it
+        return [{"before": edge.before.as_record(), "after": edge.after.as_record(), "count": edge.count}
+                for edge in self.edges.values() if edge.before is not None]
+
+
+def save_branch_data(target: lldb.SBTarget, before: BranchData, after: BranchData, counted: bool = False):
+    '''
+    counted: the edge has already been added to the aggregator without a sample
+    '''
+    with record_lock:
+        if aggregator is not None:
+            site, destination = before.registers.value("rip"), after.registers.value("rip")
+            if counted:
+                aggregator.set_sample(site, destination, before, after)
+            elif not aggregator.add(target, site, destination, before, after):
+                return
+        append_branch_record(target, before, after)
+
+
+def append_branch_record(target: lldb.SBTarget, before: BranchData, after: BranchData):
+    record = {
+        "before": before.as_record(),
+        "after": after.as_record()
+    }
+    if trace_writer is not None:
+        if symbols.generation != traced_modules_generation:
+            write_modules_record(target.GetDebugger())
+        trace_writer.write({"type": "branch", **record})
+    elif aggregator is None:
+        branch_data.append(record)
 
 
 class CollectIndirectBranchInfo:
     def __init__(self, thread_plan, dict):
         self.thread_plan = thread_plan
         self.thread = self.thread_plan.GetThread()
+        self.capture = get_register_capture(self.thread.GetProcess(), self.thread.GetFrameAtIndex(0).GetPC())
         self.branch_data_before = self.get_branch_data()
         self.branch_data_after = None
 
     def get_branch_data(self) -> BranchData:
-        return BranchData(module=self.get_current_module(), func=self.get_current_func(), registers=self.get_register_values())
-
-    def get_current_func(self):
-        return self.thread.GetFrameAtIndex(0).GetFunctionName()
-
-    def get_current_module(self):
-        return self.thread.GetFrameAtIndex(0).GetModule().GetFileSpec().GetFilename()
-
-    def get_register_values(self):
-        frame = self.thread.GetFrameAtIndex(0)
-        registers = frame.GetRegisters()
-        general_purpose_registers = registers.GetFirstValueByName("General Purpose Registers")
-        
-        register_values = {}
-        for register in general_purpose_registers:
-            if register.GetByteSize() == 8:
-                register_values[register.GetName()] = register.GetValue()
-        return register_values
+        return get_frame_branch_data(self.thread.GetFrameAtIndex(0), self.capture)
 
     def save(self):
-        global branch_data
-        branch_data.append({
-            "before": asdict(self.branch_data_before),
-            "after": asdict(self.branch_data_after)
-        })
+        save_branch_data(self.thread.GetProcess().GetTarget(), self.branch_data_before, self.branch_data_after)
 
     def is_stale(self):
         return False
@@ -200,9 +822,218 @@ class CollectIndirectBranchInfo:
         stream.Print("CollectIndirectBranch completed")
 
 
+@trace_stats.timed_callback(stats)
 def break_on_indirect_branch(frame: lldb.SBFrame, bp_loc: lldb.SBAddress, dict: dict):
+    return step_over_branch(frame)
+
+
+def step_over_branch(frame: lldb.SBFrame):
+    # the scripted thread plan has to run synchronously inside the callback
     thread = frame.GetThread()
     process = thread.GetProcess()
     process.GetTarget().GetDebugger().SetAsync(False)
     thread.StepUsingScriptedThreadPlan(f"{FILE_NAME}.CollectIndirectBranchInfo", False)
+    stats.count("steps")
     return False
+
+
+def decode_branch_instruction(process: lldb.SBProcess, pc: int) -> Optional[DecodedBranch]:
+    if pc not in decoded_branches:
+        # code pages are cached across stops, so the sites in one page cost one
+        # ReadMemory call. Breakpoint opcodes are replaced with the original bytes.
+        cache = memory_cache.get_cache(process)
+        data = cache.read(pc, MAX_INSTRUCTION_LENGTH, constant=True)
+        if data is None:
+            # the instruction may end right before an unreadable page
+            data = cache.read(pc, memory_cache.PAGE_SIZE - (pc & (memory_cache.PAGE_SIZE - 1)), constant=True)
+        stats.count("memory_reads")
+        decoded = None
+        if data is not None:
+            operand = x86_64_decoder.decode_operand(data)
+            if operand is not None:
+                size, _, kind = x86_64_decoder.decode(data, 0)
+                decoded = DecodedBranch(operand=operand, size=size, kind=kind)
+        decoded_branches[pc] = decoded
+    return decoded_branches[pc]
+
+
+def compute_branch_destination(frame: lldb.SBFrame, pc: int, decoded: DecodedBranch) -> Optional[int]:
+    '''
+    Computes the branch destination from the registers and at most one memory read.
+    Returns None when the operand cannot be evaluated.
+    '''
+    operand = decoded.operand
+
+    def register_value(name: str) -> Optional[int]:
+        if name == "rip":
+            return pc + decoded.size
+        register = frame.FindRegister(name)
+        if not register.IsValid():
+            return None
+        return register.GetValueAsUnsigned()
+
+    if not operand.is_memory:
+        return register_value(operand.register)
+
+    address = operand.displacement
+    for name, scale in ((operand.base, 1), (operand.index, operand.scale)):
+        if name is None:
+            continue
+        if (value := register_value(name)) is None:
+            return None
+        address += value * scale
+    if operand.address_size == 32:
+        address &= 0xffffffff
+    if operand.segment is not None:
+        if (segment_base := register_value(f"{operand.segment}_base")) is None:
+            return None
+        address += segment_base
+    address &= 0xffffffffffffffff
+
+    # not cached: one pointer is read per stop, and memory changes between stops
+    error = lldb.SBError()
+    destination = frame.GetThread().GetProcess().ReadPointerFromMemory(address, error)
+    stats.count("memory_reads")
+    if not error.Success():
+        return None
+    return destination
+
+
+@trace_stats.timed_callback(stats)
+def break_on_indirect_branch_fast(frame: lldb.SBFrame, bp_loc: lldb.SBAddress, dict: dict):
+    '''
+    Records the branch without stepping. Falls back to the scripted thread plan
+    for operands which cannot be evaluated at the breakpoint.
+    '''
+    pc = frame.GetPC()
+    process = frame.GetThread().GetProcess()
+    decoded = decode_branch_instruction(process, pc)
+    destination = None if decoded is None else compute_branch_destination(frame, pc, decoded)
+    if destination is None:
+        return step_over_branch(frame)
+
+    target = process.GetTarget()
+    with record_lock:
+        if aggregator is not None and aggregator.hit(target, pc, destination):
+            # known edge: no need to take a register snapshot
+            return False
+    before = get_frame_branch_data(frame, get_register_capture(process, pc))
+    after = get_destination_branch_data(target, destination, decoded.kind, before)
+    save_branch_data(target, before, after)
+    return False
+
+
+@trace_stats.timed_handler(stats)
+def handle_indirect_branch(thread: lldb.SBThread, bp_loc: lldb.SBBreakpointLocation) -> str:
+    stats.count("steps")
+    return STEP
+
+
+@trace_stats.timed_handler(stats)
+def handle_indirect_branch_fast(thread: lldb.SBThread, bp_loc: lldb.SBBreakpointLocation) -> str:
+    '''
+    Trace engine handler: captures the registers and the destination while the
+    process is stopped, and leaves symbolication and recording to the workers
+    '''
+    frame = thread.GetFrameAtIndex(0)
+    pc = frame.GetPC()
+    process = thread.GetProcess()
+    decoded = decode_branch_instruction(process, pc)
+    destination = None if decoded is None else compute_branch_destination(frame, pc, decoded)
+    if destination is None:
+        stats.count("steps")
+        return STEP
+
+    target = process.GetTarget()
+    with record_lock:
+        # breakpoint locations are only enabled or disabled while the process is stopped
+        if aggregator is not None and not aggregator.add(target, pc, destination, None, None):
+            return CONTINUE
+    registers = get_register_capture(process, pc).capture(frame)
+    session.submit(record_branch, target, pc, registers, destination, decoded.kind)
+    return CONTINUE
+
+
+def handle_function_entry(thread: lldb.SBThread, bp_loc: lldb.SBBreakpointLocation) -> str:
+    if not arm_function_sites(thread.GetFrameAtIndex(0), bp_loc):
+        return CONTINUE
+    return ASYNC_HANDLERS[get_branch_callback()](thread, bp_loc)
+
+
+ASYNC_HANDLERS = {
+    "break_on_indirect_branch": handle_indirect_branch,
+    "break_on_indirect_branch_fast": handle_indirect_branch_fast,
+    "break_on_function_entry": handle_function_entry,
+}
+
+
+def record_branch(target: lldb.SBTarget, pc: int, registers: PackedRegisters, destination: int, kind: str):
+    module, func = symbols.lookup(pc)
+    before = BranchData(module=module, func=func, registers=registers)
+    after = get_destination_branch_data(target, destination, kind, before)
+    save_branch_data(target, before, after, counted=aggregator is not None)
+
+
+def show_stats(debugger: lldb.SBDebugger, command: str, exe_ctx: lldb.SBExecutionContext, result: lldb.SBCommandReturnObject, internal_dict: dict):
+    trace_stats.handle_stats_command(debugger, command, result, stats, "brt_stats")
+
+
+def run(debugger: lldb.SBDebugger, command: str, exe_ctx: lldb.SBExecutionContext, result: lldb.SBCommandReturnObject, internal_dict: dict):
+    '''
+    Launches the target with the arguments under the trace engine, or resumes the
+    current process under it. Branch sites must be armed with "brt_set_bps --async"
+    '''
+    global session
+    parser = generate_run_option_parser()
+    try:
+        (options, args) = parser.parse_args(shlex.split(command))
+    except:
+        result.SetError(parser.usage)
+        return
+    if session is None:
+        result.SetError("Arm branch sites with \"brt_set_bps --async\" first")
+        return
+    if session.is_alive():
+        result.SetError("The process already runs under the trace engine")
+        return
+    if session.process is not None:
+        # the previous run has ended
+        session.close()
+        session = session.renew()
+
+    target: lldb.SBTarget = debugger.GetSelectedTarget()
+    process = target.GetProcess()
+    stopped = process.IsValid() and process.GetState() == lldb.eStateStopped
+    if stopped and not (options.restart or options.resume):
+        result.SetError("The process is already running. Relaunch it under the trace engine with --restart, "
+                        "or resume it with --resume (every stop is then also reported to this session)")
+        return
+    if options.restart and process.IsValid():
+        process.Kill()
+    debugger.SetAsync(True)
+    if stopped and options.resume:
+        print("Warning: the process was launched by this session, so each stop is also reported here. "
+              "Use --restart to trace it without the per-stop console cost")
+        error = session.attach(process)
+    else:
+        error = session.launch(target, args)
+    if not error.Success():
+        result.SetError(f"Cannot run the target: {error.GetCString()}")
+        return
+    print("The process runs under the trace engine. Save branch data with \"brt_save\" at any time")
+
+
+def generate_run_option_parser():
+    usage = "usage: %prog [--restart|--resume] [-- ARGS...]"
+    parser = optparse.OptionParser(usage=usage, prog="brt_run")
+    parser.add_option("--restart",
+                      action="store_true",
+                      default=False,
+                      dest="restart",
+                      help="Kill the current process and relaunch the target under the trace engine")
+    parser.add_option("--resume",
+                      action="store_true",
+                      default=False,
+                      dest="resume",
+                      help="Resume the current stopped process under the trace engine. Its stops are also reported to the interactive session")
+    return parser
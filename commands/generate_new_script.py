@@ -63,7 +63,13 @@ def generate_new_script(debugger: lldb.SBDebugger, command: str, exe_ctx: lldb.S
         result.SetError('There already exists a file named "{}", please remove the file at "{}" first'.format(clean_command, file_path))
         return
 
-    if options.create_class:
+    if options.tracer and options.create_class:
+        result.SetError('--tracer generates a function styled script and cannot be used with --create_class')
+        return
+
+    if options.tracer:
+        script = generate_tracer_file(clean_command, options)
+    elif options.create_class:
         script = generate_class_file(clean_command, options)
     else:
         script = generate_function_file(clean_command, options)
@@ -189,6 +195,174 @@ def generate_option_parser():
     '''
     return script
 
+def generate_tracer_file(filename, options):
+    '''
+    Generates a tracer command which follows the patterns of branch_trace and
+    sw_types_trace: records are queued to a bounded background writer, callback
+    latency is measured per site, and analysis results are cached by the hash
+    of the analysed module. Only the analysis and the record have to be written.
+    '''
+    resolved_name = options.command_name if options.command_name else filename
+    script = r"""
+'''
+__COMMAND__ sets a breakpoint at each site found by analyse_module() and writes a
+record per hit. Records are queued to a bounded background writer (trace_writer),
+callback latency is measured per site (trace_stats), and the analysis result of
+each module is cached by its SHA-256 (analysis_cache).
+
+    __COMMAND__ [-m MODULE] -f FUNCTION [-o OUTPUT]
+    (continue the program)
+    __COMMAND___save
+    __COMMAND___stats
+'''
+
+import lldb
+import fnmatch
+import os
+import shlex
+import optparse
+from typing import Dict, List, Optional
+
+import analysis_cache
+import memory_cache
+import trace_stats
+from module_utils import get_image_base, get_module_path, is_loaded, module_matches, parse_module_patterns
+from trace_writer import TraceWriter
+
+
+FILE_NAME = os.path.basename(__file__)[:-3]
+ANALYSIS_KIND = "__COMMAND___functions"  # change it when analyse_module() changes
+trace_writer: Optional[TraceWriter] = None
+stats = trace_stats.TraceStats(memory_cache.counters)
+
+
+def __lldb_init_module(debugger: lldb.SBDebugger, internal_dict: dict):
+    debugger.HandleCommand(f'__REGISTER__ -f {FILE_NAME}.set_bps __COMMAND__ -h "Set breakpoints at the sites of the selected modules and record their hits"')
+    debugger.HandleCommand(f'__REGISTER__ -f {FILE_NAME}.save __COMMAND___save -h "Wait until the recorded hits are written to the output file"')
+    debugger.HandleCommand(f'__REGISTER__ -f {FILE_NAME}.show_stats __COMMAND___stats -h "Show hit counts and callback latency of the sites"')
+
+
+def set_bps(debugger: lldb.SBDebugger, command: str, exe_ctx: lldb.SBExecutionContext, result: lldb.SBCommandReturnObject, internal_dict: dict):
+    command_args = shlex.split(command, posix=False)
+    parser = generate_option_parser()
+    try:
+        (options, args) = parser.parse_args(command_args)
+    except:
+        result.SetError(parser.usage)
+        return
+    if not options.functions:
+        result.SetError(parser.usage)
+        return
+
+    target: lldb.SBTarget = debugger.GetSelectedTarget()
+    if not target.IsValid():
+        result.SetError("No target is selected")
+        return
+
+    global trace_writer
+    if trace_writer is not None:
+        trace_writer.close()
+    trace_writer = TraceWriter(options.output)
+    stats.clear()
+
+    module_patterns = parse_module_patterns(options.modules)
+    if not module_patterns:
+        module_patterns = [target.GetModuleAtIndex(0).GetFileSpec().GetFilename()]
+    modules = []
+    num_sites = 0
+    for module in target.module_iter():
+        if not module_matches(module, module_patterns) or not is_loaded(target, module):
+            continue
+        modules.append({"name": module.GetFileSpec().GetFilename(), "addr": hex(get_image_base(target, module))})
+        for address in get_sites(target, module, options.functions):
+            bp = target.BreakpointCreateByAddress(address)
+            bp.SetScriptCallbackFunction(f"{FILE_NAME}.break_on_site")
+            num_sites += 1
+    trace_writer.write({"type": "modules", "modules": modules})
+    print(f"{num_sites} sites in {len(modules)} modules are armed. Hits are streamed to {options.output}")
+
+
+def analyse_module(target: lldb.SBTarget, module: lldb.SBModule, image_base: int) -> Dict[str, int]:
+    '''
+    The analysis whose result is cached: {function name: image-relative offset}.
+    Replace it with the analysis of the tracer. The result has to be JSON
+    serializable and must not contain load addresses.
+    '''
+    functions = {}
+    for symbol in module:
+        if symbol.GetType() != lldb.eSymbolTypeCode or not symbol.GetName():
+            continue
+        start = symbol.GetStartAddress().GetLoadAddress(target)
+        if start != lldb.LLDB_INVALID_ADDRESS:
+            functions.setdefault(symbol.GetName(), start - image_base)
+    return functions
+
+
+def get_sites(target: lldb.SBTarget, module: lldb.SBModule, patterns: List[str]) -> List[int]:
+    '''
+    Returns the load addresses of the functions which match the patterns
+    '''
+    image_base = get_image_base(target, module)
+    file_hash = analysis_cache.hash_file(get_module_path(module))
+    # a universal binary has one hash for all of its slices
+    cache_kind = analysis_cache.get_kind(ANALYSIS_KIND, target)
+    functions = analysis_cache.load(cache_kind, file_hash)
+    if functions is None:
+        functions = analyse_module(target, module, image_base)
+        analysis_cache.store(cache_kind, file_hash, functions)
+    return sorted({image_base + offset for name, offset in functions.items()
+                   if any(fnmatch.fnmatch(name, pattern) for pattern in patterns)})
+
+
+@trace_stats.timed_callback(stats)
+def break_on_site(frame: lldb.SBFrame, bp_loc: lldb.SBBreakpointLocation, dict: dict):
+    # keep callbacks cheap: no symbolication or expression evaluation here, and
+    # memory reads through memory_cache.get_cache(process) if the record needs them
+    trace_writer.write({
+        "type": "hit",
+        "pc": hex(frame.GetPC()),
+        "sp": hex(frame.GetSP()),
+        "thread": frame.GetThread().GetThreadID(),
+    })
+    return False
+
+
+def save(debugger: lldb.SBDebugger, command: str, exe_ctx: lldb.SBExecutionContext, result: lldb.SBCommandReturnObject, internal_dict: dict):
+    if trace_writer is None:
+        result.SetError("No trace is started. Run __COMMAND__ first")
+        return
+    trace_writer.flush()
+    print(f"{trace_writer.num_records} records are written to {trace_writer.path}")
+
+
+def show_stats(debugger: lldb.SBDebugger, command: str, exe_ctx: lldb.SBExecutionContext, result: lldb.SBCommandReturnObject, internal_dict: dict):
+    trace_stats.handle_stats_command(debugger, command, result, stats, "__COMMAND___stats")
+
+
+def generate_option_parser():
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage, prog="__COMMAND__")
+    parser.add_option("-m", "--module",
+                      action="append",
+                      default=[],
+                      dest="modules",
+                      help="Module names or glob patterns (comma separated, can be repeated). Default: main module")
+    parser.add_option("-f", "--function",
+                      action="append",
+                      default=[],
+                      dest="functions",
+                      help="Name or glob pattern of the functions to trace (can be repeated)")
+    parser.add_option("-o", "--output",
+                      action="store",
+                      default="/tmp/__COMMAND__.ndjson",
+                      dest="output",
+                      help="NDJSON file the hits are streamed to (default: /tmp/__COMMAND__.ndjson)")
+    return parser
+"""
+    # "command script add" is inserted here, so lldbinit.py does not take the
+    # template lines for registrations of this module
+    return script.replace("__REGISTER__", "command script add").replace("__COMMAND__", resolved_name)
+
 def create_or_touch_filepath(filepath, script):
     file = open(filepath, "w")
     file.write(script)
@@ -212,4 +386,10 @@ def generate_option_parser():
                       default=False,
                       dest="create_class",
                       help="By default, this script creates a function. This will use a class instead")
+
+    parser.add_option("-t", "--tracer",
+                      action="store_true",
+                      default=False,
+                      dest="tracer",
+                      help="Create a breakpoint tracer with a background record writer, per-site callback timing, a save command and an analysis cache")
     return parser
\ No newline at end of file
@@ -21,24 +21,143 @@
 # SOFTWARE.
 
 import lldb
+import ast
 import os
+import re
+import sys
+import time
+
+# Commands are registered as stubs which import their module on first use, so
+# startup does not pay for modules most sessions never use. The stubs are taken
+# from the "command script add" strings of the HandleCommand calls in the
+# __lldb_init_module of each module, which is parsed but not executed. The first
+# call of a stub imports its module, whose __lldb_init_module replaces the stubs
+# with the real commands (see import_lazy_module).
+# Modules without __lldb_init_module are helper modules and are not imported here.
+# Set LLDB_COMMANDS_EAGER=1 to import every module at startup, and
+# LLDB_COMMANDS_TIMING=1 to report how long each module took to load.
+FILE_NAME = os.path.basename(__file__)[:-3]
+COMMAND_PATTERN = re.compile(r"command script add -f (?:\{FILE_NAME\}|\w+)\.(\w+) (\w+) -h \"([^\"]*)\"")
+eager = os.environ.get("LLDB_COMMANDS_EAGER") == "1"
+timing = os.environ.get("LLDB_COMMANDS_TIMING") == "1"
+lazy_commands = {}  # command name -> (module name, module path, function name)
+
 
 def __lldb_init_module(debugger, internal_dict):
     file_path = os.path.realpath(__file__)
     dir_name = os.path.dirname(file_path)
-    load_python_scripts_dir(dir_name)
+    start = time.perf_counter()
+    load_python_scripts_dir(debugger, dir_name)
+    if timing:
+        print(f"{FILE_NAME}: startup took {(time.perf_counter() - start) * 1000:.1f} ms")
 
-def load_python_scripts_dir(dir_name):
+def load_python_scripts_dir(debugger, dir_name):
     this_files_basename = os.path.basename(__file__)
-    cmd = ''
-    for file in os.listdir(dir_name):
+    for file in sorted(os.listdir(dir_name)):
+        if file == this_files_basename:
+            continue
+        fullpath = dir_name + '/' + file
         if file.endswith('.py'):
-            cmd = 'command script import ' 
+            with open(fullpath, "r") as fin:
+                source = fin.read()
+            if "def __lldb_init_module" not in source:
+                # helper module, imported by the commands which use it
+                continue
+            if eager or not register_lazy_commands(debugger, fullpath, source):
+                import_script(debugger, fullpath)
         elif file.endswith('.txt'):
-            cmd = 'command source -e0 -s1 '
-        else: 
+            run_timed(debugger, 'command source -e0 -s1 ' + fullpath, file)
+
+def register_lazy_commands(debugger, fullpath, source):
+    '''
+    Registers stubs for the commands of a module. Returns False if the module has
+    to be imported now because its commands cannot be found in its source.
+    '''
+    commands = [command for text in get_registration_texts(source) for command in COMMAND_PATTERN.findall(text)]
+    if not commands:
+        return False
+    module_name = os.path.basename(fullpath)[:-3]
+    for function_name, command_name, help_text in commands:
+        lazy_commands[command_name] = (module_name, fullpath, function_name)
+        globals()[f"lazy_{command_name}"] = make_stub(command_name)
+        debugger.HandleCommand(f'command script add -f {FILE_NAME}.lazy_{command_name} {command_name} -h "{help_text}"')
+    return True
+
+def get_registration_texts(source):
+    '''
+    Returns the string arguments of the HandleCommand calls in __lldb_init_module.
+    Only these are matched with COMMAND_PATTERN, so strings elsewhere in the
+    module (e.g. script templates) are never taken for registrations.
+    '''
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return []
+    texts = []
+    for node in tree.body:
+        if not isinstance(node, ast.FunctionDef) or node.name != "__lldb_init_module":
             continue
+        for call in ast.walk(node):
+            if (isinstance(call, ast.Call) and isinstance(call.func, ast.Attribute) and call.func.attr == "HandleCommand"
+                    and call.args and (text := get_string_text(call.args[0])) is not None):
+                texts.append(text)
+    return texts
+
+def get_string_text(node):
+    '''
+    Returns the text of a string literal. Names in f-strings are kept as
+    "{NAME}"; other expressions make the text unknown (None).
+    '''
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    if not isinstance(node, ast.JoinedStr):
+        return None
+    parts = []
+    for value in node.values:
+        if isinstance(value, ast.Constant):
+            parts.append(value.value)
+        elif isinstance(value, ast.FormattedValue) and isinstance(value.value, ast.Name):
+            parts.append(f"{{{value.value.id}}}")
+        else:
+            return None
+    return "".join(parts)
+
+def make_stub(command_name):
+    def stub(debugger, command, exe_ctx, result, internal_dict):
+        module_name, fullpath, function_name = lazy_commands[command_name]
+        if module_name not in sys.modules:
+            import_lazy_module(debugger, fullpath)
+        module = sys.modules.get(module_name)
+        if module is None:
+            result.SetError(f"Cannot import {fullpath}")
+            return
+        getattr(module, function_name)(debugger, command, exe_ctx, result, internal_dict)
+    return stub
+
+def import_lazy_module(debugger, fullpath):
+    '''
+    Imports the module of a stub. "command script add" in its __lldb_init_module
+    cannot replace the stubs while interpreter.require-overwrite is set, so the
+    setting is turned off during the import (LLDB versions without the setting
+    always replace commands).
+    '''
+    interpreter = debugger.GetCommandInterpreter()
+    result = lldb.SBCommandReturnObject()
+    interpreter.HandleCommand("settings show interpreter.require-overwrite", result)
+    require_overwrite = result.Succeeded() and result.GetOutput().strip().endswith("= true")
+    if require_overwrite:
+        interpreter.HandleCommand("settings set interpreter.require-overwrite false", lldb.SBCommandReturnObject())
+    try:
+        import_script(debugger, fullpath)
+    finally:
+        if require_overwrite:
+            interpreter.HandleCommand("settings set interpreter.require-overwrite true", lldb.SBCommandReturnObject())
+
+def import_script(debugger, fullpath):
+    run_timed(debugger, 'command script import ' + fullpath, os.path.basename(fullpath))
 
-        if file != this_files_basename:
-            fullpath = dir_name + '/' + file
-            lldb.debugger.HandleCommand(cmd + fullpath)
+def run_timed(debugger, cmd, name):
+    start = time.perf_counter()
+    debugger.HandleCommand(cmd)
+    if timing:
+        print(f"{FILE_NAME}: loading {name} took {(time.perf_counter() - start) * 1000:.1f} ms")
@@ -0,0 +1,212 @@
+'''
+Page-cached process memory reader shared by the commands. Memory is fetched in
+whole pages, and later reads in the same pages are served from the cache, so
+many small reads cost one SBProcess.ReadMemory round trip per page. This matters
+most over remote debugserver links, where each round trip is expensive.
+
+Cached pages are dropped when the stop ID of the process changes (i.e. after the
+process has resumed), so a read never returns memory from an earlier stop.
+Pages read with constant=True (e.g. code) are kept until the process exits.
+Breakpoint opcodes never appear in the data; ReadMemory returns the original bytes.
+'''
+
+import lldb
+import struct
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+PAGE_SIZE = 0x1000
+PAGE_MASK = ~(PAGE_SIZE - 1)
+DEFAULT_MAX_PAGES = 4096  # 16 MiB
+DIRECT_READ_SIZE = 64 * PAGE_SIZE  # larger reads are not cached
+
+cache: Optional["MemoryCache"] = None
+totals: Dict[str, int] = {"memory_cache_hits": 0, "memory_cache_misses": 0, "memory_cache_reads": 0, "memory_cache_invalidations": 0}
+
+
+class MemoryCache:
+    def __init__(self, process: lldb.SBProcess, max_pages: int = DEFAULT_MAX_PAGES, counters: Optional[Dict[str, int]] = None):
+        self.process = process
+        self.max_pages = max_pages
+        self.pages: OrderedDict[int, Optional[bytes]] = OrderedDict()  # None: not readable
+        self.constant_pages: OrderedDict[int, Optional[bytes]] = OrderedDict()
+        self.stop_id: Optional[int] = None
+        self.lock = threading.RLock()
+        self.counters = {name: 0 for name in totals} if counters is None else counters
+
+    def validate(self):
+        stop_id = self.process.GetStopID(True)
+        if stop_id != self.stop_id:
+            if self.pages:
+                self.counters["memory_cache_invalidations"] += 1
+                self.pages.clear()
+            self.stop_id = stop_id
+
+    def read_direct(self, address: int, size: int) -> Optional[bytes]:
+        error = lldb.SBError()
+        data = self.process.ReadMemory(address, size, error)
+        self.counters["memory_cache_reads"] += 1
+        return data if error.Success() and len(data) == size else None
+
+    def store(self, pages: "OrderedDict[int, Optional[bytes]]", page: int, data: Optional[bytes]):
+        pages[page] = data
+        pages.move_to_end(page)
+        while len(pages) > self.max_pages:
+            pages.popitem(last=False)
+
+    def fetch(self, pages: "OrderedDict[int, Optional[bytes]]", first_page: int, num_pages: int):
+        '''
+        Reads a run of adjacent pages with one ReadMemory call. If a page of the
+        run is not readable, the pages are read one by one.
+        '''
+        data = self.read_direct(first_page, num_pages * PAGE_SIZE)
+        if data is not None:
+            for i in range(num_pages):
+                self.store(pages, first_page + i * PAGE_SIZE, data[i * PAGE_SIZE:(i + 1) * PAGE_SIZE])
+        elif num_pages == 1:
+            self.store(pages, first_page, None)
+        else:
+            for i in range(num_pages):
+                self.fetch(pages, first_page + i * PAGE_SIZE, 1)
+
+    def prefetch(self, pages: "OrderedDict[int, Optional[bytes]]", wanted: Iterable[int]) -> int:
+        '''
+        Fetches the wanted pages which are not cached, and returns their number.
+        Only misses are counted here; the caller counts the remaining pages as hits.
+        '''
+        missing = sorted(page for page in set(wanted) if page not in pages)
+        self.counters["memory_cache_misses"] += len(missing)
+        run_start = None
+        run_length = 0
+        for page in missing:
+            if run_start is not None and page == run_start + run_length * PAGE_SIZE:
+                run_length += 1
+                continue
+            if run_start is not None:
+                self.fetch(pages, run_start, run_length)
+            run_start, run_length = page, 1
+        if run_start is not None:
+            self.fetch(pages, run_start, run_length)
+        return len(missing)
+
+    def get_page(self, pages: "OrderedDict[int, Optional[bytes]]", page: int) -> Optional[bytes]:
+        if page in pages:
+            self.counters["memory_cache_hits"] += 1
+            pages.move_to_end(page)
+            return pages[page]
+        self.counters["memory_cache_misses"] += 1
+        self.fetch(pages, page, 1)
+        return pages.get(page)
+
+    def copy(self, pages: "OrderedDict[int, Optional[bytes]]", address: int, size: int) -> Optional[bytes]:
+        '''
+        Copies prefetched memory without counting. A page evicted since the
+        prefetch is read again.
+        '''
+        first_page = address & PAGE_MASK
+        chunks = []
+        for page in range(first_page, ((address + size - 1) & PAGE_MASK) + PAGE_SIZE, PAGE_SIZE):
+            if page not in pages:
+                self.fetch(pages, page, 1)
+            pages.move_to_end(page)
+            if (data := pages[page]) is None:
+                return None
+            chunks.append(data)
+        offset = address - first_page
+        return b"".join(chunks)[offset:offset + size]
+
+    def select_pages(self, constant: bool) -> "OrderedDict[int, Optional[bytes]]":
+        if constant:
+            return self.constant_pages
+        self.validate()
+        return self.pages
+
+    def read(self, address: int, size: int, constant: bool = False) -> Optional[bytes]:
+        if size <= 0:
+            return b""
+        if size > DIRECT_READ_SIZE:
+            return self.read_direct(address, size)
+        with self.lock:
+            pages = self.select_pages(constant)
+            first_page = address & PAGE_MASK
+            last_page = (address + size - 1) & PAGE_MASK
+            if first_page == last_page:
+                data = self.get_page(pages, first_page)
+                return None if data is None else data[address - first_page:address - first_page + size]
+            wanted = range(first_page, last_page + PAGE_SIZE, PAGE_SIZE)
+            self.counters["memory_cache_hits"] += len(wanted) - self.prefetch(pages, wanted)
+            return self.copy(pages, address, size)
+
+    def read_many(self, requests: Iterable[Tuple[int, int]], constant: bool = False) -> List[Optional[bytes]]:
+        '''
+        Vectored read of (address, size) pairs. The missing pages of all requests
+        are fetched first, with one ReadMemory call per run of adjacent pages.
+        Each distinct page is counted once, as a hit or a miss.
+        '''
+        requests = list(requests)
+        with self.lock:
+            pages = self.select_pages(constant)
+            wanted = set()
+            for address, size in requests:
+                if 0 < size <= DIRECT_READ_SIZE:
+                    wanted.update(range(address & PAGE_MASK, ((address + size - 1) & PAGE_MASK) + PAGE_SIZE, PAGE_SIZE))
+            if len(wanted) > self.max_pages:
+                return [self.read(address, size, constant) for address, size in requests]
+            self.counters["memory_cache_hits"] += len(wanted) - self.prefetch(pages, wanted)
+            return [self.copy(pages, address, size) if 0 < size <= DIRECT_READ_SIZE else self.read(address, size, constant)
+                    for address, size in requests]
+
+    def read_pointer(self, address: int, constant: bool = False) -> Optional[int]:
+        if (data := self.read(address, 8, constant)) is None:
+            return None
+        return struct.unpack("<Q", data)[0]
+
+    def read_u32(self, address: int, constant: bool = False) -> Optional[int]:
+        if (data := self.read(address, 4, constant)) is None:
+            return None
+        return struct.unpack("<I", data)[0]
+
+    def read_i32(self, address: int, constant: bool = False) -> Optional[int]:
+        if (data := self.read(address, 4, constant)) is None:
+            return None
+        return struct.unpack("<i", data)[0]
+
+    def read_c_string(self, address: int, max_length: int, constant: bool = False) -> Optional[bytes]:
+        '''
+        Reads a NUL-terminated string page by page. Returns None if the string
+        is not terminated within max_length bytes or the readable memory.
+        '''
+        chunks = []
+        pos = address
+        limit = address + max_length
+        while pos < limit:
+            page = pos & PAGE_MASK
+            size = min(page + PAGE_SIZE, limit) - pos
+            if (chunk := self.read(pos, size, constant)) is None:
+                return None
+            if (terminator := chunk.find(b"\0")) >= 0:
+                chunks.append(chunk[:terminator])
+                return b"".join(chunks)
+            chunks.append(chunk)
+            pos += size
+        return None
+
+
+def get_cache(process: lldb.SBProcess) -> MemoryCache:
+    '''
+    Returns the cache shared by all commands for the process
+    '''
+    global cache
+    if cache is None or cache.process.GetUniqueID() != process.GetUniqueID():
+        cache = MemoryCache(process, counters=totals)
+    return cache
+
+
+def counters() -> Dict[str, int]:
+    '''
+    Counters of the shared caches of all processes so far. A page read from the
+    cache is a hit; memory_cache_reads is the number of ReadMemory calls.
+    '''
+    return dict(totals)
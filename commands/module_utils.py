@@ -0,0 +1,63 @@
+'''
+Helpers to access modules through the SB API, shared by the tracing commands
+'''
+
+import lldb
+import fnmatch
+import os
+from typing import List, Optional, Tuple
+
+
+def get_module_path(module: lldb.SBModule) -> str:
+    file_spec = module.GetFileSpec()
+    return os.path.join(file_spec.GetDirectory() or "", file_spec.GetFilename())
+
+
+def get_image_base(target: lldb.SBTarget, module: lldb.SBModule) -> int:
+    return module.GetObjectFileHeaderAddress().GetLoadAddress(target)
+
+
+def is_loaded(target: lldb.SBTarget, module: lldb.SBModule) -> bool:
+    return get_image_base(target, module) != lldb.LLDB_INVALID_ADDRESS
+
+
+def parse_module_patterns(values: List[str]) -> List[str]:
+    '''
+    Splits the values of a repeatable, comma separated -m/--module option
+    '''
+    return [pattern for value in values for pattern in value.split(",") if pattern]
+
+
+def module_matches(module: lldb.SBModule, patterns: List[str]) -> bool:
+    name = module.GetFileSpec().GetFilename()
+    path = get_module_path(module)
+    return any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(path, pattern) for pattern in patterns)
+
+
+def get_text_section(module: lldb.SBModule) -> Optional[lldb.SBSection]:
+    section = module.FindSection("__TEXT")
+    if section.IsValid():
+        section = section.FindSubSection("__text")
+    else:
+        section = module.FindSection(".text")
+    return section if section.IsValid() else None
+
+
+def read_text_section(target: lldb.SBTarget, module: lldb.SBModule) -> Tuple[bytes, int]:
+    '''
+    Reads the bytes of the text section through the SB API. This also works for
+    modules which only exist in the dyld shared cache.
+    '''
+    section = get_text_section(module)
+    if section is None:
+        raise ValueError(f"Text section is not found in {module.GetFileSpec().GetFilename()}")
+
+    error = lldb.SBError()
+    section_data: lldb.SBData = section.GetSectionData()
+    data = section_data.ReadRawData(error, 0, section_data.GetByteSize())
+    if not error.Success():
+        raise ValueError(f"Cannot read text section: {error.GetCString()}")
+    address = section.GetLoadAddress(target)
+    if address == lldb.LLDB_INVALID_ADDRESS:
+        address = section.GetFileAddress()
+    return data, address
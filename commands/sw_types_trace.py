@@ -3,13 +3,115 @@ import os
 import shlex
 import optparse
 import json
+import struct
 import sys
-from typing import Tuple, Optional
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Set, Tuple, Optional
+
+import analysis_cache
+import branch_scanner
+import memory_cache
+import trace_stats
+from module_utils import get_image_base, get_module_path, is_loaded, module_matches, parse_module_patterns, read_text_section
+from symbol_index import SymbolIndex
 
 
 FILE_NAME = os.path.basename(__file__)[:-3]
-type_metadata = list()
-target_module_addr = tuple()
+target_module_patterns: List[str] = []
+target_module_matches: Dict[str, bool] = {}  # module path -> matches target_module_patterns
+symbols: Optional[SymbolIndex] = None
+call_site_return_addresses: Dict[int, int] = {}
+type_name_cache: Dict[int, Optional[str]] = {}
+type_name_tables: Dict[str, Optional[Dict[str, str]]] = {}  # module path -> {image-relative offset: type name}
+module_file_hashes: Dict[str, Optional[str]] = {}
+module_cache_kinds: Dict[str, str] = {}
+updated_type_name_tables: Set[str] = set()
+use_expression = False
+stats = trace_stats.TraceStats(memory_cache.counters)
+
+ARGUMENT_REGISTERS = {
+    "x86_64": "rdi",
+    "x86_64h": "rdi",
+    "arm64": "x0",
+    "arm64e": "x0",
+    "aarch64": "x0",
+}
+METADATA_SYMBOL_PREFIXES = (
+    "full type metadata for ",
+    "type metadata for ",
+    "OBJC_CLASS_$_",
+    "_OBJC_CLASS_$_",
+)
+MAX_METADATA_KIND = 0x7ff  # larger values are isa pointers of class metadata
+METADATA_KIND_STRUCT = 0x200
+METADATA_KIND_ENUM = 0x201
+METADATA_KIND_OPTIONAL = 0x202
+CLASS_METADATA_DESCRIPTION_OFFSET = 0x40
+VALUE_METADATA_DESCRIPTION_OFFSET = 0x8
+CONTEXT_DESCRIPTOR_KIND_MODULE = 0
+CONTEXT_DESCRIPTOR_KIND_EXTENSION = 1
+CONTEXT_DESCRIPTOR_KIND_ANONYMOUS = 2
+MAX_CONTEXT_DEPTH = 8
+MAX_TYPE_NAME_LENGTH = 1024
+ALLOCATION_FUNCTIONS = {
+    "swift_allocObject": "break_on_swift_allocObject",
+    "swift_initStackObject": "break_on_swift_initStackObject",
+}
+
+
+@dataclass
+class TypeRecord:
+    count: int
+    first_seen: float
+    last_seen: float
+
+
+class TypeMetadataStore:
+    '''
+    Aggregates allocations by (callsite, type). A call site is regarded as stable
+    after stable_hits allocations without a new type.
+    '''
+
+    def __init__(self, stable_hits: int = 0):
+        self.stable_hits = stable_hits
+        self.records: Dict[Tuple[int, str], TypeRecord] = {}
+        self.callsite_types: Dict[int, Set[str]] = {}
+        self.hits_without_new_type: Dict[int, int] = {}
+
+    def add(self, callsite: int, type_name: str) -> bool:
+        '''
+        Returns True if the type set of the call site is stable
+        '''
+        now = time.time()
+        record = self.records.get((callsite, type_name))
+        if record is None:
+            self.records[(callsite, type_name)] = TypeRecord(count=1, first_seen=now, last_seen=now)
+            self.callsite_types.setdefault(callsite, set()).add(type_name)
+            self.hits_without_new_type[callsite] = 0
+            return False
+        record.count += 1
+        record.last_seen = now
+        self.hits_without_new_type[callsite] += 1
+        return 0 < self.stable_hits <= self.hits_without_new_type[callsite]
+
+    def aggregate(self) -> List[dict]:
+        return [{"callsite": callsite, "type": type_name, "count": record.count,
+                 "first_seen": record.first_seen, "last_seen": record.last_seen}
+                for (callsite, type_name), record in self.records.items()]
+
+    def legacy(self, unique: bool = False) -> List[Tuple[int, str]]:
+        '''
+        (return address, type name) list of the old format: one entry per
+        allocation, grouped by pair in the order the pairs were first seen.
+        With unique, each pair is listed once.
+        '''
+        if unique:
+            return list(self.records.keys())
+        return [pair for pair, record in self.records.items() for _ in range(record.count)]
+
+
+type_metadata = TypeMetadataStore()
 
 
 def is_numeric_string(s: str):
@@ -21,18 +123,43 @@ def is_numeric_string(s: str):
 
 
 def is_in_target_module(addr: int):
-    return target_module_addr[0] <= addr < target_module_addr[1]
+    # modules are matched when they are first seen, so they may be loaded after swtt_set_bps
+    if (module := symbols.find_module(addr)) is None:
+        return False
+    if module.path not in target_module_matches:
+        target_module_matches[module.path] = module_matches(module.module, target_module_patterns)
+    return target_module_matches[module.path]
 
 
-def evaluate_type_metadata(debugger: lldb.SBDebugger, thread: lldb.SBThread) -> Optional[Tuple[int, int]]:
-    interpreter = debugger.GetCommandInterpreter()
+def evaluate_type_metadata(debugger: lldb.SBDebugger, thread: lldb.SBThread) -> Optional[Tuple[int, str]]:
     return_address = thread.GetFrameAtIndex(1).GetPC()
+    return evaluate_type_metadata_at(debugger, thread.GetFrameAtIndex(0), return_address)
+
 
+def evaluate_type_metadata_at(debugger: lldb.SBDebugger, frame: lldb.SBFrame, return_address: int) -> Optional[Tuple[int, str]]:
+    '''
+    frame is either the entry of an allocation function or a call site of it.
+    The first argument register holds the type metadata in both cases.
+    '''
     if not is_in_target_module(return_address):
         return None
 
+    if use_expression:
+        return evaluate_type_metadata_with_expression(debugger, return_address)
+
+    metadata = get_first_argument(frame)
+    if metadata is None or (type_name := resolve_type_name(frame.GetThread().GetProcess(), metadata)) is None:
+        return None
+    return return_address, type_name
+
+
+def evaluate_type_metadata_with_expression(debugger: lldb.SBDebugger, return_address: int) -> Optional[Tuple[int, str]]:
+    '''
+    Legacy resolver. This JIT-compiles an expression per allocation, so it is very slow
+    '''
+    interpreter = debugger.GetCommandInterpreter()
     res = lldb.SBCommandReturnObject()
-    expression = f'expression -lobjc -O -- $arg1'
+    expression = 'expression -lobjc -O -- $arg1'
     interpreter.HandleCommand(expression, res)
     if res.HasResult():
         type_metadata = res.GetOutput().replace('\n', '')
@@ -43,36 +170,223 @@ def evaluate_type_metadata(debugger: lldb.SBDebugger, thread: lldb.SBThread) ->
     return None
 
 
+def get_first_argument(frame: lldb.SBFrame) -> Optional[int]:
+    arch = frame.GetThread().GetProcess().GetTarget().GetTriple().split('-')[0]
+    if (register_name := ARGUMENT_REGISTERS.get(arch)) is None:
+        return None
+    return frame.FindRegister(register_name).GetValueAsUnsigned()
+
+
+def resolve_type_name(process: lldb.SBProcess, metadata: int) -> Optional[str]:
+    '''
+    Resolves a type metadata address to "Module.Type". Each address is resolved once per session.
+    '''
+    if metadata in type_name_cache:
+        return type_name_cache[metadata]
+    target = process.GetTarget()
+    # metadata emitted in a module is also cached across sessions by its image-relative offset
+    module: lldb.SBModule = target.ResolveLoadAddress(metadata).GetModule()
+    module_path = get_module_path(module) if module.IsValid() else None
+    table = None if module_path is None else get_type_name_table(target, module)
+    offset = None if table is None else str(metadata - get_image_base(target, module))
+    if table is not None and offset in table:
+        type_name = table[offset]
+    else:
+        type_name = get_type_name_from_symbol(target, metadata)
+        if type_name is None:
+            type_name = read_type_name_from_descriptor(process, metadata)
+        if table is not None and type_name is not None:
+            table[offset] = type_name
+            updated_type_name_tables.add(module_path)
+    type_name_cache[metadata] = type_name
+    return type_name
+
+
+def get_type_name_table(target: lldb.SBTarget, module: lldb.SBModule) -> Optional[Dict[str, str]]:
+    module_path = get_module_path(module)
+    if module_path not in type_name_tables:
+        module_file_hashes[module_path] = analysis_cache.hash_file(module_path)
+        module_cache_kinds[module_path] = analysis_cache.get_kind("type_names", target)
+        if module_file_hashes[module_path] is None:
+            type_name_tables[module_path] = None
+        else:
+            type_name_tables[module_path] = analysis_cache.load(module_cache_kinds[module_path], module_file_hashes[module_path]) or {}
+    return type_name_tables[module_path]
+
+
+def store_type_name_tables():
+    for module_path in updated_type_name_tables:
+        analysis_cache.store(module_cache_kinds[module_path], module_file_hashes[module_path], type_name_tables[module_path])
+    updated_type_name_tables.clear()
+
+
+def get_type_name_from_symbol(target: lldb.SBTarget, metadata: int) -> Optional[str]:
+    symbol: lldb.SBSymbol = target.ResolveLoadAddress(metadata).GetSymbol()
+    if not symbol.IsValid() or (name := symbol.GetName()) is None:
+        return None
+    for prefix in METADATA_SYMBOL_PREFIXES:
+        if name.startswith(prefix):
+            return name[len(prefix):]
+    return None
+
+
+def read_memory(process: lldb.SBProcess, address: int, size: int) -> Optional[bytes]:
+    stats.count("memory_reads")
+    return memory_cache.get_cache(process).read(address, size)
+
+
+def read_pointer(process: lldb.SBProcess, address: int) -> Optional[int]:
+    stats.count("memory_reads")
+    return memory_cache.get_cache(process).read_pointer(address)
+
+
+def read_relative_pointer(process: lldb.SBProcess, address: int, indirectable: bool = False) -> Optional[int]:
+    if (data := read_memory(process, address, 4)) is None:
+        return None
+    (offset,) = struct.unpack("<i", data)
+    if offset == 0:
+        return None
+    if not indirectable or offset & 1 == 0:
+        return address + offset
+    return read_pointer(process, address + (offset & ~1))
+
+
+def read_type_name_from_descriptor(process: lldb.SBProcess, metadata: int) -> Optional[str]:
+    '''
+    Reads the name of a type from its nominal type descriptor, walking the
+    parent contexts to qualify it with the module (and enclosing type) names.
+    The reads go through the page cache, so the descriptors and names which
+    share pages cost one ReadMemory call per page.
+    '''
+    if (kind := read_pointer(process, metadata)) is None:
+        return None
+    if kind > MAX_METADATA_KIND:
+        description_offset = CLASS_METADATA_DESCRIPTION_OFFSET
+    elif kind in (METADATA_KIND_STRUCT, METADATA_KIND_ENUM, METADATA_KIND_OPTIONAL):
+        description_offset = VALUE_METADATA_DESCRIPTION_OFFSET
+    else:
+        return None
+    if not (descriptor := read_pointer(process, metadata + description_offset)):
+        return None
+
+    names = []
+    for _ in range(MAX_CONTEXT_DEPTH):
+        if (data := read_memory(process, descriptor, 4)) is None:
+            return None
+        context_kind = struct.unpack("<I", data)[0] & 0x1f
+        if context_kind not in (CONTEXT_DESCRIPTOR_KIND_EXTENSION, CONTEXT_DESCRIPTOR_KIND_ANONYMOUS):
+            if (name_address := read_relative_pointer(process, descriptor + 8)) is None:
+                return None
+            stats.count("memory_reads")
+            if (name := memory_cache.get_cache(process).read_c_string(name_address, MAX_TYPE_NAME_LENGTH)) is None:
+                return None
+            names.append(name.decode(errors="replace"))
+        if context_kind == CONTEXT_DESCRIPTOR_KIND_MODULE:
+            break
+        if (descriptor := read_relative_pointer(process, descriptor + 4, indirectable=True)) is None:
+            break
+    return ".".join(reversed(names)) if names else None
+
+
+@trace_stats.timed_callback(stats)
 def break_on_swift_allocObject(frame: lldb.SBFrame, bp_loc: lldb.SBAddress, dict: dict):
     if (res := evaluate_type_metadata(frame.GetThread().GetProcess().GetTarget().GetDebugger(), frame.GetThread())) is None:
         return False
-    type_metadata.append(res)
+    type_metadata.add(*res)
     return False
 
 
+@trace_stats.timed_callback(stats)
 def break_on_swift_initStackObject(frame: lldb.SBFrame, bp_loc: lldb.SBAddress, dict: dict):
     if (res := evaluate_type_metadata(frame.GetThread().GetProcess().GetTarget().GetDebugger(), frame.GetThread())) is None:
         return False
-    type_metadata.append(res)
+    type_metadata.add(*res)
+    return False
+
+
+@trace_stats.timed_callback(stats)
+def break_on_allocation_call_site(frame: lldb.SBFrame, bp_loc: lldb.SBBreakpointLocation, dict: dict):
+    return_address = call_site_return_addresses.get(frame.GetPC())
+    if return_address is None:
+        # tail call: the allocation function returns to the caller of this frame
+        return_address = frame.GetThread().GetFrameAtIndex(1).GetPC()
+    if (res := evaluate_type_metadata_at(frame.GetThread().GetProcess().GetTarget().GetDebugger(), frame, return_address)) is None:
+        return False
+    if type_metadata.add(*res):
+        # the types allocated at this call site are stable
+        bp_loc.SetEnabled(False)
     return False
 
 
 def __lldb_init_module(debugger: lldb.SBDebugger, internal_dict: dict):
     debugger.HandleCommand(f'command script add -f {FILE_NAME}.set_bps swtt_set_bps -h "Set breakpoints on swift_allocObject and swift_initStackObject to obtain type metadata"')
     debugger.HandleCommand(f'command script add -f {FILE_NAME}.save swtt_save -h "Save the collected trace data to a file"')
+    debugger.HandleCommand(f'command script add -f {FILE_NAME}.show_stats swtt_stats -h "Show hit counts and callback latency of allocation breakpoints"')
+
+
+def show_stats(debugger: lldb.SBDebugger, command: str, exe_ctx: lldb.SBExecutionContext, result: lldb.SBCommandReturnObject, internal_dict: dict):
+    trace_stats.handle_stats_command(debugger, command, result, stats, "swtt_stats")
 
 
 def save(debugger: lldb.SBDebugger, command: str, exe_ctx: lldb.SBExecutionContext, result: lldb.SBCommandReturnObject, internal_dict: dict):
-    with open("/tmp/type_metadata_trace.json", "w") as f:
-        json.dump(type_metadata, f)
-    print("Saved to /tmp/type_metadata_trace.json")
+    command_args = shlex.split(command, posix=False)
+    parser = generate_save_option_parser()
+    try:
+        (options, args) = parser.parse_args(command_args)
+    except:
+        result.SetError(parser.usage)
+        return
 
+    if options.format == "aggregate":
+        file_name = options.output or "/tmp/type_metadata_aggregate.json"
+        data = type_metadata.aggregate()
+    else:
+        file_name = options.output or "/tmp/type_metadata_trace.json"
+        data = type_metadata.legacy(options.unique)
+    with open(file_name, "w") as f:
+        json.dump(data, f)
+    store_type_name_tables()
+    print(f"Saved to {file_name}")
 
-def get_text_segment_address_range(module: lldb.SBModule, target: lldb.SBTarget) -> Optional[Tuple[int, int]]:
-    for sec in module.sections:
-        if sec.GetName() == "__TEXT":
-            return (sec.GetFileAddress(), sec.GetFileAddress() + sec.size)
-    return None
+
+def get_allocation_function_name(target: lldb.SBTarget, address: int) -> Optional[str]:
+    symbol: lldb.SBSymbol = target.ResolveLoadAddress(address).GetSymbol()
+    if not symbol.IsValid() or symbol.GetStartAddress().GetLoadAddress(target) != address:
+        return None
+    name = (symbol.GetName() or "").removesuffix("@plt")
+    return name if name in ALLOCATION_FUNCTIONS else None
+
+
+def find_allocation_call_sites(target: lldb.SBTarget, module: lldb.SBModule) -> Dict[str, List[branch_scanner.DirectBranch]]:
+    '''
+    Finds direct calls (and tail calls) of the allocation functions, including
+    the ones through symbol stubs, in the text section of the module
+    '''
+    arch = target.GetTriple().split('-')[0]
+    decoder = branch_scanner.get_decoder(arch)
+    if decoder is None:
+        raise ValueError(f"No decoder for {arch}")
+    data, address = read_text_section(target, module)
+
+    destination_names: Dict[int, Optional[str]] = {}
+    call_sites = {name: [] for name in ALLOCATION_FUNCTIONS}
+    for branch in decoder.iter_direct_branches(data, address):
+        if branch.destination not in destination_names:
+            destination_names[branch.destination] = get_allocation_function_name(target, branch.destination)
+        if (name := destination_names[branch.destination]) is not None:
+            call_sites[name].append(branch)
+    return call_sites
+
+
+def set_call_site_bps(target: lldb.SBTarget, modules: List[lldb.SBModule]):
+    for module in modules:
+        for name, branches in find_allocation_call_sites(target, module).items():
+            for branch in branches:
+                if branch.kind == "call":
+                    call_site_return_addresses[branch.address] = branch.address + branch.size
+                bp = target.BreakpointCreateByAddress(branch.address)
+                bp.SetScriptCallbackFunction(f"{FILE_NAME}.break_on_allocation_call_site")
+            print(f"{len(branches)} call sites of {name} in {module.GetFileSpec().GetFilename()}")
 
 
 def set_bps(debugger: lldb.SBDebugger, command: str, exe_ctx: lldb.SBExecutionContext, result: lldb.SBCommandReturnObject, internal_dict: dict):
@@ -84,28 +398,89 @@ def set_bps(debugger: lldb.SBDebugger, command: str, exe_ctx: lldb.SBExecutionCo
         result.SetError(parser.usage)
         return
 
+    global use_expression, type_metadata
+    use_expression = options.expression
+    type_metadata = TypeMetadataStore(options.stable_hits)
+    stats.clear()
+
     target = debugger.GetSelectedTarget()
-    bp = target.BreakpointCreateByName("swift_allocObject")
-    bp.SetScriptCallbackFunction(f"{FILE_NAME}.break_on_swift_allocObject")
-    bp = target.BreakpointCreateByName("swift_initStackObject")
-    bp.SetScriptCallbackFunction(f"{FILE_NAME}.break_on_swift_initStackObject")
-    print("Breakpoints are set. Please continue execution and run \"swtt_save\" command to save the collected data")
+    global symbols, target_module_patterns
+    target_module_patterns = parse_module_patterns(options.modules)
+    if not target_module_patterns:
+        target_module_patterns = [target.GetModuleAtIndex(0).GetFileSpec().GetFilename()]
+    target_module_matches.clear()
+    if symbols is not None:
+        symbols.close()
+    symbols = SymbolIndex(target)
 
-    global target_module_addr
-    main_module: lldb.SBModule = target.GetModuleAtIndex(0)
-    if (main_module_address_range := get_text_segment_address_range(main_module, target)) is None:
-        print("Cannot find __TEXT segment?", file=sys.stderr)
-    target_module_addr = main_module_address_range
+    if options.call_sites:
+        # call sites are found in the loaded code of the modules
+        target_modules = []
+        for module in target.module_iter():
+            if not module_matches(module, target_module_patterns):
+                continue
+            if not is_loaded(target, module):
+                print(f"{module.GetFileSpec().GetFilename()} is not loaded. Is the process running?", file=sys.stderr)
+                continue
+            target_modules.append(module)
+        if not target_modules:
+            result.SetError(f"No loaded module matches {', '.join(target_module_patterns)}")
+            return
+        set_call_site_bps(target, target_modules)
+    else:
+        # set by name, so this works before the process is launched
+        for name, callback in ALLOCATION_FUNCTIONS.items():
+            bp = target.BreakpointCreateByName(name)
+            bp.SetScriptCallbackFunction(f"{FILE_NAME}.{callback}")
+    print("Breakpoints are set. Please continue execution and run \"swtt_save\" command to save the collected data")
 
 
 def generate_option_parser():
-    # TODO: support module option (not implemented yet)
     usage = "usage: %prog [options]"
     parser = optparse.OptionParser(usage=usage, prog=FILE_NAME)
     parser.add_option("-m", "--module",
+                      action="append",
+                      default=[],
+                      dest="modules",
+                      help="Module names or glob patterns (comma separated, can be repeated) whose allocations are recorded. Default: main module")
+    parser.add_option("-c", "--call-sites",
+                      action="store_true",
+                      default=False,
+                      dest="call_sites",
+                      help="Set breakpoints at the call sites of swift_allocObject/swift_initStackObject in the target modules instead of the functions themselves")
+    parser.add_option("-e", "--expression",
+                      action="store_true",
+                      default=False,
+                      dest="expression",
+                      help="Resolve type names by evaluating expressions (slow) instead of reading type metadata")
+    parser.add_option("-s", "--stable-hits",
+                      action="store",
+                      type="int",
+                      default=0,
+                      dest="stable_hits",
+                      help="With --call-sites, disable a call site after this many allocations without a new type (0: never)")
+    return parser
+
+
+def generate_save_option_parser():
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage, prog="swtt_save")
+    parser.add_option("-f", "--format",
+                      action="store",
+                      type="choice",
+                      choices=["legacy", "aggregate"],
+                      default="legacy",
+                      dest="format",
+                      help="legacy: [return address, type name] list for the Binja Swift Analyzer plugin (default), "
+                           "aggregate: per (callsite, type) counts and first/last-seen timestamps")
+    parser.add_option("-o", "--output",
                       action="store",
                       default=None,
-                      dest="module",
-                      help="Module name to set breakpoints")
+                      dest="output",
+                      help="Output file (default: /tmp/type_metadata_trace.json, or /tmp/type_metadata_aggregate.json)")
+    parser.add_option("-u", "--unique",
+                      action="store_true",
+                      default=False,
+                      dest="unique",
+                      help="With the legacy format, write each [return address, type name] pair once instead of once per allocation")
     return parser
-    
@@ -0,0 +1,657 @@
+'''
+Dumps Swift objects by reading their metadata, nominal type descriptors and
+field descriptors directly from process memory, instead of compiling a Swift
+expression per object. This also works on stripped targets.
+
+The layout of a type (type name, field names, offsets and types) is read once
+per metadata address and cached while the process lives. An object is then
+read with one memory read of its instance size.
+
+NOTE: 64-bit little-endian targets only. Enum payloads and resilient class
+hierarchies are shown as raw bytes.
+'''
+
+import lldb
+import optparse
+import os
+import shlex
+import struct
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set, Tuple
+
+import memory_cache
+
+
+FILE_NAME = os.path.basename(__file__)[:-3]
+MAX_METADATA_KIND = 0x7ff  # larger values are isa pointers of class metadata
+METADATA_KIND_CLASS = 0
+METADATA_KIND_STRUCT = 0x200
+METADATA_KIND_ENUM = 0x201
+METADATA_KIND_OPTIONAL = 0x202
+VALUE_METADATA_DESCRIPTION_OFFSET = 0x8
+CONTEXT_DESCRIPTOR_KIND_MODULE = 0
+CONTEXT_DESCRIPTOR_KIND_EXTENSION = 1
+CONTEXT_DESCRIPTOR_KIND_ANONYMOUS = 2
+CONTEXT_DESCRIPTOR_KIND_CLASS = 16
+CONTEXT_DESCRIPTOR_KIND_STRUCT = 17
+CONTEXT_DESCRIPTOR_KIND_ENUM = 18
+CLASS_HAS_RESILIENT_SUPERCLASS = 1 << (16 + 13)
+CLASS_DESCRIPTOR_SIZE = 44
+STRUCT_DESCRIPTOR_SIZE = 28
+FIELD_DESCRIPTOR_HEADER_SIZE = 16
+VALUE_WITNESS_SIZE_OFFSET = 64
+VALUE_WITNESS_FLAGS_OFFSET = 80
+VALUE_WITNESS_ALIGNMENT_MASK = 0xff
+VALUE_WITNESS_IS_NON_INLINE = 0x20000
+HEAP_OBJECT_HEADER_SIZE = 16
+ARRAY_COUNT_OFFSET = 16
+ARRAY_ELEMENTS_OFFSET = 32
+EXISTENTIAL_BUFFER_SIZE = 24
+STRING_IS_SMALL = 0x2000000000000000
+STRING_SMALL_COUNT_SHIFT = 56
+STRING_OBJECT_ADDRESS_MASK = 0x0fffffffffffffff
+STRING_COUNT_MASK = 0x0000ffffffffffff
+STRING_NATIVE_BIAS = 32
+MAX_CONTEXT_DEPTH = 8
+MAX_CLASS_DEPTH = 16
+MAX_NAME_LENGTH = 1024
+MAX_MANGLED_NAME_LENGTH = 128
+MAX_INSTANCE_SIZE = 0x10000
+MAX_STRING_LENGTH = 1024
+
+# mangled name -> (name, struct format)
+STANDARD_TYPES = {
+    "Si": ("Int", "<q"),
+    "Su": ("UInt", "<Q"),
+    "Sd": ("Double", "<d"),
+    "Sf": ("Float", "<f"),
+    "Sb": ("Bool", "<?"),
+    "s4Int8V": ("Int8", "<b"),
+    "s5UInt8V": ("UInt8", "<B"),
+    "s5Int16V": ("Int16", "<h"),
+    "s6UInt16V": ("UInt16", "<H"),
+    "s5Int32V": ("Int32", "<i"),
+    "s6UInt32V": ("UInt32", "<I"),
+    "s5Int64V": ("Int64", "<q"),
+    "s6UInt64V": ("UInt64", "<Q"),
+}
+
+
+@dataclass(frozen=True)
+class ClassMetadataOffsets:
+    instance_size: int
+    description: int
+
+
+# class metadata has 3 more words (cache, vtable, rodata) with Objective-C interop
+OBJC_INTEROP_CLASS_METADATA = ClassMetadataOffsets(instance_size=0x30, description=0x40)
+NATIVE_CLASS_METADATA = ClassMetadataOffsets(instance_size=0x18, description=0x28)
+
+
+@dataclass(frozen=True)
+class FieldType:
+    name: str
+    kind: str  # "scalar", "string", "reference", "array", "optional", "value"
+    format: Optional[str] = None
+    element: Optional["FieldType"] = None
+
+    @property
+    def stride(self) -> Optional[int]:
+        if self.kind == "scalar":
+            return struct.calcsize(self.format)
+        if self.kind == "string":
+            return 16
+        if self.kind in ("reference", "array"):
+            return 8
+        return None
+
+
+@dataclass
+class Field:
+    name: str
+    offset: int
+    size: int
+    type: FieldType
+
+
+@dataclass
+class Layout:
+    name: str
+    kind: str  # "class", "struct", "enum"
+    size: int
+    fields: List[Field]
+    note: Optional[str] = None
+
+
+layouts: Dict[int, Optional[Layout]] = {}
+descriptor_names: Dict[int, Tuple[Optional[str], int]] = {}
+layouts_process_id: Optional[int] = None
+
+
+def __lldb_init_module(debugger: lldb.SBDebugger, internal_dict: dict):
+    debugger.HandleCommand(f'command script add -f {FILE_NAME}.sdump sdump -h "Print the contents of Swift objects"')
+    debugger.HandleCommand(f'command script add -f {FILE_NAME}.dump_boxed_array dump_boxed_array -h "Print the contents of the elements of an existential array"')
+    debugger.HandleCommand(f'command script add -f {FILE_NAME}.p_boxed_array p_boxed_array -h "Print the types and addresses of the elements of an existential array"')
+
+
+class Reader:
+    '''
+    Typed reads through the page cache of memory_cache, so the objects, metadata
+    and names in the same pages cost one ReadMemory call per page
+    '''
+
+    def __init__(self, process: lldb.SBProcess):
+        self.process = process
+        self.cache = memory_cache.get_cache(process)
+        triple = process.GetTarget().GetTriple()
+        self.class_offsets = OBJC_INTEROP_CLASS_METADATA if "-apple-" in triple else NATIVE_CLASS_METADATA
+
+    def read(self, address: int, size: int) -> Optional[bytes]:
+        return self.cache.read(address, size)
+
+    def read_pointer(self, address: int) -> Optional[int]:
+        return self.cache.read_pointer(address)
+
+    def read_u32(self, address: int) -> Optional[int]:
+        return self.cache.read_u32(address)
+
+    def read_relative_pointer(self, address: int, indirectable: bool = False) -> Optional[int]:
+        if (offset := self.cache.read_i32(address)) is None:
+            return None
+        return resolve_relative_pointer(self, address, offset, indirectable)
+
+    def read_c_string(self, address: int, max_length: int = MAX_NAME_LENGTH) -> Optional[str]:
+        if (string := self.cache.read_c_string(address, max_length)) is None:
+            return None
+        return string.decode(errors="replace")
+
+
+def resolve_relative_pointer(reader: Reader, address: int, offset: int, indirectable: bool = False) -> Optional[int]:
+    if offset == 0:
+        return None
+    if not indirectable or offset & 1 == 0:
+        return address + offset
+    return reader.read_pointer(address + (offset & ~1))
+
+
+def reset_caches_for(process: lldb.SBProcess):
+    '''
+    Layouts are keyed by metadata addresses, which are only valid in one process
+    '''
+    global layouts_process_id
+    if process.GetUniqueID() != layouts_process_id:
+        layouts.clear()
+        descriptor_names.clear()
+        layouts_process_id = process.GetUniqueID()
+
+
+def read_descriptor_name(reader: Reader, descriptor: int) -> Tuple[Optional[str], int]:
+    '''
+    Returns the name of a nominal type descriptor qualified with the module (and
+    enclosing type) names, and the kind of the descriptor
+    '''
+    if descriptor in descriptor_names:
+        return descriptor_names[descriptor]
+    names = []
+    kind = -1
+    context = descriptor
+    for depth in range(MAX_CONTEXT_DEPTH):
+        if (flags := reader.read_u32(context)) is None:
+            break
+        context_kind = flags & 0x1f
+        if depth == 0:
+            kind = context_kind
+        if context_kind not in (CONTEXT_DESCRIPTOR_KIND_EXTENSION, CONTEXT_DESCRIPTOR_KIND_ANONYMOUS):
+            name_address = reader.read_relative_pointer(context + 8)
+            if name_address is None or (name := reader.read_c_string(name_address)) is None:
+                break
+            names.append(name)
+        if context_kind == CONTEXT_DESCRIPTOR_KIND_MODULE:
+            break
+        if (context := reader.read_relative_pointer(context + 4, indirectable=True)) is None:
+            break
+    descriptor_names[descriptor] = (".".join(reversed(names)) if names else None, kind)
+    return descriptor_names[descriptor]
+
+
+def read_mangled_name(reader: Reader, address: int) -> Tuple[str, Dict[str, Tuple[Optional[str], int]]]:
+    '''
+    Reads a mangled type name. Symbolic references to type descriptors are
+    replaced with private use characters, which map to (name, descriptor kind).
+    '''
+    data = reader.read(address, MAX_MANGLED_NAME_LENGTH) or reader.read(address, 16) or b""
+    chars = []
+    references = {}
+    pos = 0
+    while pos < len(data) and data[pos] != 0:
+        byte = data[pos]
+        if 0x01 <= byte <= 0x17:
+            if pos + 5 > len(data):
+                break
+            offset = struct.unpack_from("<i", data, pos + 1)[0]
+            reference = chr(0xe000 + len(references))
+            descriptor = None
+            if byte == 0x01:
+                descriptor = address + pos + 1 + offset
+            elif byte == 0x02:
+                descriptor = reader.read_pointer(address + pos + 1 + offset)
+            references[reference] = (None, -1) if descriptor is None else read_descriptor_name(reader, descriptor)
+            chars.append(reference)
+            pos += 5
+        elif 0x18 <= byte <= 0x1f:
+            references[reference := chr(0xe000 + len(references))] = (None, -1)
+            chars.append(reference)
+            pos += 9
+        else:
+            chars.append(chr(byte))
+            pos += 1
+    return "".join(chars), references
+
+
+def parse_field_type(mangled: str, references: Dict[str, Tuple[Optional[str], int]]) -> FieldType:
+    if mangled in STANDARD_TYPES:
+        name, format = STANDARD_TYPES[mangled]
+        return FieldType(name=name, kind="scalar", format=format)
+    if mangled == "SS":
+        return FieldType(name="String", kind="string")
+    if mangled == "yXl":
+        return FieldType(name="AnyObject", kind="reference")
+    if mangled.endswith("Sg") and len(mangled) > 2:
+        wrapped = parse_field_type(mangled[:-2], references)
+        return FieldType(name=f"{wrapped.name}?", kind="optional", element=wrapped)
+    if mangled.startswith("Say") and mangled.endswith("G"):
+        element = parse_field_type(mangled[3:-1], references)
+        return FieldType(name=f"[{element.name}]", kind="array", element=element)
+    if mangled in references:
+        name, kind = references[mangled]
+        return FieldType(name=name or "?", kind="reference" if kind == CONTEXT_DESCRIPTOR_KIND_CLASS else "value")
+    return FieldType(name="".join(references[c][0] or "?" if c in references else c for c in mangled) or "?", kind="value")
+
+
+def read_fields(reader: Reader, descriptor: int, offsets: List[int]) -> List[Tuple[str, int, FieldType]]:
+    '''
+    Reads the field records of the field descriptor of a type descriptor.
+    Returns (name, offset, type) of each stored property.
+    '''
+    field_descriptor = reader.read_relative_pointer(descriptor + 16)
+    if field_descriptor is None or (header := reader.read(field_descriptor, FIELD_DESCRIPTOR_HEADER_SIZE)) is None:
+        return []
+    record_size, num_records = struct.unpack_from("<HI", header, 10)
+    num_records = min(num_records, len(offsets))
+    records = reader.read(field_descriptor + FIELD_DESCRIPTOR_HEADER_SIZE, record_size * num_records) if num_records else b""
+    if records is None:
+        return []
+    fields = []
+    for i in range(num_records):
+        record = field_descriptor + FIELD_DESCRIPTOR_HEADER_SIZE + i * record_size
+        _, type_offset, name_offset = struct.unpack_from("<Iii", records, i * record_size)
+        name_address = resolve_relative_pointer(reader, record + 8, name_offset)
+        name = (reader.read_c_string(name_address) if name_address is not None else None) or f"field{i}"
+        type_address = resolve_relative_pointer(reader, record + 4, type_offset)
+        field_type = parse_field_type(*read_mangled_name(reader, type_address)) if type_address is not None else FieldType(name="?", kind="value")
+        fields.append((name, offsets[i], field_type))
+    return fields
+
+
+def make_fields(fields: List[Tuple[str, int, FieldType]], size: int) -> List[Field]:
+    '''
+    The size of a field is up to the next field (or the end of the instance)
+    '''
+    fields = sorted(fields, key=lambda field: field[1])
+    ends = [offset for _, offset, _ in fields[1:]] + [size]
+    return [Field(name=name, offset=offset, size=max(0, end - offset), type=field_type)
+            for (name, offset, field_type), end in zip(fields, ends)]
+
+
+def get_layout(reader: Reader, metadata: int) -> Optional[Layout]:
+    if metadata not in layouts:
+        layouts[metadata] = read_layout(reader, metadata)
+    return layouts[metadata]
+
+
+def read_layout(reader: Reader, metadata: int) -> Optional[Layout]:
+    if (kind := reader.read_pointer(metadata)) is None:
+        return None
+    if kind == METADATA_KIND_CLASS or kind > MAX_METADATA_KIND:
+        return read_class_layout(reader, metadata)
+    if kind not in (METADATA_KIND_STRUCT, METADATA_KIND_ENUM, METADATA_KIND_OPTIONAL):
+        return None
+    descriptor = reader.read_pointer(metadata + VALUE_METADATA_DESCRIPTION_OFFSET)
+    size = get_value_size(reader, metadata)
+    if not descriptor or size is None:
+        return None
+    name, descriptor_kind = read_descriptor_name(reader, descriptor)
+    if descriptor_kind != CONTEXT_DESCRIPTOR_KIND_STRUCT:
+        return Layout(name=name or "?", kind="enum", size=size, fields=[])
+    if (header := reader.read(descriptor, STRUCT_DESCRIPTOR_SIZE)) is None:
+        return None
+    num_fields, field_offset_vector = struct.unpack_from("<II", header, 20)
+    offsets = reader.read(metadata + 8 * field_offset_vector, 4 * num_fields) if num_fields else b""
+    if offsets is None:
+        return None
+    fields = read_fields(reader, descriptor, list(struct.unpack(f"<{num_fields}I", offsets)))
+    return Layout(name=name or "?", kind="struct", size=size, fields=make_fields(fields, size))
+
+
+def read_class_layout(reader: Reader, metadata: int) -> Optional[Layout]:
+    '''
+    Reads the fields of the class and its superclasses (base class first)
+    '''
+    offsets = reader.class_offsets
+    instance_size = reader.read_u32(metadata + offsets.instance_size)
+    if instance_size is None or instance_size > MAX_INSTANCE_SIZE:
+        return None
+    hierarchy = []
+    current = metadata
+    for _ in range(MAX_CLASS_DEPTH):
+        descriptor = reader.read_pointer(current + offsets.description)
+        if not descriptor or (header := reader.read(descriptor, CLASS_DESCRIPTOR_SIZE)) is None:
+            # root classes such as SwiftObject and NSObject
+            break
+        if struct.unpack_from("<I", header)[0] & 0x1f != CONTEXT_DESCRIPTOR_KIND_CLASS:
+            break
+        hierarchy.append((current, descriptor, header))
+        if not (current := reader.read_pointer(current + 8)):
+            break
+    if not hierarchy:
+        return None
+
+    fields = []
+    note = None
+    for current, descriptor, header in reversed(hierarchy):
+        flags = struct.unpack_from("<I", header)[0]
+        num_fields, field_offset_vector = struct.unpack_from("<II", header, 36)
+        if flags & CLASS_HAS_RESILIENT_SUPERCLASS:
+            # the field offset vector is placed after the superclass metadata of unknown size
+            note = "fields of classes with a resilient superclass are not shown"
+            continue
+        if num_fields == 0:
+            continue
+        if (vector := reader.read(current + 8 * field_offset_vector, 8 * num_fields)) is None:
+            continue
+        fields.extend(read_fields(reader, descriptor, list(struct.unpack(f"<{num_fields}Q", vector))))
+    name = read_descriptor_name(reader, hierarchy[0][1])[0]
+    return Layout(name=name or "?", kind="class", size=instance_size, fields=make_fields(fields, instance_size), note=note)
+
+
+def get_value_size(reader: Reader, metadata: int) -> Optional[int]:
+    value_witnesses = reader.read_pointer(metadata - 8)
+    if not value_witnesses:
+        return None
+    return reader.read_pointer(value_witnesses + VALUE_WITNESS_SIZE_OFFSET)
+
+
+class Dumper:
+    '''
+    level is the number of references followed from a dumped object (or array
+    element). Objects at level depth and deeper are shown as their type and address.
+    '''
+
+    def __init__(self, reader: Reader, depth: int, max_elements: int):
+        self.reader = reader
+        self.depth = depth
+        self.max_elements = max_elements
+        self.lines: List[str] = []
+        self.visiting: Set[int] = set()
+        self.base_indent = 0
+
+    def indent(self, level: int) -> str:
+        return "  " * (self.base_indent + level)
+
+    def dump_object(self, address: int, level: int = 0, label: str = ""):
+        indent = self.indent(level)
+        if address in self.visiting:
+            self.lines.append(f"{indent}{label}<cycle> @ 0x{address:x}")
+            return
+        metadata = self.reader.read_pointer(address)
+        layout = None if metadata is None else get_layout(self.reader, metadata)
+        if layout is None or layout.kind != "class":
+            self.lines.append(f"{indent}{label}0x{address:x} (not a Swift object)")
+            return
+        if level >= self.depth:
+            self.lines.append(f"{indent}{label}{layout.name} @ 0x{address:x}")
+            return
+        data = self.reader.read(address, layout.size)
+        if data is None:
+            self.lines.append(f"{indent}{label}{layout.name} @ 0x{address:x} (not readable)")
+            return
+        self.lines.append(f"{indent}{label}{layout.name} @ 0x{address:x}")
+        self.visiting.add(address)
+        self.dump_fields(layout, data, level + 1)
+        self.visiting.discard(address)
+
+    def dump_value(self, metadata: int, address: int, level: int, label: str = ""):
+        indent = self.indent(level)
+        layout = get_layout(self.reader, metadata)
+        if layout is None:
+            self.lines.append(f"{indent}{label}value @ 0x{address:x} (unknown type)")
+            return
+        if layout.kind == "class":
+            if (pointer := self.reader.read_pointer(address)) is not None:
+                self.dump_object(pointer, level, label)
+            return
+        data = self.reader.read(address, layout.size) if layout.size else b""
+        if data is None:
+            self.lines.append(f"{indent}{label}{layout.name} @ 0x{address:x} (not readable)")
+            return
+        if layout.kind == "enum":
+            self.lines.append(f"{indent}{label}{layout.name} {format_bytes(data)}")
+            return
+        if level >= self.depth:
+            self.lines.append(f"{indent}{label}{layout.name} @ 0x{address:x}")
+            return
+        self.lines.append(f"{indent}{label}{layout.name}")
+        self.dump_fields(layout, data, level + 1)
+
+    def dump_fields(self, layout: Layout, data: bytes, level: int):
+        indent = self.indent(level)
+        if layout.note is not None:
+            self.lines.append(f"{indent}({layout.note})")
+        for field in layout.fields:
+            self.dump_field(field.type, data[field.offset:field.offset + field.size], level, f"{field.name}: ")
+
+    def dump_field(self, field_type: FieldType, data: bytes, level: int, label: str):
+        indent = self.indent(level)
+        kind = field_type.kind
+        if kind == "optional" and field_type.element.kind in ("reference", "array"):
+            if int.from_bytes(data[:8], "little") == 0:
+                self.lines.append(f"{indent}{label}nil")
+                return
+            field_type, kind = field_type.element, field_type.element.kind
+        elif kind == "optional" and field_type.element.kind == "scalar":
+            size = field_type.element.stride
+            # Bool? stores nil as an invalid Bool value, other scalars in a tag byte
+            if (data[:1] == b"\x02") if field_type.element.name == "Bool" else (len(data) > size and data[size] == 1):
+                self.lines.append(f"{indent}{label}nil")
+                return
+            field_type, kind = field_type.element, "scalar"
+
+        if kind == "scalar" and len(data) >= field_type.stride:
+            self.lines.append(f"{indent}{label}{struct.unpack_from(field_type.format, data)[0]}")
+        elif kind == "string" and len(data) >= 16:
+            self.lines.append(f"{indent}{label}{self.read_string(data)}")
+        elif kind == "reference" and len(data) >= 8:
+            pointer = int.from_bytes(data[:8], "little")
+            if pointer == 0:
+                self.lines.append(f"{indent}{label}nil")
+            else:
+                self.dump_object(pointer, level, label)
+        elif kind == "array" and len(data) >= 8:
+            self.dump_array(field_type, int.from_bytes(data[:8], "little"), level, label)
+        else:
+            self.lines.append(f"{indent}{label}{format_bytes(data)} ({field_type.name})")
+
+    def read_string(self, data: bytes) -> str:
+        count_and_flags, string_object = struct.unpack_from("<QQ", data)
+        if string_object & STRING_IS_SMALL:
+            count = (string_object >> STRING_SMALL_COUNT_SHIFT) & 0xf
+            raw = data[:15][:count]
+        else:
+            count = count_and_flags & STRING_COUNT_MASK
+            address = (string_object & STRING_OBJECT_ADDRESS_MASK) + STRING_NATIVE_BIAS
+            raw = self.reader.read(address, min(count, MAX_STRING_LENGTH))
+            if raw is None:
+                return f"<string of {count} bytes at 0x{address:x}>"
+        text = raw.decode("utf-8", errors="replace")
+        return repr(text) + ("..." if count > MAX_STRING_LENGTH else "")
+
+    def dump_array(self, field_type: FieldType, storage: int, level: int, label: str):
+        indent = self.indent(level)
+        count = self.reader.read_pointer(storage + ARRAY_COUNT_OFFSET)
+        element = field_type.element
+        if count is None:
+            self.lines.append(f"{indent}{label}{field_type.name} @ 0x{storage:x} (not readable)")
+            return
+        self.lines.append(f"{indent}{label}{field_type.name} ({count} elements) @ 0x{storage:x}")
+        stride = element.stride
+        shown = min(count, self.max_elements)
+        if stride is None or shown == 0 or level >= self.depth:
+            return
+        data = self.reader.read(storage + ARRAY_ELEMENTS_OFFSET, stride * shown)
+        if data is None:
+            return
+        for i in range(shown):
+            self.dump_field(element, data[i * stride:(i + 1) * stride], level + 1, f"[{i}]: ")
+        if shown < count:
+            self.lines.append(f"{self.indent(level + 1)}... {count - shown} more")
+
+    def dump_existential_array(self, storage: int, num_witness_tables: int):
+        '''
+        Elements of [any P] are existential containers: a 3-word value buffer,
+        the type metadata, and the witness tables of the protocols
+        '''
+        count = self.reader.read_pointer(storage + ARRAY_COUNT_OFFSET)
+        if count is None:
+            self.lines.append(f"0x{storage:x} (not readable)")
+            return
+        self.lines.append(f"{count} elements @ 0x{storage:x}")
+        self.base_indent = 1
+        stride = EXISTENTIAL_BUFFER_SIZE + 8 + 8 * num_witness_tables
+        shown = min(count, self.max_elements)
+        data = self.reader.read(storage + ARRAY_ELEMENTS_OFFSET, stride * shown) if shown else b""
+        if data is None:
+            return
+        for i in range(shown):
+            element = storage + ARRAY_ELEMENTS_OFFSET + i * stride
+            metadata = struct.unpack_from("<Q", data, i * stride + EXISTENTIAL_BUFFER_SIZE)[0]
+            self.dump_value(metadata, self.get_existential_value(element, metadata), 0, f"[{i}]: ")
+        if shown < count:
+            self.lines.append(f"  ... {count - shown} more")
+        self.base_indent = 0
+
+    def get_existential_value(self, container: int, metadata: int) -> int:
+        '''
+        Returns the address of the value (or of the object reference) in an
+        existential container
+        '''
+        value_witnesses = self.reader.read_pointer(metadata - 8)
+        flags = None if not value_witnesses else self.reader.read_u32(value_witnesses + VALUE_WITNESS_FLAGS_OFFSET)
+        if flags is None or not flags & VALUE_WITNESS_IS_NON_INLINE:
+            return container
+        # the value is stored in a heap box after its header
+        box = self.reader.read_pointer(container) or 0
+        alignment_mask = flags & VALUE_WITNESS_ALIGNMENT_MASK
+        return box + ((HEAP_OBJECT_HEADER_SIZE + alignment_mask) & ~alignment_mask)
+
+
+def format_bytes(data: bytes) -> str:
+    if 0 < len(data) <= 8:
+        return f"0x{int.from_bytes(data, 'little'):x}"
+    return data[:32].hex(" ") + (" ..." if len(data) > 32 else "")
+
+
+def evaluate_address(frame: lldb.SBFrame, expression: str) -> Optional[int]:
+    '''
+    Integer literals and registers are read without the expression evaluator
+    '''
+    try:
+        return int(expression, 0)
+    except ValueError:
+        pass
+    if expression.startswith("$") and (register := frame.FindRegister(expression[1:])).IsValid():
+        return register.GetValueAsUnsigned()
+    value = frame.FindVariable(expression)
+    if not value.IsValid():
+        value = frame.EvaluateExpression(expression)
+    if not value.IsValid() or value.GetError().Fail():
+        return None
+    return value.GetValueAsUnsigned()
+
+
+def run_dump(debugger: lldb.SBDebugger, command: str, result: lldb.SBCommandReturnObject, prog: str, array: bool, default_depth: int):
+    parser = generate_option_parser(prog, array, default_depth)
+    try:
+        (options, args) = parser.parse_args(shlex.split(command))
+    except:
+        result.SetError(parser.usage)
+        return
+    if not args:
+        result.SetError(parser.get_usage())
+        return
+
+    process: lldb.SBProcess = debugger.GetSelectedTarget().GetProcess()
+    if not process.IsValid():
+        result.SetError("No process")
+        return
+    if options.expression:
+        for expression in args:
+            if array:
+                debugger.HandleCommand(f"expr -l Swift -- protocol Empty {{}}; let $tmp = dump(unsafeBitCast({expression}, to: [any Empty].self))")
+            else:
+                debugger.HandleCommand(f"dwim-print -l Swift -- dump(unsafeBitCast({expression}, to: AnyObject.self))")
+        return
+
+    reset_caches_for(process)
+    frame = process.GetSelectedThread().GetSelectedFrame()
+    dumper = Dumper(Reader(process), options.depth, options.max_elements)
+    for expression in args:
+        if (address := evaluate_address(frame, expression)) is None:
+            dumper.lines.append(f"Cannot evaluate {expression}")
+        elif array:
+            dumper.dump_existential_array(address, options.witness_tables)
+        else:
+            dumper.dump_object(address)
+    result.AppendMessage("\n".join(dumper.lines))
+
+
+def sdump(debugger: lldb.SBDebugger, command: str, exe_ctx: lldb.SBExecutionContext, result: lldb.SBCommandReturnObject, internal_dict: dict):
+    run_dump(debugger, command, result, "sdump", array=False, default_depth=2)
+
+
+def dump_boxed_array(debugger: lldb.SBDebugger, command: str, exe_ctx: lldb.SBExecutionContext, result: lldb.SBCommandReturnObject, internal_dict: dict):
+    run_dump(debugger, command, result, "dump_boxed_array", array=True, default_depth=2)
+
+
+def p_boxed_array(debugger: lldb.SBDebugger, command: str, exe_ctx: lldb.SBExecutionContext, result: lldb.SBCommandReturnObject, internal_dict: dict):
+    run_dump(debugger, command, result, "p_boxed_array", array=True, default_depth=0)
+
+
+def generate_option_parser(prog: str, array: bool, default_depth: int):
+    usage = f"usage: %prog [options] <{'array' if array else 'object'} address> [...]"
+    parser = optparse.OptionParser(usage=usage, prog=prog)
+    parser.add_option("-d", "--depth",
+                      action="store",
+                      type="int",
+                      default=default_depth,
+                      dest="depth",
+                      help=f"Levels of referenced objects to expand (default: {default_depth})")
+    parser.add_option("-n", "--max-elements",
+                      action="store",
+                      type="int",
+                      default=100,
+                      dest="max_elements",
+                      help="Maximum number of array elements to show (default: 100)")
+    parser.add_option("-e", "--expression",
+                      action="store_true",
+                      default=False,
+                      dest="expression",
+                      help="Use the Swift expression evaluator (slow, needs debug info)")
+    if array:
+        parser.add_option("-w", "--witness-tables",
+                          action="store",
+                          type="int",
+                          default=1,
+                          dest="witness_tables",
+                          help="Number of protocol witness tables in each element: 0 for [Any], 1 for [any P] "
+                               "(default: 1, the 40-byte elements of [any Empty] which -e casts to)")
+    return parser
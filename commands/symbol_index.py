@@ -0,0 +1,145 @@
+'''
+PC -> (module, function) index for the tracing commands. Address ranges of the
+loaded modules and of the functions in them are kept in sorted lists, so a
+lookup is a bisect instead of SB API symbolication on every stop.
+
+Module ranges are rebuilt when the target reports modules loaded or unloaded.
+The function table of a module is built on its first lookup and is kept with
+image-relative offsets by module path, so it is reused when the module is
+loaded again at another address.
+'''
+
+import lldb
+import bisect
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+
+MODULE_EVENTS = lldb.SBTarget.eBroadcastBitModulesLoaded | lldb.SBTarget.eBroadcastBitModulesUnloaded
+IGNORED_SECTIONS = {"__PAGEZERO"}
+
+
+@dataclass(frozen=True)
+class LoadedModule:
+    name: str
+    path: str
+    base: int
+    module: lldb.SBModule
+
+
+class FunctionTable:
+    def __init__(self, target: lldb.SBTarget, module: lldb.SBModule, base: int):
+        functions: Dict[int, Tuple[int, str]] = {}
+        for i in range(module.GetNumSymbols()):
+            symbol: lldb.SBSymbol = module.GetSymbolAtIndex(i)
+            if symbol.GetType() != lldb.eSymbolTypeCode:
+                continue
+            start = symbol.GetStartAddress().GetLoadAddress(target)
+            if start == lldb.LLDB_INVALID_ADDRESS:
+                continue
+            end = symbol.GetEndAddress().GetLoadAddress(target)
+            size = end - start if end != lldb.LLDB_INVALID_ADDRESS and end > start else 0
+            functions.setdefault(start - base, (size, symbol.GetName()))
+        self.offsets = sorted(functions)
+        self.sizes = [functions[offset][0] for offset in self.offsets]
+        self.names = [functions[offset][1] for offset in self.offsets]
+
+    def find(self, offset: int) -> Optional[str]:
+        i = bisect.bisect_right(self.offsets, offset) - 1
+        if i < 0:
+            return None
+        # symbols without a size extend to the next symbol
+        if self.sizes[i] and offset >= self.offsets[i] + self.sizes[i]:
+            return None
+        return self.names[i]
+
+
+class SymbolIndex:
+    def __init__(self, target: lldb.SBTarget):
+        self.target = target
+        self.listener = lldb.SBListener("symbol-index")
+        self.target.GetBroadcaster().AddListener(self.listener, MODULE_EVENTS)
+        self.lock = threading.Lock()
+        self.function_tables: Dict[str, FunctionTable] = {}
+        self.generation = 0
+        self.rebuild()
+
+    def rebuild(self):
+        '''
+        Walks the modules of the target. generation is incremented so users of
+        module_records() can tell that the module table has changed.
+        '''
+        ranges: List[Tuple[int, int, LoadedModule]] = []
+        records = []
+        for module in self.target.module_iter():
+            file_spec = module.GetFileSpec()
+            base = module.GetObjectFileHeaderAddress().GetLoadAddress(self.target)
+            record = {"name": file_spec.GetFilename(), "addr": hex(base)}
+            records.append(record)
+            if base == lldb.LLDB_INVALID_ADDRESS:
+                continue
+            loaded = LoadedModule(name=file_spec.GetFilename(), path=file_spec.fullpath, base=base, module=module)
+            end = base
+            for section in module.sections:
+                start = section.GetLoadAddress(self.target)
+                if start == lldb.LLDB_INVALID_ADDRESS or section.GetByteSize() == 0 or section.GetName() in IGNORED_SECTIONS:
+                    continue
+                ranges.append((start, start + section.GetByteSize(), loaded))
+                end = max(end, start + section.GetByteSize())
+            if end > base:
+                # the extent of the module, up to the end of its last section
+                record["size"] = hex(end - base)
+        ranges.sort(key=lambda entry: entry[0])
+        # replaced at once, so lookups on other threads see a consistent table
+        self.table = ([start for start, _, _ in ranges], ranges)
+        self.records = records
+        self.generation += 1
+
+    def poll(self):
+        '''
+        Rebuilds the module ranges if modules have been loaded or unloaded
+        since the last call
+        '''
+        event = lldb.SBEvent()
+        changed = False
+        while self.listener.GetNextEvent(event):
+            changed |= bool(event.GetType() & MODULE_EVENTS)
+        if changed:
+            with self.lock:
+                self.rebuild()
+
+    def find_module(self, address: int) -> Optional[LoadedModule]:
+        self.poll()
+        starts, ranges = self.table
+        i = bisect.bisect_right(starts, address) - 1
+        if i < 0:
+            return None
+        start, end, loaded = ranges[i]
+        return loaded if address < end else None
+
+    def find_function(self, loaded: LoadedModule, address: int) -> Optional[str]:
+        table = self.function_tables.get(loaded.path)
+        if table is None:
+            table = self.function_tables[loaded.path] = FunctionTable(self.target, loaded.module, loaded.base)
+        return table.find(address - loaded.base)
+
+    def lookup(self, address: int) -> Tuple[Optional[str], Optional[str]]:
+        '''
+        Returns (module file name, function name)
+        '''
+        loaded = self.find_module(address)
+        if loaded is None:
+            return None, None
+        return loaded.name, self.find_function(loaded, address)
+
+    def module_records(self) -> List[dict]:
+        '''
+        Module table of the saved traces ({"name", "addr", "size"} of every module
+        of the target; "size" is missing if the module is not loaded)
+        '''
+        self.poll()
+        return self.records
+
+    def close(self):
+        self.target.GetBroadcaster().RemoveListener(self.listener, MODULE_EVENTS)
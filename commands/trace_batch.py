@@ -0,0 +1,221 @@
+'''
+Batch branch tracing of one executable over many inputs. One debugger and one
+target are used for all runs: the branch sites are discovered and armed once
+by the first run ("brt_set_bps"), and the armed breakpoints, the function
+tables of the symbol index and the decoded branch operands are reused while
+the target is relaunched for each input. Each run is streamed to its own trace.
+
+Inputs are files, which replace "@@" in the arguments or are fed to stdin,
+and/or lines of an arguments file, each of which is an argument vector.
+
+The runner also works outside LLDB:
+    python3 trace_batch.py [options] <executable> [args ...]
+    python3 -m trace_batch [options] <executable> [args ...]  (with commands/ in PYTHONPATH)
+'''
+
+import json
+import optparse
+import os
+import shlex
+import subprocess
+import sys
+import time
+from typing import List, Optional, Tuple
+
+try:
+    import lldb
+except ImportError:
+    # run as a script outside LLDB
+    sys.path.insert(0, subprocess.check_output(["lldb", "-P"], text=True).strip())
+    import lldb
+
+from trace_shards import COMMANDS_DIR, launch_to_main, run_command, run_to_exit
+
+
+FILE_NAME = os.path.basename(__file__)[:-3]
+INPUT_PLACEHOLDER = "@@"
+
+
+def __lldb_init_module(debugger: lldb.SBDebugger, internal_dict: dict):
+    debugger.HandleCommand(f'command script add -f {FILE_NAME}.run_batch_command brt_batch -h "Trace the selected target once per input, reusing the armed branch sites across relaunches"')
+
+
+def run_batch_command(debugger: lldb.SBDebugger, command: str, exe_ctx: lldb.SBExecutionContext, result: lldb.SBCommandReturnObject, internal_dict: dict):
+    '''
+    Traces the selected target for each input, with the arguments as the template
+    '''
+    parser = generate_option_parser()
+    try:
+        (options, args) = parser.parse_args(shlex.split(command))
+        runs = get_runs(args, options)
+    except OSError as e:
+        result.SetError(str(e))
+        return
+    except:
+        result.SetError(parser.usage)
+        return
+
+    target: lldb.SBTarget = debugger.GetSelectedTarget()
+    if not target.IsValid():
+        result.SetError("No target is selected")
+        return
+    if target.GetProcess().IsValid() and target.GetProcess().GetState() not in (lldb.eStateExited, lldb.eStateDetached):
+        result.SetError("Kill the process of the target before starting a batch")
+        return
+    was_async = debugger.GetAsync()
+    debugger.SetAsync(False)
+    try:
+        trace_batch(debugger, target, runs, options)
+    except RuntimeError as e:
+        result.SetError(str(e))
+    finally:
+        debugger.SetAsync(was_async)
+
+
+def get_runs(args: List[str], options) -> List[Tuple[Optional[str], List[str], Optional[str]]]:
+    '''
+    Returns (input file or None, arguments, file fed to stdin or None) of each run
+    '''
+    input_files = []
+    for path in options.inputs:
+        if os.path.isdir(path):
+            input_files.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                      if os.path.isfile(os.path.join(path, name))))
+        elif os.path.isfile(path):
+            input_files.append(path)
+        else:
+            raise OSError(f"No such input: {path}")
+
+    use_stdin = INPUT_PLACEHOLDER not in args
+    runs = [(input_file, [input_file if arg == INPUT_PLACEHOLDER else arg for arg in args], input_file if use_stdin else None)
+            for input_file in input_files]
+    if options.args_file is not None:
+        with open(options.args_file, "r") as fin:
+            runs.extend((None, args + shlex.split(line), None) for line in fin if line.strip() and not line.startswith("#"))
+    if not runs:
+        raise OSError("No inputs. Use -i/--input and/or -a/--args-file")
+    return runs
+
+
+def create_launch_info(target: lldb.SBTarget, args: List[str], stdin: Optional[str]) -> lldb.SBLaunchInfo:
+    launch_info = target.GetLaunchInfo()
+    launch_info.SetArguments(args, False)
+    # the armed sites are load addresses, so every run has to be loaded at the same addresses
+    launch_info.SetLaunchFlags(launch_info.GetLaunchFlags() | lldb.eLaunchFlagDisableASLR)
+    if stdin is not None:
+        launch_info.AddOpenFileAction(0, stdin, True, False)
+    return launch_info
+
+
+def trace_batch(debugger: lldb.SBDebugger, target: lldb.SBTarget, runs: List[Tuple[Optional[str], List[str], Optional[str]]], options) -> List[dict]:
+    '''
+    Runs the target once per run, and writes trace_<i> and a summary (batch.json)
+    into options.output_dir. Returns the summary of each run
+    '''
+    os.makedirs(options.output_dir, exist_ok=True)
+    if "--async" in shlex.split(options.set_bps):
+        raise RuntimeError("Batch runs use brt_set_bps synchronously. Remove --async")
+    if "branch_trace" not in sys.modules:
+        run_command(debugger, f"command script import {os.path.join(COMMANDS_DIR, 'branch_trace.py')}")
+    # the module imported by LLDB, which owns the armed breakpoints
+    import branch_trace
+
+    extension = "ndjson" if options.ndjson else "brt"
+    summaries = []
+    start = time.perf_counter()
+    for i, (input_file, args, stdin) in enumerate(runs):
+        trace_path = os.path.join(options.output_dir, f"trace_{i}.{extension}")
+        process = launch_to_main(target, create_launch_info(target, args, stdin))
+        stops = branch_trace.stats.counters["stops"]
+        if i == 0:
+            arm_start = time.perf_counter()
+            run_command(debugger, f"brt_set_bps {options.set_bps} --stream {trace_path}{'' if options.ndjson else ' --binary'}")
+            print(f"Branch sites are armed in {time.perf_counter() - arm_start:.2f} s, and reused by the next runs")
+        else:
+            branch_trace.restart_trace(debugger, trace_path, not options.ndjson)
+        run_seconds, truncated = run_to_exit(process, options.max_stops)
+        run_command(debugger, "brt_save")
+        summary = {
+            "input": input_file,
+            "args": args,
+            "trace": trace_path,
+            "stops": branch_trace.stats.counters["stops"] - stops,
+            "run_seconds": run_seconds,
+            "exit_status": process.GetExitStatus() if process.GetState() == lldb.eStateExited else None,
+            "truncated": truncated,
+        }
+        summaries.append(summary)
+        print(f"Run {i}: {summary['stops']} stops in {run_seconds:.2f} s, exit status {summary['exit_status']}"
+              f"{' (truncated: killed after --max-stops stops)' if truncated else ''}")
+
+    with open(os.path.join(options.output_dir, "batch.json"), "w") as fout:
+        json.dump(summaries, fout, indent=2)
+    print(f"{len(runs)} runs are traced in {time.perf_counter() - start:.2f} s. Traces are in {options.output_dir}")
+    return summaries
+
+
+def generate_option_parser():
+    usage = "usage: %prog [options] [-- args ...] (\"@@\" in args is replaced by each input file)"
+    parser = optparse.OptionParser(usage=usage, prog="brt_batch")
+    parser.add_option("-i", "--input",
+                      action="append",
+                      default=[],
+                      dest="inputs",
+                      help="Input file, or a directory of input files (can be repeated). "
+                           "An input replaces \"@@\" in the arguments, or is fed to stdin if there is no \"@@\"")
+    parser.add_option("-a", "--args-file",
+                      action="store",
+                      default=None,
+                      dest="args_file",
+                      help="File with one argument vector per line, each of which is appended to the arguments for one run")
+    parser.add_option("-o", "--output-dir",
+                      action="store",
+                      default="/tmp/brt_batch",
+                      dest="output_dir",
+                      help="Directory for the traces (trace_<i>.brt) and the summary (batch.json) (default: /tmp/brt_batch)")
+    parser.add_option("--set-bps",
+                      action="store",
+                      default="",
+                      dest="set_bps",
+                      help="brt_set_bps options, as one quoted string (e.g., \"-f -a -m libfoo*\")")
+    parser.add_option("--ndjson",
+                      action="store_true",
+                      default=False,
+                      dest="ndjson",
+                      help="Write NDJSON traces instead of the binary format")
+    parser.add_option("--max-stops",
+                      action="store",
+                      type="int",
+                      default=0,
+                      dest="max_stops",
+                      help="Kill a run after this many stops which are not branch sites, such as signals, "
+                           "and mark its trace as truncated (0: never)")
+    return parser
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = generate_option_parser()
+    parser.prog = os.path.basename(__file__)
+    parser.usage = "usage: python3 %prog [options] <executable> [args ...] (\"@@\" in args is replaced by each input file)"
+    parser.disable_interspersed_args()
+    (options, args) = parser.parse_args(argv)
+    if not args:
+        parser.error("The executable is missing")
+    try:
+        runs = get_runs(args[1:], options)
+    except OSError as e:
+        parser.error(str(e))
+
+    debugger = lldb.SBDebugger.Create()
+    debugger.SetAsync(False)
+    target = debugger.CreateTarget(os.path.realpath(args[0]))
+    if not target.IsValid():
+        parser.error(f"Cannot create a target for {args[0]}")
+    try:
+        trace_batch(debugger, target, runs, options)
+    finally:
+        lldb.SBDebugger.Destroy(debugger)
+
+
+if __name__ == "__main__":
+    main()
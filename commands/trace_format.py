@@ -0,0 +1,514 @@
+'''
+Compact binary columnar format for branch traces, and conversion to the JSON
+layout ({"modules", "branches"}) consumed by the Binja Missing Link plugin.
+
+A file starts with MAGIC followed by the format version, then a sequence of
+8-byte aligned blocks. Each block has a (kind, payload size) header:
+
+- STRS: strings appended to the string table (ids are assigned in order)
+- REGS: register names, which define the order of register columns. Names
+        are only added, and each REGS block has all names so far
+- MODS: module table (addr and size: uint64 columns, name id: uint32 column).
+        A size of 0 is unknown
+- BRCH: chunk of branch records. uint64 columns for the before/after registers
+        (one per name of the last REGS block), the before/after register masks
+        (bit i: register i was captured; records of different sites capture
+        different registers) and the hit count, then uint32 columns for the
+        before/after module and function name ids
+- CNTS: (site, destination, count) uint64 columns for aggregated edges
+
+Usage:
+    python3 trace_format.py <input.brt|input.ndjson> <output.json>
+    python3 trace_format.py --check  (round-trip check of the binary format)
+'''
+
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from collections.abc import Mapping
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+MAGIC = b"BRTRACE\0"
+VERSION = 3  # 1: no register masks, every record has every register. 2: no module sizes
+MAX_REGISTERS = 64  # bits of a register mask
+FILE_HEADER = struct.Struct("<8sII")
+BLOCK_HEADER = struct.Struct("<4sI")
+COUNT_HEADER = struct.Struct("<II")
+NO_STRING = 0xffffffff
+DEFAULT_CHUNK_RECORDS = 4096
+
+
+class PackedRegisters(Mapping):
+    '''
+    Register values of a record packed in a uint64 array. As a mapping, values are
+    hex strings as in the JSON layout, but they are only formatted on access.
+    '''
+    __slots__ = ("names", "index", "values")
+
+    def __init__(self, names: Tuple[str, ...], index: Dict[str, int], values: array):
+        self.names = names
+        self.index = index
+        self.values = values
+
+    def __getitem__(self, name: str) -> str:
+        return f"0x{self.values[self.index[name]]:016x}"
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.names)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def value(self, name: str, default: Optional[int] = None) -> Optional[int]:
+        i = self.index.get(name)
+        return default if i is None else self.values[i]
+
+    def replace(self, **values: int) -> "PackedRegisters":
+        '''
+        Returns a copy with the given registers (if captured) set to new values
+        '''
+        copied = array("Q", self.values)
+        for name, value in values.items():
+            if (i := self.index.get(name)) is not None:
+                copied[i] = value & 0xffffffffffffffff
+        return PackedRegisters(self.names, self.index, copied)
+
+
+def to_json_value(value):
+    '''
+    "default" function for json.dump, which serializes PackedRegisters as objects
+    '''
+    if isinstance(value, Mapping):
+        return dict(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _padding(size: int) -> bytes:
+    return b"\0" * (-size % 8)
+
+
+def _encode_strings(strings: List[str]) -> bytes:
+    chunks = [struct.pack("<I", len(strings))]
+    for string in strings:
+        encoded = string.encode()
+        chunks.append(struct.pack("<I", len(encoded)))
+        chunks.append(encoded)
+    return b"".join(chunks)
+
+
+def _decode_strings(payload: memoryview) -> List[str]:
+    (count,) = struct.unpack_from("<I", payload, 0)
+    pos = 4
+    strings = []
+    for _ in range(count):
+        (size,) = struct.unpack_from("<I", payload, pos)
+        pos += 4
+        strings.append(bytes(payload[pos:pos + size]).decode())
+        pos += size
+    return strings
+
+
+def _column(payload: memoryview, offset: int, typecode: str, count: int):
+    itemsize = 8 if typecode == "Q" else 4
+    view = payload[offset:offset + itemsize * count]
+    if sys.byteorder == "little":
+        return view.cast(typecode)
+    column = array(typecode, bytes(view))
+    column.byteswap()
+    return column
+
+
+def _to_bytes(column: array) -> bytes:
+    if sys.byteorder != "little":
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+
+class BinaryTraceEncoder:
+    '''
+    Accepts the same records as the NDJSON stream ("modules", "branch" and
+    "edge_count") and writes them as blocks
+    '''
+
+    def __init__(self, path: str, chunk_records: int = DEFAULT_CHUNK_RECORDS):
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(FILE_HEADER.pack(MAGIC, VERSION, 0))
+        self.chunk_records = chunk_records
+        self.strings: Dict[Optional[str], int] = {None: NO_STRING}
+        self.pending_strings: List[str] = []
+        self.register_names: List[str] = []
+        self.register_index: Dict[str, int] = {}
+        self.reset_chunk()
+        self.reset_counts()
+
+    def reset_chunk(self):
+        self.num_chunk_records = 0
+        self.register_columns: List[array] = []
+        self.mask_columns = [array("Q"), array("Q")]
+        self.count_column = array("Q")
+        self.name_columns = [array("I") for _ in range(4)]
+
+    def reset_counts(self):
+        self.count_columns = [array("Q") for _ in range(3)]
+
+    def intern(self, string: Optional[str]) -> int:
+        string_id = self.strings.get(string)
+        if string_id is None:
+            string_id = len(self.strings) - 1
+            self.strings[string] = string_id
+            self.pending_strings.append(string)
+        return string_id
+
+    def write_block(self, kind: bytes, payload: bytes):
+        self.file.write(BLOCK_HEADER.pack(kind, len(payload) + len(_padding(len(payload)))))
+        self.file.write(payload)
+        self.file.write(_padding(len(payload)))
+
+    def write_pending_strings(self):
+        if self.pending_strings:
+            self.write_block(b"STRS", _encode_strings(self.pending_strings))
+            self.pending_strings = []
+
+    def write_records(self, records: List[dict]):
+        for record in records:
+            kind = record.get("type", "branch")
+            if kind == "branch":
+                self.add_branch(record)
+            elif kind == "modules":
+                self.write_modules(record["modules"])
+            elif kind == "edge_count":
+                for column, value in zip(self.count_columns, (record["site"], record["destination"], record["count"])):
+                    column.append(int(value, 16) if isinstance(value, str) else value)
+
+    def write_modules(self, modules: List[dict]):
+        self.flush_chunk()
+        name_ids = array("I", (self.intern(module["name"]) for module in modules))
+        addrs = array("Q", (int(module["addr"], 16) & 0xffffffffffffffff for module in modules))
+        sizes = array("Q", (int(module.get("size", "0x0"), 16) for module in modules))
+        self.write_pending_strings()
+        self.write_block(b"MODS", COUNT_HEADER.pack(len(modules), 0) + _to_bytes(addrs) + _to_bytes(sizes) + _to_bytes(name_ids))
+
+    def add_branch(self, record: dict):
+        before = record["before"]
+        after = record["after"]
+        new_names = [name for name in (*before["registers"].keys(), *after["registers"].keys()) if name not in self.register_index]
+        if new_names:
+            self.add_register_names(new_names)
+        if not self.register_columns:
+            self.register_columns = [array("Q") for _ in range(2 * len(self.register_names))]
+        num_registers = len(self.register_names)
+        for side, registers in enumerate((before["registers"], after["registers"])):
+            mask = 0
+            for i, name in enumerate(self.register_names):
+                value = _register_value(registers, name)
+                if value is not None:
+                    mask |= 1 << i
+                self.register_columns[side * num_registers + i].append(0 if value is None else value)
+            self.mask_columns[side].append(mask)
+        self.count_column.append(record.get("count", 0))
+        for column, value in zip(self.name_columns, (before["module"], before["func"], after["module"], after["func"])):
+            column.append(self.intern(value))
+        self.num_chunk_records += 1
+        if self.num_chunk_records >= self.chunk_records:
+            self.flush_chunk()
+
+    def add_register_names(self, names: List[str]):
+        '''
+        Extends the register table. The current chunk has columns for the old
+        table only, so it is written first.
+        '''
+        self.flush_chunk()
+        for name in dict.fromkeys(names):
+            self.register_index[name] = len(self.register_names)
+            self.register_names.append(name)
+        if len(self.register_names) > MAX_REGISTERS:
+            raise ValueError(f"More than {MAX_REGISTERS} registers are recorded")
+        self.write_block(b"REGS", _encode_strings(self.register_names))
+
+    def flush_chunk(self):
+        if self.num_chunk_records == 0:
+            return
+        self.write_pending_strings()
+        payload = [COUNT_HEADER.pack(self.num_chunk_records, len(self.register_names))]
+        payload.extend(_to_bytes(column) for column in self.register_columns)
+        payload.extend(_to_bytes(column) for column in self.mask_columns)
+        payload.append(_to_bytes(self.count_column))
+        payload.extend(_to_bytes(column) for column in self.name_columns)
+        self.write_block(b"BRCH", b"".join(payload))
+        self.reset_chunk()
+
+    def flush_counts(self):
+        if not self.count_columns[0]:
+            return
+        payload = [COUNT_HEADER.pack(len(self.count_columns[0]), 0)]
+        payload.extend(_to_bytes(column) for column in self.count_columns)
+        self.write_block(b"CNTS", b"".join(payload))
+        self.reset_counts()
+
+    def flush(self):
+        self.flush_chunk()
+        self.flush_counts()
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def _register_value(registers: Mapping, name: str) -> Optional[int]:
+    '''
+    Returns None if the register was not captured
+    '''
+    if isinstance(registers, PackedRegisters):
+        return registers.value(name)
+    value = registers.get(name)
+    if value is None:
+        return None
+    return int(value, 16)
+
+
+class BinaryTraceReader:
+    '''
+    Reads a binary trace through a memory map. Register columns are exposed as
+    memoryviews over the mapped file, so they are not copied.
+    '''
+
+    def __init__(self, path: str):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _ = FILE_HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a binary branch trace")
+        if not 1 <= version <= VERSION:
+            raise ValueError(f"Unsupported binary branch trace version: {version}")
+        self.version = version
+
+    def iter_blocks(self) -> Iterator[Tuple[bytes, memoryview]]:
+        view = memoryview(self.map)
+        pos = FILE_HEADER.size
+        while pos + BLOCK_HEADER.size <= len(self.map):
+            kind, size = BLOCK_HEADER.unpack_from(self.map, pos)
+            pos += BLOCK_HEADER.size
+            if pos + size > len(self.map):
+                # truncated block (e.g., the process crashed while writing)
+                return
+            yield kind, view[pos:pos + size]
+            pos += size
+
+    def scan(self) -> Tuple[List[dict], Dict[Tuple[int, int], int]]:
+        '''
+        Returns the last module table and the edge counts without decoding branch records
+        '''
+        strings: List[str] = []
+        modules: List[dict] = []
+        counts: Dict[Tuple[int, int], int] = {}
+        for kind, payload in self.iter_blocks():
+            if kind == b"STRS":
+                strings.extend(_decode_strings(payload))
+            elif kind == b"MODS":
+                count, _ = COUNT_HEADER.unpack_from(payload, 0)
+                addrs = _column(payload, COUNT_HEADER.size, "Q", count)
+                sizes = _column(payload, COUNT_HEADER.size + 8 * count, "Q", count) if self.version >= 3 else [0] * count
+                name_ids = _column(payload, COUNT_HEADER.size + (16 if self.version >= 3 else 8) * count, "I", count)
+                modules = [{"name": strings[name_ids[i]], "addr": hex(addrs[i])} for i in range(count)]
+                for module, size in zip(modules, sizes):
+                    if size:
+                        module["size"] = hex(size)
+            elif kind == b"CNTS":
+                count, _ = COUNT_HEADER.unpack_from(payload, 0)
+                sites, destinations, hits = (_column(payload, COUNT_HEADER.size + 8 * count * i, "Q", count) for i in range(3))
+                for i in range(count):
+                    counts[(sites[i], destinations[i])] = hits[i]
+        return modules, counts
+
+    def iter_branches(self) -> Iterator[dict]:
+        strings: List[Optional[str]] = []
+        register_names: List[str] = []
+
+        def string(string_id: int) -> Optional[str]:
+            return None if string_id == NO_STRING else strings[string_id]
+
+        for kind, payload in self.iter_blocks():
+            if kind == b"STRS":
+                strings.extend(_decode_strings(payload))
+            elif kind == b"REGS":
+                register_names = _decode_strings(payload)
+            elif kind == b"BRCH":
+                count, num_registers = COUNT_HEADER.unpack_from(payload, 0)
+                pos = COUNT_HEADER.size
+                register_columns = []
+                for _ in range(2 * num_registers):
+                    register_columns.append(_column(payload, pos, "Q", count))
+                    pos += 8 * count
+                all_registers = (1 << num_registers) - 1
+                if self.version >= 2:
+                    masks = [_column(payload, pos + 8 * count * side, "Q", count) for side in range(2)]
+                    pos += 16 * count
+                else:
+                    masks = [[all_registers] * count] * 2
+                hits = _column(payload, pos, "Q", count)
+                pos += 8 * count
+                name_columns = []
+                for _ in range(4):
+                    name_columns.append(_column(payload, pos, "I", count))
+                    pos += 4 * count
+                for i in range(count):
+                    record = {
+                        "before": {
+                            "module": string(name_columns[0][i]),
+                            "func": string(name_columns[1][i]),
+                            "registers": {name: f"0x{register_columns[j][i]:016x}" for j, name in enumerate(register_names[:num_registers])
+                                          if masks[0][i] >> j & 1},
+                        },
+                        "after": {
+                            "module": string(name_columns[2][i]),
+                            "func": string(name_columns[3][i]),
+                            "registers": {name: f"0x{register_columns[num_registers + j][i]:016x}" for j, name in enumerate(register_names[:num_registers])
+                                          if masks[1][i] >> j & 1},
+                        },
+                    }
+                    if hits[i]:
+                        record["count"] = hits[i]
+                    yield record
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def is_binary_trace(path: str) -> bool:
+    with open(path, "rb") as fin:
+        return fin.read(len(MAGIC)) == MAGIC
+
+
+def scan_ndjson(path: str) -> Tuple[List[dict], Dict[Tuple[int, int], int]]:
+    modules: List[dict] = []
+    counts: Dict[Tuple[int, int], int] = {}
+    with open(path) as fin:
+        for line in fin:
+            if '"type":"branch"' in line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # truncated last line
+                continue
+            if record.get("type") == "modules":
+                modules = record["modules"]
+            elif record.get("type") == "edge_count":
+                counts[(int(record["site"], 16), int(record["destination"], 16))] = record["count"]
+    return modules, counts
+
+
+def iter_ndjson_branches(path: str) -> Iterator[dict]:
+    with open(path) as fin:
+        for line in fin:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.pop("type", "branch") == "branch":
+                yield record
+
+
+def export_json(input_path: str, output_path: str) -> int:
+    '''
+    Converts a binary or NDJSON trace into the {"modules", "branches"} JSON layout.
+    Records are written one by one, so the whole trace is never held in memory.
+    '''
+    reader = None
+    if is_binary_trace(input_path):
+        reader = BinaryTraceReader(input_path)
+        modules, counts = reader.scan()
+        branches = reader.iter_branches()
+    else:
+        modules, counts = scan_ndjson(input_path)
+        branches = iter_ndjson_branches(input_path)
+
+    num_branches = 0
+    try:
+        with open(output_path, "w") as fout:
+            fout.write('{"modules": ')
+            json.dump(modules, fout)
+            fout.write(', "branches": [')
+            for record in branches:
+                if counts:
+                    edge = (int(record["before"]["registers"]["rip"], 16), int(record["after"]["registers"]["rip"], 16))
+                    if edge in counts:
+                        record["count"] = counts[edge]
+                if num_branches:
+                    fout.write(",")
+                fout.write("\n")
+                json.dump(record, fout)
+                num_branches += 1
+            fout.write("\n]}\n")
+    finally:
+        if reader is not None:
+            del branches
+            reader.close()
+    return num_branches
+
+
+def check_round_trip(chunk_records: int = 2) -> int:
+    '''
+    Writes branch records which capture different register sets (as with
+    "brt_set_bps -r operand") and checks that they are read back unchanged.
+    Returns the number of checked records
+    '''
+    def side(module: str, registers: Dict[str, int], packed: bool) -> dict:
+        if packed:
+            names = tuple(registers)
+            values = PackedRegisters(names, {name: i for i, name in enumerate(names)}, array("Q", registers.values()))
+        else:
+            values = {name: f"0x{value:016x}" for name, value in registers.items()}
+        return {"module": module, "func": None, "registers": values}
+
+    register_sets = [
+        {"rip": 0x1000, "rsp": 0x7ff0, "rax": 0x11},
+        {"rip": 0x2000, "rsp": 0x7fe0, "r11": 0x22},
+        {"rip": 0x3000, "rsp": 0x7fd0},
+        {"rip": 0x4000, "rsp": 0x7fc0, "rax": 0, "r11": 0x44, "rdi": 0x55},
+    ]
+    records = [{"before": side("a.out", registers, i % 2 == 0),
+                "after": side("libc.so", {"rip": registers["rip"] + 0x100, "rsp": registers["rsp"]}, i % 2 == 1),
+                "count": i}
+               for i, registers in enumerate(register_sets * 2)]
+    expected = [json.loads(json.dumps(record, default=to_json_value)) for record in records]
+    for record in expected:
+        if not record["count"]:
+            del record["count"]
+
+    fd, path = tempfile.mkstemp(suffix=".brt")
+    os.close(fd)
+    try:
+        encoder = BinaryTraceEncoder(path, chunk_records)
+        encoder.write_records([{"type": "modules", "modules": [{"name": "a.out", "addr": "0x1000"}]}])
+        encoder.write_records(records)
+        encoder.close()
+        reader = BinaryTraceReader(path)
+        try:
+            decoded = list(reader.iter_branches())
+        finally:
+            reader.close()
+    finally:
+        os.remove(path)
+    if decoded != expected:
+        raise ValueError(f"Round trip mismatch:\n{json.dumps(expected, indent=1)}\n!=\n{json.dumps(decoded, indent=1)}")
+    return len(decoded)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--check"]:
+        print(f"{check_round_trip()} records are read back unchanged")
+        sys.exit(0)
+    if len(sys.argv) != 3:
+        print(__doc__, file=sys.stderr)
+        sys.exit(1)
+    print(f"{export_json(sys.argv[1], sys.argv[2])} branches are exported to {sys.argv[2]}")
@@ -0,0 +1,347 @@
+'''
+Streaming merge of branch traces (brt_save JSON, NDJSON streams and binary
+traces) into one deduplicated edge index. Addresses are rebased to
+(module, offset) with the module table of each input, so runs with different
+ASLR slides are merged correctly.
+
+Inputs are read record by record, and the index is kept in an on-disk SQLite
+database, so memory use stays bounded for any number and size of inputs. The
+output has the {"modules", "branches"} layout of brt_save (one sample record
+and a "count" per unique edge, rebased to one module table), so it can be
+loaded by the Binja Missing Link plugin and merged again. Only rip is rebased:
+the other registers of a sample are kept as captured in the one run the sample
+was taken from, so pointers in them may not match the merged module table.
+
+Usage:
+    python3 trace_merge.py <output.json> <input> [<input> ...]
+    python3 trace_merge.py --check  (check of the module rebasing)
+'''
+
+import bisect
+import json
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import trace_format
+
+
+CHUNK_SIZE = 1024 * 1024
+MAX_PENDING_EDGES = 100000
+WHITESPACE = re.compile(r"\s*")
+
+
+class JsonStream:
+    '''
+    Incremental reader of one JSON document. Only the element being decoded
+    has to fit in memory.
+    '''
+
+    def __init__(self, file):
+        self.file = file
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        chunk = self.file.read(CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self) -> str:
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                raise ValueError("Unexpected end of the JSON document")
+            self.fill()
+
+    def expect(self, chars: str) -> str:
+        char = self.peek()
+        if char not in chars:
+            raise ValueError(f"Expected one of {chars!r} but got {char!r}")
+        self.pos += 1
+        return char
+
+    def decode_value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                self.fill()
+                continue
+            if end == len(self.buffer) and not self.eof:
+                # a number may continue in the next chunk
+                self.fill()
+                continue
+            self.pos = end
+            return value
+
+    def iter_members(self) -> Iterator[Tuple[str, Any]]:
+        '''
+        Yields (key, value) for the members of the top-level object. The
+        elements of array members are yielded one by one as (key, element).
+        '''
+        self.expect("{")
+        if self.peek() == "}":
+            return
+        while True:
+            key = self.decode_value()
+            self.expect(":")
+            if self.peek() == "[":
+                self.pos += 1
+                if self.peek() == "]":
+                    self.pos += 1
+                else:
+                    while True:
+                        yield key, self.decode_value()
+                        if self.expect(",]") == "]":
+                            break
+            else:
+                yield key, self.decode_value()
+            if self.expect(",}") == "}":
+                return
+
+
+def iter_trace(path: str) -> Iterator[Tuple[List[dict], dict]]:
+    '''
+    Yields (module table, branch record) for each record of a trace. The count
+    of an aggregated edge is stored in the "count" field of its record.
+    '''
+    if trace_format.is_binary_trace(path):
+        reader = trace_format.BinaryTraceReader(path)
+        try:
+            modules, counts = reader.scan()
+            yield from with_counts(modules, counts, reader.iter_branches())
+        finally:
+            reader.close()
+        return
+
+    if not is_ndjson(path):
+        modules = []
+        with open(path, "r") as fin:
+            for key, value in JsonStream(fin).iter_members():
+                if key == "modules":
+                    modules.append(value)
+                elif key == "branches":
+                    yield modules, value
+        return
+
+    modules, counts = trace_format.scan_ndjson(path)
+    yield from with_counts(modules, counts, trace_format.iter_ndjson_branches(path))
+
+
+def is_ndjson(path: str) -> bool:
+    with open(path, "r") as fin:
+        line = fin.readline()
+    try:
+        return "type" in json.loads(line)
+    except (json.JSONDecodeError, TypeError):
+        return False
+
+
+def with_counts(modules: List[dict], counts: Dict[Tuple[int, int], int], records: Iterator[dict]) -> Iterator[Tuple[List[dict], dict]]:
+    for record in records:
+        if counts:
+            edge = (int(record["before"]["registers"]["rip"], 16), int(record["after"]["registers"]["rip"], 16))
+            if edge in counts:
+                record["count"] = counts[edge]
+        yield modules, record
+
+
+class ModuleTable:
+    def __init__(self, modules: List[dict]):
+        self.bases: Dict[str, int] = {}
+        self.sizes: Dict[str, Optional[int]] = {}
+        for module in modules:
+            if module["name"] not in self.bases:
+                self.bases[module["name"]] = int(module["addr"], 16)
+                # traces written before module sizes were recorded have none
+                self.sizes[module["name"]] = int(module["size"], 16) if "size" in module else None
+        self.sorted = sorted((base, name) for name, base in self.bases.items())
+        self.sorted_bases = [base for base, _ in self.sorted]
+
+    def contains(self, name: str, address: int) -> bool:
+        base, size = self.bases[name], self.sizes[name]
+        return base <= address and (size is None or address < base + size)
+
+    def rebase(self, name: Optional[str], address: int) -> Tuple[str, int]:
+        '''
+        Returns (module name, offset). Addresses which do not belong to a known
+        module (e.g., JIT or heap code, whose records have no module) are kept
+        as ("", address).
+        '''
+        if not name:
+            return "", address
+        if name in self.bases and self.contains(name, address):
+            return name, address - self.bases[name]
+        i = bisect.bisect_right(self.sorted_bases, address) - 1
+        if i < 0:
+            return "", address
+        base, name = self.sorted[i]
+        if not self.contains(name, address):
+            return "", address
+        return name, address - base
+
+
+def to_signed(value: int) -> int:
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def to_unsigned(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+
+class EdgeIndex:
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS edges (
+            site_module TEXT, site_offset INTEGER, destination_module TEXT, destination_offset INTEGER,
+            count INTEGER, sample TEXT,
+            PRIMARY KEY (site_module, site_offset, destination_module, destination_offset)) WITHOUT ROWID""")
+        self.pending: Dict[Tuple[str, int, str, int], list] = {}
+        self.module_bases: Dict[str, int] = {}
+        self.module_sizes: Dict[str, Optional[int]] = {}
+
+    def add(self, table: ModuleTable, record: dict):
+        site = table.rebase(record["before"]["module"], int(record["before"]["registers"]["rip"], 16))
+        destination = table.rebase(record["after"]["module"], int(record["after"]["registers"]["rip"], 16))
+        for name in (site[0], destination[0]):
+            if name and name not in self.module_bases:
+                # the first base seen becomes the base in the merged module table
+                self.module_bases[name] = table.bases[name]
+                self.module_sizes[name] = table.sizes[name]
+        key = (site[0], to_signed(site[1]), destination[0], to_signed(destination[1]))
+        count = record.get("count", 1)
+        if key in self.pending:
+            self.pending[key][0] += count
+            return
+        self.pending[key] = [count, record]
+        if len(self.pending) >= MAX_PENDING_EDGES:
+            self.flush()
+
+    def flush(self):
+        self.db.executemany(
+            "INSERT INTO edges VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT DO UPDATE SET count = count + excluded.count",
+            ((*key, count, json.dumps(record)) for key, (count, record) in self.pending.items()))
+        self.db.commit()
+        self.pending = {}
+
+    def iter_edges(self) -> Iterator[Tuple[str, int, str, int, int, dict]]:
+        self.flush()
+        for site_module, site_offset, destination_module, destination_offset, count, sample in self.db.execute(
+                "SELECT * FROM edges ORDER BY site_module, site_offset, destination_module, destination_offset"):
+            yield site_module, to_unsigned(site_offset), destination_module, to_unsigned(destination_offset), count, json.loads(sample)
+
+    def close(self):
+        self.db.close()
+
+
+def rebase_sample(sample: dict, key: str, edge_key: str, module: str, offset: int, module_bases: Dict[str, int]):
+    '''
+    Moves the address of the sample to the merged module table, and adds the
+    module-relative address as sample[edge_key]. The other registers are not
+    rebased; they are the values of the run the sample was taken from.
+    '''
+    address = module_bases[module] + offset if module else offset
+    sample[key]["registers"]["rip"] = f"0x{address:016x}"
+    sample[edge_key] = {"module": module, "offset": hex(offset)}
+
+
+def get_module_record(name: str, base: int, size: Optional[int]) -> dict:
+    record = {"name": name, "addr": hex(base)}
+    if size is not None:
+        record["size"] = hex(size)
+    return record
+
+
+def merge_traces(input_paths: List[str], output_path: str) -> Tuple[int, int]:
+    '''
+    Merges traces into output_path. Returns (number of input records, number of unique edges)
+    '''
+    num_records = 0
+    num_edges = 0
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_path))) as work_dir:
+        index = EdgeIndex(os.path.join(work_dir, "edges.sqlite"))
+        try:
+            for path in input_paths:
+                table = None
+                for modules, record in iter_trace(path):
+                    if table is None:
+                        table = ModuleTable(modules)
+                    index.add(table, record)
+                    num_records += 1
+
+            with open(output_path, "w") as fout:
+                edges = index.iter_edges()
+                fout.write('{"modules": ')
+                json.dump([get_module_record(name, base, index.module_sizes[name]) for name, base in index.module_bases.items()], fout)
+                fout.write(', "branches": [')
+                for site_module, site_offset, destination_module, destination_offset, count, sample in edges:
+                    rebase_sample(sample, "before", "site", site_module, site_offset, index.module_bases)
+                    rebase_sample(sample, "after", "destination", destination_module, destination_offset, index.module_bases)
+                    sample["count"] = count
+                    if num_edges:
+                        fout.write(",")
+                    fout.write("\n")
+                    json.dump(sample, fout)
+                    num_edges += 1
+                fout.write("\n]}\n")
+        finally:
+            index.close()
+    return num_records, num_edges
+
+
+def check_rebase() -> int:
+    '''
+    Checks that addresses are only credited to a module within its extent.
+    Returns the number of checked addresses
+    '''
+    table = ModuleTable([
+        {"name": "a.out", "addr": "0x400000", "size": "0x3000"},
+        {"name": "libc.so", "addr": "0x7f0000000000", "size": "0x200000"},
+        {"name": "old.so", "addr": "0x7f1000000000"},
+    ])
+    cases = [
+        (("a.out", 0x401234), ("a.out", 0x1234)),
+        (("libc.so", 0x7f0000001000), ("libc.so", 0x1000)),
+        # a wrong module name is corrected by the module table
+        (("libc.so", 0x400010), ("a.out", 0x10)),
+        # outside every module: between modules, above the last sized one, below the first
+        (("a.out", 0x403000), ("", 0x403000)),
+        (("", 0x7f0000200000), ("", 0x7f0000200000)),
+        ((None, 0x1000), ("", 0x1000)),
+        # records without a module (e.g., JIT code) are kept, even inside a module
+        ((None, 0x7f0000001000), ("", 0x7f0000001000)),
+        # modules of old traces have no size, so they extend to the next module
+        (("old.so", 0x7f1000123456), ("old.so", 0x123456)),
+    ]
+    for (name, address), expected in cases:
+        if (rebased := table.rebase(name, address)) != expected:
+            raise ValueError(f"rebase({name!r}, {address:#x}) is {rebased}, not {expected}")
+    return len(cases)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--check"]:
+        print(f"{check_rebase()} addresses are rebased as expected")
+        sys.exit(0)
+    if len(sys.argv) < 3:
+        print(__doc__, file=sys.stderr)
+        sys.exit(1)
+    num_records, num_edges = merge_traces(sys.argv[2:], sys.argv[1])
+    print(f"{num_records} records from {len(sys.argv) - 2} traces are merged into {num_edges} edges in {sys.argv[1]}")
@@ -0,0 +1,213 @@
+'''
+Asynchronous trace engine. The traced process runs in async mode, and its
+stops are handled on a dedicated SBListener thread instead of synchronous
+breakpoint script callbacks. Handlers only capture the state of the stopped
+thread; recording work (symbolication, serialization) is queued to worker
+threads, so the process is resumed as soon as the state is captured.
+
+A handler is called as handler(thread, bp_loc) for each thread stopped at its
+breakpoint, and returns CONTINUE, STOP (leave the process stopped) or STEP
+(queue the scripted thread plan registered with the handler before resuming).
+
+An exception in a handler or in recording work loses that record: the first
+one is printed with its traceback when it happens, and drain() raises it, so
+brt_save fails instead of saving an incomplete trace silently.
+'''
+
+import lldb
+import queue
+import sys
+import threading
+import traceback
+from typing import Callable, Dict, Optional, Tuple
+
+
+CONTINUE = "continue"
+STOP = "stop"
+STEP = "step"
+DEFAULT_MAX_QUEUED_WORK = 65536
+MAX_WORK_PER_BATCH = 256
+_STOP = object()
+
+Handler = Callable[[lldb.SBThread, lldb.SBBreakpointLocation], str]
+
+
+class TraceSession(threading.Thread):
+    def __init__(self, num_workers: int = 1, max_queued_work: int = DEFAULT_MAX_QUEUED_WORK):
+        super().__init__(name="trace-session", daemon=True)
+        self.listener = lldb.SBListener("trace-session")
+        self.handlers: Dict[int, Tuple[Handler, Optional[str]]] = {}
+        self.process: Optional[lldb.SBProcess] = None
+        self.stopped = threading.Event()
+        self.work: queue.Queue = queue.Queue(maxsize=max_queued_work)
+        self.workers = [threading.Thread(target=self.run_worker, name=f"trace-session-worker-{i}", daemon=True)
+                        for i in range(num_workers)]
+        self.num_stops = 0
+        self.num_handled_stops = 0
+        self.num_steps = 0
+        self.shares_listener = False
+        self.error: Optional[Exception] = None
+        self.num_errors = 0
+        self.num_reported_errors = 0
+
+    def renew(self) -> "TraceSession":
+        '''
+        Returns a new session with the same handlers. A session runs its threads
+        once, so each run of the process needs a new one.
+        '''
+        session = TraceSession(len(self.workers), self.work.maxsize)
+        session.handlers = dict(self.handlers)
+        return session
+
+    def add_handler(self, breakpoint_id: int, handler: Handler, step_plan: Optional[str] = None):
+        self.handlers[breakpoint_id] = (handler, step_plan)
+
+    def launch(self, target: lldb.SBTarget, args: list) -> lldb.SBError:
+        '''
+        Launches the process with the listener of this session, so its stops are
+        not reported to the interactive session
+        '''
+        launch_info = lldb.SBLaunchInfo(args)
+        launch_info.SetListener(self.listener)
+        error = lldb.SBError()
+        process = target.Launch(launch_info, error)
+        if error.Success():
+            self.start_with(process)
+        return error
+
+    def attach(self, process: lldb.SBProcess) -> lldb.SBError:
+        '''
+        Takes the state events of a process launched by the interactive session,
+        and resumes it. The listener of a launched process cannot be replaced, so
+        this listener is added next to it: the interactive session still receives
+        (and prints) every stop, which costs about as much as the stop itself.
+        Relaunch with launch() to avoid it.
+        '''
+        process.GetBroadcaster().AddListener(self.listener, lldb.SBProcess.eBroadcastBitStateChanged)
+        self.shares_listener = True
+        self.start_with(process)
+        return process.Continue()
+
+    def start_with(self, process: lldb.SBProcess):
+        self.process = process
+        for worker in self.workers:
+            worker.start()
+        self.start()
+
+    def run(self):
+        event = lldb.SBEvent()
+        while not self.stopped.is_set():
+            if not self.listener.WaitForEvent(1, event):
+                continue
+            if not lldb.SBProcess.EventIsProcessEvent(event):
+                continue
+            state = lldb.SBProcess.GetStateFromEvent(event)
+            if state == lldb.eStateStopped and not lldb.SBProcess.GetRestartedFromEvent(event):
+                self.handle_stop()
+            elif state in (lldb.eStateExited, lldb.eStateDetached, lldb.eStateCrashed):
+                print(f"Traced process is {lldb.SBDebugger.StateAsCString(state)} ({self.num_handled_stops} breakpoint stops handled)")
+                if self.shares_listener:
+                    print(f"{self.num_stops} stops were also reported to the interactive session. Use \"brt_run --restart\" to avoid it")
+                self.work.join()
+                self.report_errors()
+                break
+
+    def handle_stop(self):
+        self.num_stops += 1
+        target = self.process.GetTarget()
+        resume = True
+        steps = []
+        for thread in self.process:
+            reason = thread.GetStopReason()
+            if reason != lldb.eStopReasonBreakpoint:
+                if reason not in (lldb.eStopReasonNone, lldb.eStopReasonTrace, lldb.eStopReasonPlanComplete):
+                    resume = False
+                continue
+            breakpoint_id = thread.GetStopReasonDataAtIndex(0)
+            if (entry := self.handlers.get(breakpoint_id)) is None:
+                # a breakpoint set by the user
+                resume = False
+                continue
+            handler, step_plan = entry
+            bp_loc = target.FindBreakpointByID(breakpoint_id).FindLocationByID(thread.GetStopReasonDataAtIndex(1))
+            try:
+                action = handler(thread, bp_loc)
+            except Exception as e:
+                self.record_error(e)
+                action = CONTINUE
+            self.num_handled_stops += 1
+            if action == STOP:
+                resume = False
+            elif action == STEP and step_plan is not None:
+                steps.append((thread, step_plan))
+
+        if not resume:
+            thread = self.process.GetSelectedThread()
+            print(f"Traced process stopped: {thread.GetStopDescription(256)} (thread #{thread.GetIndexID()})")
+            return
+        for thread, step_plan in steps:
+            # the plans run when the process is resumed
+            thread.StepUsingScriptedThreadPlan(step_plan, False)
+            self.num_steps += 1
+        self.process.Continue()
+
+    def submit(self, function: Callable, *args):
+        self.work.put((function, args))
+
+    def run_worker(self):
+        while True:
+            items = [self.work.get()]
+            while len(items) < MAX_WORK_PER_BATCH:
+                try:
+                    items.append(self.work.get_nowait())
+                except queue.Empty:
+                    break
+            stop = False
+            for item in items:
+                if item is _STOP:
+                    stop = True
+                else:
+                    function, args = item
+                    try:
+                        function(*args)
+                    except Exception as e:
+                        self.record_error(e)
+                self.work.task_done()
+            if stop:
+                return
+
+    def record_error(self, error: Exception):
+        '''
+        Called in the except block of a failed handler or work item. Only the
+        first error is printed, so a failure at every stop does not flood the console.
+        '''
+        self.num_errors += 1
+        if self.error is None:
+            self.error = error
+            print("Trace engine error (the record of this stop is lost, later errors are only counted):", file=sys.stderr)
+            traceback.print_exc()
+
+    def report_errors(self):
+        if self.num_errors > self.num_reported_errors:
+            self.num_reported_errors = self.num_errors
+            print(f"The trace is incomplete: {self.num_errors} stops or records failed. First error: {self.error!r}", file=sys.stderr)
+
+    def drain(self):
+        '''
+        Waits until all queued recording work is done. Raises the first error of
+        the handlers and the recording work, as TraceWriter.flush() does.
+        '''
+        self.work.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+        # workers are daemon threads; they exit after the queued work is done
+        for worker in self.workers:
+            if worker.is_alive():
+                self.work.put(_STOP)
+        self.work.join()
+        self.report_errors()
@@ -0,0 +1,263 @@
+'''
+Sharded branch tracing. One debugger stops at one branch site at a time, so
+the branch sites are partitioned across N worker processes instead. Each worker
+launches its own copy of the target under its own debugger instance, and arms
+only its shard of the sites ("brt_set_bps --shard I/N"). Each worker streams
+its shard to a binary trace, and the shard traces are merged with trace_merge
+when all workers are done.
+
+The driver also works outside LLDB:
+    python3 trace_shards.py [options] <executable> [args ...]
+'''
+
+import json
+import optparse
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List, Optional, Tuple
+
+try:
+    import lldb
+except ImportError:
+    # run as a script outside LLDB
+    sys.path.insert(0, subprocess.check_output(["lldb", "-P"], text=True).strip())
+    import lldb
+
+import trace_merge
+from branch_scanner import get_python_executable
+
+
+FILE_NAME = os.path.basename(__file__)[:-3]
+COMMANDS_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def __lldb_init_module(debugger: lldb.SBDebugger, internal_dict: dict):
+    debugger.HandleCommand(f'command script add -f {FILE_NAME}.run_shards brt_shard -h "Trace the target in worker processes which arm a shard of the branch sites each, and merge the traces"')
+
+
+def run_shards(debugger: lldb.SBDebugger, command: str, exe_ctx: lldb.SBExecutionContext, result: lldb.SBCommandReturnObject, internal_dict: dict):
+    '''
+    Traces the executable of the selected target with the arguments
+    '''
+    parser = generate_option_parser()
+    try:
+        (options, args) = parser.parse_args(shlex.split(command))
+    except:
+        result.SetError(parser.usage)
+        return
+
+    target: lldb.SBTarget = debugger.GetSelectedTarget()
+    if not target.IsValid():
+        result.SetError("No target is selected")
+        return
+    try:
+        trace_in_shards(target.GetExecutable().fullpath, args, options)
+    except (OSError, RuntimeError) as e:
+        result.SetError(str(e))
+
+
+def trace_in_shards(executable: str, args: List[str], options) -> int:
+    '''
+    Runs the workers and merges their traces into options.output. Returns the
+    number of unique edges
+    '''
+    if "--async" in shlex.split(options.set_bps):
+        raise RuntimeError("Workers run brt_set_bps synchronously. Remove --async")
+    work_dir = options.work_dir or tempfile.mkdtemp(prefix="brt_shards_")
+    os.makedirs(work_dir, exist_ok=True)
+    lldb_python_dir = os.path.dirname(os.path.dirname(os.path.realpath(lldb.__file__)))
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = os.pathsep.join([lldb_python_dir, COMMANDS_DIR] + [path for path in [os.environ.get("PYTHONPATH")] if path])
+
+    start = time.perf_counter()
+    workers = []
+    for index in range(options.jobs):
+        config = {
+            "executable": executable,
+            "args": args,
+            "set_bps": options.set_bps,
+            "shard": f"{index}/{options.jobs}",
+            "max_stops": options.max_stops,
+            "trace": os.path.join(work_dir, f"shard_{index}.brt"),
+            "result": os.path.join(work_dir, f"shard_{index}.json"),
+        }
+        config_path = os.path.join(work_dir, f"shard_{index}.config.json")
+        with open(config_path, "w") as fout:
+            json.dump(config, fout)
+        log = open(os.path.join(work_dir, f"shard_{index}.log"), "w")
+        process = subprocess.Popen([get_python_executable(), os.path.realpath(__file__), "--worker", config_path],
+                                   stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT, env=environment)
+        workers.append((index, process, log, config))
+    print(f"{options.jobs} workers are started. Logs and shard traces are in {work_dir}")
+
+    deadline = None if options.timeout <= 0 else time.monotonic() + options.timeout
+    traces = []
+    for index, process, log, config in workers:
+        try:
+            process.wait(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+            print(f"Shard {index} timed out and was killed", file=sys.stderr)
+        log.close()
+        if os.path.exists(config["result"]):
+            with open(config["result"], "r") as fin:
+                shard = json.load(fin)
+            print(f"Shard {index}: {shard['sites']} sites, {shard['breakpoint_hits']} hits in {shard['run_seconds']:.2f} s, exit status {shard['exit_status']}"
+                  f"{' (truncated: killed after --max-stops stops)' if shard['truncated'] else ''}")
+        else:
+            print(f"Shard {index} failed (exit status {process.returncode}). See {log.name}", file=sys.stderr)
+        # the stream of a failed worker still holds the records written before the failure
+        if os.path.exists(config["trace"]) and os.path.getsize(config["trace"]) > 0:
+            traces.append(config["trace"])
+    if not traces:
+        raise RuntimeError("No shard trace was written")
+
+    num_records, num_edges = trace_merge.merge_traces(traces, options.output)
+    print(f"{num_records} records from {len(traces)} shards are merged into {num_edges} edges in {options.output} "
+          f"({time.perf_counter() - start:.2f} s in total)")
+    return num_edges
+
+
+def run_command(debugger: lldb.SBDebugger, command: str):
+    result = lldb.SBCommandReturnObject()
+    debugger.GetCommandInterpreter().HandleCommand(command, result)
+    if not result.Succeeded():
+        raise RuntimeError(f"{command} failed: {result.GetError()}")
+
+
+def launch_to_main(target: lldb.SBTarget, launch_info: lldb.SBLaunchInfo) -> lldb.SBProcess:
+    '''
+    Launches the target synchronously and stops at main, when the libraries
+    linked to the target are loaded (or at the entry point if there is no main)
+    '''
+    main_bp = target.BreakpointCreateByName("main", target.GetExecutable().GetFilename())
+    if main_bp.GetNumLocations() == 0:
+        launch_info.SetLaunchFlags(launch_info.GetLaunchFlags() | lldb.eLaunchFlagStopAtEntry)
+    error = lldb.SBError()
+    process = target.Launch(launch_info, error)
+    target.BreakpointDelete(main_bp.GetID())
+    if not error.Success() or process.GetState() != lldb.eStateStopped:
+        raise RuntimeError(f"Cannot launch {target.GetExecutable().fullpath}: {error.GetCString()}")
+    return process
+
+
+def run_to_exit(process: lldb.SBProcess, max_stops: int = 0) -> Tuple[float, bool]:
+    '''
+    Continues the process until it exits. Stops which are not caused by branch
+    sites (such as signals) are continued; after max_stops of them (0: never),
+    the process is killed. Returns (run time in seconds, True if it was killed)
+    '''
+    start = time.perf_counter()
+    process.Continue()
+    num_stops = 0
+    while process.GetState() == lldb.eStateStopped:
+        num_stops += 1
+        if 0 < max_stops < num_stops:
+            print(f"Warning: the process is killed after {max_stops} stops which are not branch sites. Its trace is truncated", file=sys.stderr)
+            process.Kill()
+            return time.perf_counter() - start, True
+        process.Continue()
+    return time.perf_counter() - start, False
+
+
+def run_worker(config: dict) -> dict:
+    '''
+    Launches the target, arms the shard of the branch sites, and runs the target
+    to the end while streaming the shard to config["trace"]
+    '''
+    debugger = lldb.SBDebugger.Create()
+    debugger.SetAsync(False)
+    run_command(debugger, f"command script import {os.path.join(COMMANDS_DIR, 'branch_trace.py')}")
+    target = debugger.CreateTarget(config["executable"])
+    if not target.IsValid():
+        raise RuntimeError(f"Cannot create a target for {config['executable']}")
+    process = launch_to_main(target, lldb.SBLaunchInfo(config["args"]))
+
+    run_command(debugger, f"brt_set_bps {config['set_bps']} --shard {config['shard']} --stream {config['trace']} --binary")
+    sites = sum(bp.GetNumLocations() for bp in target.breakpoint_iter())
+
+    run_seconds, truncated = run_to_exit(process, config["max_stops"])
+    breakpoint_hits = sum(bp.GetHitCount() for bp in target.breakpoint_iter())
+    run_command(debugger, "brt_save")
+    exit_status = process.GetExitStatus()
+    lldb.SBDebugger.Destroy(debugger)
+    return {
+        "shard": config["shard"],
+        "sites": sites,
+        "breakpoint_hits": breakpoint_hits,
+        "run_seconds": run_seconds,
+        "exit_status": exit_status,
+        "truncated": truncated,
+    }
+
+
+def generate_option_parser():
+    usage = "usage: %prog [options] [-- args ...]"
+    parser = optparse.OptionParser(usage=usage, prog="brt_shard")
+    parser.add_option("-j", "--jobs",
+                      action="store",
+                      type="int",
+                      default=os.cpu_count() or 1,
+                      dest="jobs",
+                      help="Number of worker processes (shards) (default: number of CPUs)")
+    parser.add_option("-o", "--output",
+                      action="store",
+                      default="/tmp/branches.json",
+                      dest="output",
+                      help="Merged trace (default: /tmp/branches.json)")
+    parser.add_option("--set-bps",
+                      action="store",
+                      default="",
+                      dest="set_bps",
+                      help="brt_set_bps options of the workers, as one quoted string (e.g., \"-f -a -m libfoo*\")")
+    parser.add_option("-t", "--timeout",
+                      action="store",
+                      type="float",
+                      default=0.0,
+                      dest="timeout",
+                      help="Kill the workers which are still running after this many seconds (0: never)")
+    parser.add_option("--max-stops",
+                      action="store",
+                      type="int",
+                      default=0,
+                      dest="max_stops",
+                      help="Kill a traced process after this many stops which are not branch sites, such as signals, "
+                           "and mark its trace as truncated (0: never)")
+    parser.add_option("-w", "--work-dir",
+                      action="store",
+                      default=None,
+                      dest="work_dir",
+                      help="Directory for the shard traces and logs (default: a new temporary directory)")
+    parser.add_option("--worker",
+                      action="store",
+                      default=None,
+                      dest="worker",
+                      help=optparse.SUPPRESS_HELP)
+    return parser
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = generate_option_parser()
+    parser.prog = os.path.basename(__file__)
+    parser.usage = "usage: python3 %prog [options] <executable> [args ...]"
+    parser.disable_interspersed_args()
+    (options, args) = parser.parse_args(argv)
+    if options.worker is not None:
+        with open(options.worker, "r") as fin:
+            config = json.load(fin)
+        shard = run_worker(config)
+        with open(config["result"], "w") as fout:
+            json.dump(shard, fout)
+        return
+    if not args:
+        parser.error("The executable is missing")
+    trace_in_shards(os.path.realpath(args[0]), args[1:], options)
+
+
+if __name__ == "__main__":
+    main()
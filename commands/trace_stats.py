@@ -0,0 +1,253 @@
+'''
+Instrumentation of the tracing commands: per-site hit counts and callback time,
+a log2-bucketed histogram of callback latency, and counters of stops, steps and
+memory reads. Shared by branch_trace (brt_stats) and sw_types_trace (swtt_stats).
+SB API objects are only used through the arguments, so lldb is not imported.
+Counters kept elsewhere (e.g. memory_cache) are added with extra_counters.
+'''
+
+import functools
+import json
+import optparse
+import shlex
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+NUM_BUCKETS = 48  # bucket i holds latencies in [2^(i-1), 2^i) ns, bucket 0 holds 0 ns
+
+
+@dataclass
+class SiteStats:
+    hits: int = 0
+    total_ns: int = 0
+    max_ns: int = 0
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.buckets = [0] * NUM_BUCKETS
+
+    def add(self, elapsed_ns: int):
+        self.buckets[min(elapsed_ns.bit_length(), NUM_BUCKETS - 1)] += 1
+
+    @staticmethod
+    def bounds(bucket: int) -> Tuple[int, int]:
+        if bucket == 0:
+            return 0, 1
+        return 1 << (bucket - 1), 1 << bucket
+
+    def percentile(self, fraction: float) -> Optional[int]:
+        '''
+        Returns the upper bound of the bucket containing the percentile
+        '''
+        total = sum(self.buckets)
+        if total == 0:
+            return None
+        rank = fraction * total
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return self.bounds(bucket)[1]
+        return self.bounds(NUM_BUCKETS - 1)[1]
+
+    def non_empty(self) -> List[Tuple[int, int, int]]:
+        return [(*self.bounds(bucket), count) for bucket, count in enumerate(self.buckets) if count]
+
+
+class TraceStats:
+    def __init__(self, extra_counters: Callable[[], Dict[str, int]] = dict):
+        self.extra_counters = extra_counters
+        self.clear()
+
+    def clear(self):
+        self.sites: Dict[int, SiteStats] = {}
+        self.histogram = LatencyHistogram()
+        self.counters: Dict[str, int] = {"stops": 0, "steps": 0, "memory_reads": 0}
+        self.callback_ns = 0
+        self.started: Optional[float] = None
+        # extra counters are cumulative, so they are shown relative to the last clear
+        self.extra_baseline = self.extra_counters()
+
+    def record(self, site: int, elapsed_ns: int):
+        if self.started is None:
+            self.started = time.monotonic()
+        site_stats = self.sites.get(site)
+        if site_stats is None:
+            site_stats = self.sites[site] = SiteStats()
+        site_stats.hits += 1
+        site_stats.total_ns += elapsed_ns
+        if elapsed_ns > site_stats.max_ns:
+            site_stats.max_ns = elapsed_ns
+        self.histogram.add(elapsed_ns)
+        self.callback_ns += elapsed_ns
+        self.counters["stops"] += 1
+
+    def count(self, name: str, n: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def all_counters(self) -> Dict[str, int]:
+        extra = {name: value - self.extra_baseline.get(name, 0) for name, value in self.extra_counters().items()}
+        return {**self.counters, **extra}
+
+    def wall_seconds(self) -> float:
+        return 0.0 if self.started is None else time.monotonic() - self.started
+
+    def top(self, n: int, key: str = "hits") -> List[Tuple[int, SiteStats]]:
+        return sorted(self.sites.items(), key=lambda item: getattr(item[1], key), reverse=True)[:n]
+
+    def sites_above(self, hits: int) -> List[int]:
+        return [site for site, site_stats in self.sites.items() if site_stats.hits > hits]
+
+    def to_json(self, describe: Callable[[int], Optional[str]] = lambda site: None, top: Optional[int] = None) -> dict:
+        sites = self.top(len(self.sites) if top is None else top)
+        return {
+            "counters": self.all_counters(),
+            "wall_seconds": self.wall_seconds(),
+            "callback_seconds": self.callback_ns / 1e9,
+            "latency_histogram": [{"lower_ns": lower, "upper_ns": upper, "count": count}
+                                  for lower, upper, count in self.histogram.non_empty()],
+            "latency_percentiles_ns": {name: self.histogram.percentile(fraction)
+                                       for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99))},
+            "sites": [{"address": hex(site), "symbol": describe(site), "hits": site_stats.hits,
+                       "total_ns": site_stats.total_ns, "max_ns": site_stats.max_ns}
+                      for site, site_stats in sites],
+        }
+
+    def format(self, describe: Callable[[int], Optional[str]], top: int) -> str:
+        wall_seconds = self.wall_seconds()
+        callback_seconds = self.callback_ns / 1e9
+        lines = [
+            ", ".join(f"{name}: {value}" for name, value in self.all_counters().items()),
+            f"callbacks: {callback_seconds:.3f} s of {wall_seconds:.3f} s since the first hit "
+            f"({100 * callback_seconds / wall_seconds if wall_seconds else 0:.1f}%)",
+            "callback latency:",
+        ]
+        for lower, upper, count in self.histogram.non_empty():
+            lines.append(f"    [{format_ns(lower):>8}, {format_ns(upper):>8}): {count}")
+        lines.append(f"top {top} sites:")
+        lines.append(f"    {'address':>18} {'hits':>10} {'total ms':>10} {'mean us':>10} {'max us':>10}  symbol")
+        for site, site_stats in self.top(top):
+            lines.append(f"    0x{site:016x} {site_stats.hits:>10} {site_stats.total_ns / 1e6:>10.2f} "
+                         f"{site_stats.total_ns / site_stats.hits / 1e3:>10.1f} {site_stats.max_ns / 1e3:>10.1f}  {describe(site) or ''}")
+        return "\n".join(lines)
+
+
+def format_ns(ns: int) -> str:
+    for unit, scale in (("s", 10 ** 9), ("ms", 10 ** 6), ("us", 10 ** 3)):
+        if ns >= scale:
+            return f"{ns / scale:g}{unit}"
+    return f"{ns}ns"
+
+
+def timed_callback(stats: TraceStats):
+    '''
+    Decorates a breakpoint callback (frame, bp_loc, dict) to record its latency
+    for the site at the PC of the frame
+    '''
+    def decorator(callback):
+        @functools.wraps(callback)
+        def wrapper(frame, bp_loc, internal_dict):
+            start = time.perf_counter_ns()
+            try:
+                return callback(frame, bp_loc, internal_dict)
+            finally:
+                stats.record(frame.GetPC(), time.perf_counter_ns() - start)
+        return wrapper
+    return decorator
+
+
+def timed_handler(stats: TraceStats):
+    '''
+    Same as timed_callback for trace engine handlers (thread, bp_loc)
+    '''
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(thread, bp_loc):
+            start = time.perf_counter_ns()
+            try:
+                return handler(thread, bp_loc)
+            finally:
+                stats.record(thread.GetFrameAtIndex(0).GetPC(), time.perf_counter_ns() - start)
+        return wrapper
+    return decorator
+
+
+def describe_site(target, site: int) -> Optional[str]:
+    address = target.ResolveLoadAddress(site)
+    symbol = address.GetSymbol()
+    if not symbol.IsValid():
+        return None
+    offset = site - symbol.GetStartAddress().GetLoadAddress(target)
+    return f"{address.GetModule().GetFileSpec().GetFilename()}`{symbol.GetName()}+{offset}"
+
+
+def disable_sites(target, sites: List[int]) -> int:
+    '''
+    Disables the breakpoint locations at the given sites. Returns the number of
+    disabled locations
+    '''
+    sites = set(sites)
+    num_disabled = 0
+    for bp in target.breakpoint_iter():
+        for bp_loc in bp:
+            if bp_loc.IsEnabled() and bp_loc.GetLoadAddress() in sites:
+                bp_loc.SetEnabled(False)
+                num_disabled += 1
+    return num_disabled
+
+
+def handle_stats_command(debugger, command: str, result, stats: TraceStats, prog: str):
+    '''
+    Implements brt_stats and swtt_stats
+    '''
+    parser = generate_option_parser(prog)
+    try:
+        (options, args) = parser.parse_args(shlex.split(command, posix=False))
+    except:
+        result.SetError(parser.usage)
+        return
+
+    target = debugger.GetSelectedTarget()
+    describe = functools.partial(describe_site, target)
+    print(stats.format(describe, options.top))
+    if options.output is not None:
+        with open(options.output, "w") as fout:
+            json.dump(stats.to_json(describe), fout, indent=2)
+        print(f"Statistics are saved to {options.output}")
+    if options.disable_above is not None:
+        sites = stats.sites_above(options.disable_above)
+        print(f"{disable_sites(target, sites)} breakpoint locations at {len(sites)} sites with more than {options.disable_above} hits are disabled")
+    if options.reset:
+        stats.clear()
+        print("Statistics are reset")
+
+
+def generate_option_parser(prog: str):
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage, prog=prog)
+    parser.add_option("-n", "--top",
+                      action="store",
+                      type="int",
+                      default=20,
+                      dest="top",
+                      help="Number of the hottest sites to show (default: 20)")
+    parser.add_option("-d", "--disable-above",
+                      action="store",
+                      type="int",
+                      default=None,
+                      dest="disable_above",
+                      help="Disable the breakpoints at the sites hit more than this many times")
+    parser.add_option("-o", "--output",
+                      action="store",
+                      default=None,
+                      dest="output",
+                      help="Save the statistics of all sites to this JSON file")
+    parser.add_option("--reset",
+                      action="store_true",
+                      default=False,
+                      dest="reset",
+                      help="Reset the statistics after showing them")
+    return parser
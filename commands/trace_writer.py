@@ -0,0 +1,109 @@
+'''
+Append-only trace writer. Records are queued by breakpoint callbacks and
+written by a background thread, so callbacks never wait for file I/O unless the
+bounded queue is full.
+'''
+
+import json
+import os
+import queue
+import threading
+from typing import List, Optional
+
+from trace_format import BinaryTraceEncoder, to_json_value
+
+
+DEFAULT_MAX_QUEUED_RECORDS = 65536
+MAX_RECORDS_PER_WRITE = 1024
+_STOP = object()
+
+
+class NdjsonSink:
+    def __init__(self, path: str):
+        self.file = open(path, "w")
+
+    def write_records(self, records: List[dict]):
+        self.file.write("".join(json.dumps(record, separators=(",", ":"), default=to_json_value) + "\n" for record in records))
+        self.file.flush()
+
+    def flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class BinarySink(BinaryTraceEncoder):
+    def flush(self):
+        super().flush()
+        os.fsync(self.file.fileno())
+
+
+class TraceWriter:
+    def __init__(self, path: str, binary: bool = False, max_queued_records: int = DEFAULT_MAX_QUEUED_RECORDS):
+        self.path = path
+        self.sink = BinarySink(path) if binary else NdjsonSink(path)
+        self.queue: queue.Queue = queue.Queue(maxsize=max_queued_records)
+        self.num_records = 0
+        self.num_blocked_writes = 0
+        self.error: Optional[Exception] = None
+        self.thread = threading.Thread(target=self.run, name=f"TraceWriter({path})", daemon=True)
+        self.thread.start()
+
+    def write(self, record: dict):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # back-pressure instead of dropping records or growing without bound
+            self.num_blocked_writes += 1
+            self.queue.put(record)
+
+    def run(self):
+        while True:
+            items = [self.queue.get()]
+            while len(items) < MAX_RECORDS_PER_WRITE:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            records = []
+            for item in items:
+                if isinstance(item, dict):
+                    records.append(item)
+                    continue
+                self.write_records(records)
+                records = []
+                if item is _STOP:
+                    self.call_sink(self.sink.close)
+                    return
+                # flush request
+                self.call_sink(self.sink.flush)
+                item.set()
+            self.write_records(records)
+
+    def write_records(self, records: List[dict]):
+        if records:
+            self.call_sink(self.sink.write_records, records)
+            self.num_records += len(records)
+
+    def call_sink(self, method, *args):
+        try:
+            method(*args)
+        except Exception as e:
+            self.error = e
+
+    def flush(self):
+        '''
+        Waits until all queued records are written to disk
+        '''
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.queue.put(_STOP)
+        self.thread.join()
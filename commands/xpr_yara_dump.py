@@ -1,63 +1,135 @@
 import lldb
+import hashlib
 import os
+import optparse
+import shlex
+import shutil
 import sys
 import subprocess
-from typing import Optional
+import tempfile
+from typing import Dict, Optional
+
+import analysis_cache
+import branch_scanner
+import memory_cache
+from module_utils import get_image_base, get_module_path, read_text_section
 
 
 FILE_NAME = os.path.basename(__file__)[:-3]
 OUTPUT_FD = None
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+MAX_RULE_STRING_SIZE = 64 * 1024 * 1024
+rule_hashes: Dict[bytes, int] = {}
 
 
 def __lldb_init_module(debugger: lldb.SBDebugger, internal_dict: dict):
     debugger.HandleCommand(
     f'command script add -f {FILE_NAME}.handle_command xpr_yara_dump -h "Dump yara rule strings of XProtectRemediator"')
+    debugger.HandleCommand(
+    f'command script add -f {FILE_NAME}.flush xpr_yara_flush -h "Flush the output of xpr_yara_dump"')
+
+
+def get_YaraMatcher_init_addr(target: lldb.SBTarget, module: lldb.SBModule, use_r2: bool = False) -> Optional[int]:
+    '''
+    Returns the load address of YaraMatcher.init. The offset from the image base
+    is cached per binary, so relaunches with a different ASLR slide reuse it.
+    '''
+    target_path = get_module_path(module)
+    image_base = get_image_base(target, module)
+    file_hash = analysis_cache.hash_file(target_path)
+    cache_kind = analysis_cache.get_kind("YaraMatcher_init", target)
+    if (offset := analysis_cache.load(cache_kind, file_hash)) is not None:
+        return image_base + offset
+
+    if use_r2 and shutil.which("r2") is not None:
+        addr = get_YaraMatcher_init_addr_with_r2(target_path, image_base)
+    else:
+        addr = find_YaraMatcher_init_addr(target, module)
+    if addr is None:
+        print("Cannot get YaraMatcher.init", file=sys.stderr)
+        print(f"Are you really debugging XProtectRemediator? (executable is {target_path})", file=sys.stderr)
+        return None
+
+    analysis_cache.store(cache_kind, file_hash, addr - image_base)
+    return addr
 
 
-def get_YaraMatcher_init_addr(target_path: str, image_base: int) -> Optional[int]:
-    r2_script_path = "/tmp/get_YaraMatcher_init.r2"
-    with open(r2_script_path, "w") as fout:
+def find_YaraMatcher_init_addr(target: lldb.SBTarget, module: lldb.SBModule) -> Optional[int]:
+    '''
+    YaraMatcher.init is the function which calls yr_compiler_create. Finds the
+    direct calls to the yr_compiler_create stub in the text section without
+    spawning an external process.
+    '''
+    stub_addrs = set()
+    for symbol_context in module.FindSymbols("yr_compiler_create"):
+        addr = symbol_context.GetSymbol().GetStartAddress().GetLoadAddress(target)
+        if addr != lldb.LLDB_INVALID_ADDRESS:
+            stub_addrs.add(addr)
+    decoder = branch_scanner.get_decoder(target.GetTriple().split('-')[0])
+    if not stub_addrs or decoder is None:
+        return None
+
+    data, text_address = read_text_section(target, module)
+    for branch in decoder.iter_direct_branches(data, text_address):
+        if branch.kind != "call" or branch.destination not in stub_addrs:
+            continue
+        symbol = target.ResolveLoadAddress(branch.address).GetSymbol()
+        if symbol.IsValid():
+            return symbol.GetStartAddress().GetLoadAddress(target)
+    return None
+
+
+def get_YaraMatcher_init_addr_with_r2(target_path: str, image_base: int) -> Optional[int]:
+    with tempfile.NamedTemporaryFile("w", prefix="get_YaraMatcher_init_", suffix=".r2", delete=False) as fout:
+        r2_script_path = fout.name
         fout.write("aa\n")
         fout.write("s $(axt sym.imp.yr_compiler_create~[0])\n")
         fout.write("s")
-    
-    r2_process = subprocess.Popen(["r2", "-e", "bin.relocs.apply=true", "-i", r2_script_path, "-B", hex(image_base) , "-q", target_path], 
-                                  stdout=subprocess.PIPE, 
-                                  stderr=subprocess.PIPE, 
-                                  text=True)
-    output, _ = r2_process.communicate()
-    addr = None
+
     try:
-        addr = int(output.strip(), 16)
-    except Exception as e:
-        print("Cannot get YaraMatcher.init", file=sys.stderr)
-        print(f"Are you really debugging XProtectRemediator? (executable is {target_path})", file=sys.stderr)
-    return addr
+        r2_process = subprocess.Popen(["r2", "-e", "bin.relocs.apply=true", "-i", r2_script_path, "-B", hex(image_base) , "-q", target_path],
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE,
+                                      text=True)
+        output, _ = r2_process.communicate()
+    finally:
+        os.remove(r2_script_path)
+    try:
+        return int(output.strip(), 16)
+    except ValueError:
+        return None
 
 
 def break_on_YaraMatcher_init(frame: lldb.SBFrame, bp_loc: lldb.SBAddress, dict: dict):
-    thread = frame.GetThread()
-    process = thread.GetProcess()
-    process.GetTarget().GetDebugger().SetAsync(False)
-    r13_value = frame.FindRegister("r13").GetValueAsUnsigned()
-    print(f"Yara Matcher @ 0x{r13_value:016x}", file=OUTPUT_FD)
-    OUTPUT_FD.flush()
+    write_yara_matcher(frame.FindRegister("r13").GetValueAsUnsigned())
     return False
 
 
 def break_on_yr_compiler_add_string(frame: lldb.SBFrame, bp_loc: lldb.SBAddress, dict: dict):
+    # the string may be freed after the call, so it is always copied here
     string_ptr = frame.FindRegister("rsi").GetValueAsUnsigned()
-    error = lldb.SBError()
-    yara_rule_string = frame.GetThread().GetProcess().ReadCStringFromMemory(string_ptr, 0xffffffff, error)
-
-    if error.Success():
-        print(f"YARA rule:\n{yara_rule_string}", file=OUTPUT_FD)
-        OUTPUT_FD.flush()
+    process = frame.GetThread().GetProcess()
+    yara_rule_string = memory_cache.get_cache(process).read_c_string(string_ptr, MAX_RULE_STRING_SIZE)
+    if yara_rule_string is None:
+        print(f"Error reading YARA rule string at 0x{string_ptr:016x}", file=sys.stderr)
     else:
-        print(f"Error reading YARA rule string: {error.GetCString()}", file=sys.stderr)
+        write_yara_rule(yara_rule_string)
     return False
 
 
+def write_yara_matcher(address: int):
+    print(f"Yara Matcher @ 0x{address:016x}", file=OUTPUT_FD)
+
+
+def write_yara_rule(yara_rule_string: bytes):
+    digest = hashlib.sha256(yara_rule_string).digest()
+    if digest in rule_hashes:
+        print(f"YARA rule: same as rule #{rule_hashes[digest]} (sha256: {digest.hex()})", file=OUTPUT_FD)
+        return
+    rule_hashes[digest] = len(rule_hashes)
+    print(f"YARA rule:\n{yara_rule_string.decode(errors='replace')}", file=OUTPUT_FD)
+
+
 def get_target_executable(debugger):
     file_spec = debugger.GetSelectedTarget().GetExecutable()
     directory = file_spec.GetDirectory()
@@ -70,20 +142,49 @@ def handle_command(debugger: lldb.SBDebugger, command: str, exe_ctx: lldb.SBExec
     '''
     Dump yara rule strings of XProtectRemediator
     '''
+    command_args = shlex.split(command, posix=False)
+    parser = generate_option_parser()
+    try:
+        (options, args) = parser.parse_args(command_args)
+    except:
+        result.SetError(parser.usage)
+        return
+
     target_executable = get_target_executable(debugger)
     module_name = os.path.basename(target_executable)
     output_file = f"/tmp/{module_name}_yara_dump.txt"
     global OUTPUT_FD
-    OUTPUT_FD = open(output_file, "w")
+    if OUTPUT_FD is not None:
+        OUTPUT_FD.close()
+    OUTPUT_FD = open(output_file, "w", buffering=OUTPUT_BUFFER_SIZE)
+    rule_hashes.clear()
 
     target: lldb.SBTarget = debugger.GetSelectedTarget()
     main_module: lldb.SBModule = target.GetModuleAtIndex(0)
-    image_base = main_module.GetObjectFileHeaderAddress().GetLoadAddress(target)
-    YaraMatcher_init_addr = get_YaraMatcher_init_addr(target_executable, image_base)
+    YaraMatcher_init_addr = get_YaraMatcher_init_addr(target, main_module, options.use_r2)
     if YaraMatcher_init_addr is None:
         return
 
     target.BreakpointCreateByAddress(YaraMatcher_init_addr).SetScriptCallbackFunction(f"{FILE_NAME}.break_on_YaraMatcher_init")
     target.BreakpointCreateByName("yr_compiler_add_string").SetScriptCallbackFunction(f"{FILE_NAME}.break_on_yr_compiler_add_string")
     print("Callback functions are set. Please continue the execution.")
-    print(f"Dumped result will be saved to {output_file}")
\ No newline at end of file
+    print(f"Dumped result will be saved to {output_file} (flushed by xpr_yara_flush, or when LLDB exits)")
+
+
+def flush(debugger: lldb.SBDebugger, command: str, exe_ctx: lldb.SBExecutionContext, result: lldb.SBCommandReturnObject, internal_dict: dict):
+    if OUTPUT_FD is None:
+        result.SetError("xpr_yara_dump is not running")
+        return
+    OUTPUT_FD.flush()
+    print(f"Flushed {OUTPUT_FD.name}")
+
+
+def generate_option_parser():
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage, prog="xpr_yara_dump")
+    parser.add_option("--r2",
+                      action="store_true",
+                      default=False,
+                      dest="use_r2",
+                      help="Find YaraMatcher.init with radare2 instead of the built-in scanner (slow)")
+    return parser
\ No newline at end of file